@@ -0,0 +1,374 @@
+"""
+Proxy load and latency benchmark
+
+Runs a local upstream and the proxy in processes of their own, then drives
+the proxy with many concurrent asyncio clients for a fixed time in each
+scenario:
+
+    forward     a new connection for every request
+    keepalive   requests over persistent connections
+    large_body  uploads echoed back by the upstream (--body-size bytes)
+    suppress    requests answered by a callback without going upstream
+    tunnel      requests over CONNECT tunnels
+
+Each scenario reports requests per second, latency percentiles, throughput
+and how much the proxy's resident memory grew per client connection.
+Results can be saved as JSON and compared with an earlier run:
+
+    python -m benchmarks.proxy_load [--duration 10] [--connections 64]
+        [--output results.json] [--compare baseline.json]
+"""
+
+import argparse
+import asyncio
+from dataclasses import dataclass
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import pyproxy
+from pyproxy import (
+    HttpRequest, HttpResponse, ProxyServer, ProxyServerAction, ProxyServerCallback
+)
+from pyproxy.loops import EventLoop, loop_factory, run
+
+LOOPBACK = "127.0.0.1"
+UPSTREAM_PORT = 9997
+PROXY_PORT = 9999
+SMALL_BODY = 256
+SUPPRESSED_BODY = b"x" * SMALL_BODY
+RSS_SAMPLE_INTERVAL = 0.1
+PERCENTILES = { "p50": 0.5, "p99": 0.99, "p999": 0.999 }
+
+
+@dataclass
+class Scenario:
+    name: str
+    path: str = f"/bytes/{SMALL_BODY}"
+    upload: int = 0
+    keep_alive: bool = True
+    tunnel: bool = False
+    suppress: bool = False
+
+    def request(self) -> bytes:
+        target = (self.path if self.tunnel
+            else f"http://{LOOPBACK}:{UPSTREAM_PORT}{self.path}")
+        method = "POST" if self.upload else "GET"
+        headers = f"Host: {LOOPBACK}:{UPSTREAM_PORT}\r\n"
+        if self.upload:
+            headers += f"Content-Length: {self.upload}\r\n"
+        if not self.keep_alive:
+            headers += "Connection: close\r\n"
+        head = f"{method} {target} HTTP/1.1\r\n{headers}\r\n".encode()
+        return head + b"\0" * self.upload
+
+
+def scenarios(body_size: int) -> Dict[str, Scenario]:
+    return { scenario.name: scenario for scenario in (
+        Scenario("forward", keep_alive=False),
+        Scenario("keepalive"),
+        Scenario("large_body", path="/echo", upload=body_size),
+        Scenario("suppress", suppress=True),
+        Scenario("tunnel", tunnel=True),
+    ) }
+
+
+# Upstream
+
+async def upstream_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Answers /bytes/<n> with n bytes, and echoes the body of anything else."""
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            path = head.split(b" ", 2)[1].rsplit(b"/", 2)
+            length = content_length(head)
+            body = await reader.readexactly(length) if length else b""
+            if path[-2] == b"bytes":
+                body = b"\0" * int(path[-1])
+            writer.write(b"HTTP/1.1 200 OK\r\nCache-Control: no-store\r\n"
+                b"Content-Length: %d\r\n\r\n" % len(body))
+            writer.write(body)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def run_upstream(loop: str) -> None:
+    async def main() -> None:
+        server = await asyncio.start_server(upstream_handler, LOOPBACK, UPSTREAM_PORT)
+        async with server:
+            await server.serve_forever()
+
+    run(main(), loop)
+
+
+# Proxy
+
+class SuppressCallback(ProxyServerCallback):
+    async def on_new_request_async(self, request: HttpRequest) -> ProxyServerAction:
+        return ProxyServerAction.Suppress
+
+    async def on_new_response_async(
+        self, action: ProxyServerAction, request: HttpRequest, response: HttpResponse
+        ) -> None:
+
+        response.http_version = request.version
+        response.response_code = 200
+        response.response_text = "OK"
+        response.headers.clear()
+        response.set_body(SUPPRESSED_BODY)
+
+
+def run_proxy(loop: str, suppress: bool) -> None:
+    server = ProxyServer(LOOPBACK, PROXY_PORT)
+    server.set_options(allow_loopback_target=True, event_loop=loop)
+    if suppress:
+        server.register_callback(SuppressCallback())
+    server.run_forever()
+
+
+def rss(pid: int) -> Optional[int]:
+    """Resident memory of process pid in bytes, where /proc has it."""
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+# Clients
+
+def content_length(head: bytes) -> int:
+    for line in head.lower().split(b"\r\n"):
+        if line.startswith(b"content-length:"):
+            return int(line[15:])
+    return 0
+
+
+class Results:
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.bytes = 0
+        self.errors = 0
+
+    def summary(self, elapsed: float, connections: int, rss_growth: Optional[int]
+        ) -> Dict[str, Any]:
+
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        summary: Dict[str, Any] = {
+            "requests": count,
+            "errors": self.errors,
+            "requests_per_second": count / elapsed,
+            "throughput_mib_per_second": self.bytes / elapsed / 2**20,
+        }
+        for name, quantile in PERCENTILES.items():
+            summary[f"latency_{name}_ms"] = (
+                latencies[min(int(quantile * count), count - 1)] * 1000
+                if count else None)
+        summary["rss_per_connection_kib"] = (
+            rss_growth / connections / 1024 if rss_growth is not None else None)
+        return summary
+
+
+async def open_connection(scenario: Scenario
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+
+    reader, writer = await asyncio.open_connection(LOOPBACK, PROXY_PORT)
+    if scenario.tunnel:
+        writer.write(f"CONNECT {LOOPBACK}:{UPSTREAM_PORT} HTTP/1.1\r\n"
+            f"Host: {LOOPBACK}:{UPSTREAM_PORT}\r\n\r\n".encode())
+        head = await reader.readuntil(b"\r\n\r\n")
+        if not head.startswith(b"HTTP/1.1 200"):
+            writer.close()
+            raise ConnectionError(f"CONNECT failed: {head!r}")
+    return reader, writer
+
+
+async def exchange(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, request: bytes
+    ) -> int:
+    """Sends request and reads the response. Returns the bytes received."""
+    writer.write(request)
+    head = await reader.readuntil(b"\r\n\r\n")
+    if not head.startswith(b"HTTP/1.1 200"):
+        raise ConnectionError(f"unexpected response: {head[:40]!r}")
+    length = content_length(head)
+    await reader.readexactly(length)
+    return len(head) + length
+
+
+async def client(
+    scenario: Scenario, results: Results, record_from: float, stop_at: float) -> None:
+
+    request = scenario.request()
+    writer: Optional[asyncio.StreamWriter] = None
+    while (start := time.perf_counter()) < stop_at:
+        try:
+            if writer is None:
+                reader, writer = await open_connection(scenario)
+            received = await exchange(reader, writer, request)
+            if not scenario.keep_alive:
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            if start >= record_from:
+                results.errors += 1
+            if writer is not None:
+                writer.close()
+                writer = None
+            continue
+
+        if start >= record_from:
+            results.latencies.append(time.perf_counter() - start)
+            results.bytes += len(request) + received
+    if writer is not None:
+        writer.close()
+
+
+async def sample_rss(pid: int, peak: List[int], stop_at: float) -> None:
+    while time.perf_counter() < stop_at:
+        size = rss(pid)
+        if size is not None:
+            peak[0] = max(peak[0], size)
+        await asyncio.sleep(RSS_SAMPLE_INTERVAL)
+
+
+async def wait_listening(port: int) -> None:
+    for _ in range(50):
+        try:
+            _, writer = await asyncio.open_connection(LOOPBACK, port)
+            writer.close()
+            return
+        except ConnectionError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+async def benchmark(
+    scenario: Scenario, loop: str, connections: int, duration: float, warmup: float
+    ) -> Dict[str, Any]:
+
+    proxy = multiprocessing.Process(
+        target=run_proxy, args=(loop, scenario.suppress), daemon=True)
+    proxy.start()
+    try:
+        await wait_listening(PROXY_PORT)
+        assert proxy.pid is not None
+        idle_rss = rss(proxy.pid)
+        peak = [idle_rss or 0]
+
+        record_from = time.perf_counter() + warmup
+        stop_at = record_from + duration
+        results = Results()
+        await asyncio.gather(
+            sample_rss(proxy.pid, peak, stop_at),
+            *(client(scenario, results, record_from, stop_at)
+                for _ in range(connections)))
+        rss_growth = peak[0] - idle_rss if idle_rss is not None else None
+        return results.summary(duration, connections, rss_growth)
+    finally:
+        proxy.terminate()
+        proxy.join()
+
+
+def environment(loop: str) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "describe", "--always", "--dirty"],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    event_loop = loop_factory(loop)()
+    event_loop.close()
+    return {
+        "pyproxy": pyproxy.__version__,
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "event_loop": type(event_loop).__module__.split(".")[0],
+    }
+
+
+def print_summary(name: str, summary: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> None:
+    rss_text = (f"{summary['rss_per_connection_kib']:7.1f} KiB/conn"
+        if summary["rss_per_connection_kib"] is not None else "")
+    line = (f"{name:>10}: {summary['requests_per_second']:9.0f} req/s  "
+        f"p50 {summary['latency_p50_ms'] or 0:7.2f} ms  "
+        f"p99 {summary['latency_p99_ms'] or 0:7.2f} ms  "
+        f"p999 {summary['latency_p999_ms'] or 0:7.2f} ms  "
+        f"{summary['throughput_mib_per_second']:8.1f} MiB/s  {rss_text}")
+    if summary["errors"]:
+        line += f"  ({summary['errors']} errors)"
+    if baseline and baseline.get("requests_per_second"):
+        line += f"  [{summary['requests_per_second'] / baseline['requests_per_second']:.2f}x]"
+    print(line)
+
+
+async def main(args: argparse.Namespace) -> None:
+    baseline: Dict[str, Any] = { }
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["scenarios"]
+
+    upstream = multiprocessing.Process(target=run_upstream, args=(args.loop,), daemon=True)
+    upstream.start()
+    results: Dict[str, Any] = {
+        "environment": environment(args.loop),
+        "parameters": {
+            "connections": args.connections,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "body_size": args.body_size,
+        },
+        "scenarios": { },
+    }
+    try:
+        await wait_listening(UPSTREAM_PORT)
+        for name, scenario in scenarios(args.body_size).items():
+            if args.scenarios and name not in args.scenarios:
+                continue
+            summary = await benchmark(
+                scenario, args.loop, args.connections, args.duration, args.warmup)
+            results["scenarios"][name] = summary
+            print_summary(name, summary, baseline.get(name))
+    finally:
+        upstream.terminate()
+        upstream.join()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=64,
+        help="concurrent client connections")
+    parser.add_argument("--duration", type=float, default=10,
+        help="seconds measured per scenario")
+    parser.add_argument("--warmup", type=float, default=2,
+        help="seconds to run each scenario before measuring")
+    parser.add_argument("--body-size", type=int, default=1024 * 1024,
+        help="request and response body size for large_body")
+    parser.add_argument("--loop", choices=[kind.value for kind in EventLoop],
+        default=EventLoop.Auto.value, help="event loop for the proxy and clients")
+    parser.add_argument("--scenarios", nargs="+",
+        choices=list(scenarios(0)), help="scenarios to run (default: all)")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare",
+        help="JSON results of an earlier run to compare requests per second with")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    run(main(arguments), arguments.loop)
@@ -0,0 +1,113 @@
+"""
+CONNECT tunnel throughput benchmark
+
+Starts a local upstream that streams a fixed number of bytes to whoever
+connects, runs the proxy in a separate process with each tunnel mode and
+relay engine, and counts the bytes a client receives through a CONNECT
+tunnel.
+
+    python -m benchmarks.tunnel_throughput [--size-mb 512] [--runs 3]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import time
+from typing import Any, Dict, List
+
+from pyproxy import ProxyServer
+from pyproxy.relay import RelayEngine
+from pyproxy.tunnel import TunnelMode, splice_supported
+
+LOOPBACK = "127.0.0.1"
+UPSTREAM_PORT = 9997
+PROXY_PORT = 9999
+CHUNK = b"\0" * (256 * 1024)
+
+
+def run_proxy(options: Dict[str, Any]) -> None:
+    async def main() -> None:
+        server = ProxyServer(LOOPBACK, PROXY_PORT)
+        server.set_options(allow_loopback_target=True, **options)
+        await server.run()
+
+    asyncio.run(main())
+
+
+async def source_handler(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, size: int) -> None:
+
+    sent = 0
+    while sent < size:
+        writer.write(CHUNK)
+        await writer.drain()
+        sent += len(CHUNK)
+    writer.close()
+
+
+async def measure(size: int) -> float:
+    reader, writer = await asyncio.open_connection(LOOPBACK, PROXY_PORT)
+    writer.write(f"CONNECT {LOOPBACK}:{UPSTREAM_PORT} HTTP/1.1\r\n\r\n".encode())
+    await reader.readuntil(b"\r\n\r\n")
+
+    start = time.perf_counter()
+    received = 0
+    while data := await reader.read(1024 * 1024):
+        received += len(data)
+    elapsed = time.perf_counter() - start
+    writer.close()
+
+    assert received >= size, f"only received {received} of {size} bytes"
+    return received / elapsed
+
+
+async def benchmark(options: Dict[str, Any], size: int, runs: int) -> List[float]:
+    proxy = multiprocessing.Process(target=run_proxy, args=(options,), daemon=True)
+    proxy.start()
+    try:
+        # Wait for the proxy to start listening
+        for _ in range(50):
+            try:
+                _, writer = await asyncio.open_connection(LOOPBACK, PROXY_PORT)
+                writer.close()
+                break
+            except ConnectionError:
+                await asyncio.sleep(0.1)
+
+        return [await measure(size) for _ in range(runs)]
+    finally:
+        proxy.terminate()
+        proxy.join()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024
+
+    upstream = await asyncio.start_server(
+        lambda r, w: source_handler(r, w, size), LOOPBACK, UPSTREAM_PORT)
+
+    configurations = {
+        "streams": { "tunnel_mode": TunnelMode.Streams.value },
+        "recv_into": { "tunnel_mode": TunnelMode.RecvInto.value },
+        "protocol": { "relay_engine": RelayEngine.Protocol.value },
+    }
+    if splice_supported():
+        configurations["splice"] = { "tunnel_mode": TunnelMode.Splice.value }
+
+    baseline = 0.0
+    async with upstream:
+        for name, options in configurations.items():
+            results = await benchmark(options, size, args.runs)
+            best = max(results)
+            baseline = baseline or best
+            print(f"{name:>10}: {best / 2**20:8.1f} MiB/s "
+                f"({best / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,5 +1,8 @@
 __version__ = "0.2.1"
 
-from .callback import ProxyServerAction, ProxyServerCallback
+from .callback import ProxyServerAction, ProxyServerCallback, ProxyServerSyncCallback
+from .forms import FormError, FormPart
 from .httprequest import HttpRequest, HttpResponse, parse_form_data
 from .proxyserver import ProxyServer
+from .tls import TlsProfile
+from .workers import WorkerSupervisor
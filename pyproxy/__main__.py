@@ -1,9 +1,12 @@
-import asyncio
+import argparse
 import logging
+from typing import List, Optional
 
 from .callback import ProxyServerAction, ProxyServerCallback
 from .httprequest import HttpRequest, HttpResponse
+from .loops import EventLoop
 from .proxyserver import ProxyServer
+from .workers import WorkerSupervisor
 
 PROXY_IP = ""
 PROXY_PORT = 8080
@@ -18,6 +21,11 @@ def setup_logging() -> None:
     ch.setLevel(logging.DEBUG)
     _LOGGER.addHandler(ch)
 
+    # Worker starts, exits and restarts
+    workers_logger = logging.getLogger("pyproxy.workers")
+    workers_logger.setLevel(logging.INFO)
+    workers_logger.addHandler(ch)
+
 class ProxyCallback(ProxyServerCallback):
     async def on_new_request_async(self, request: HttpRequest) -> ProxyServerAction:
         print("ProxyCallback:on_new_request_async: returning ProxyServerAction.Forward")
@@ -30,12 +38,39 @@ class ProxyCallback(ProxyServerCallback):
         print("ProxyCallback:on_new_response_async: returning ProxyServerAction.Forward")
 
 
-if __name__ == "__main__":
-    setup_logging()
-    server = ProxyServer(PROXY_IP, PROXY_PORT)
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m pyproxy")
+    parser.add_argument("--address", default=PROXY_IP,
+        help="address to listen on (default: all interfaces)")
+    parser.add_argument("--port", type=int, default=PROXY_PORT,
+        help=f"port to listen on (default: {PROXY_PORT})")
+    parser.add_argument("--workers", type=int, nargs="?", const=0,
+        help="serve from this many processes sharing the port (default: one "
+        "per CPU when given without a number)")
+    parser.add_argument("--loop", choices=[kind.value for kind in EventLoop],
+        default=EventLoop.Auto.value,
+        help="event loop implementation (default: uvloop if installed)")
+    return parser.parse_args(argv)
+
+
+def create_server(address: str, port: int, loop: str = EventLoop.Auto) -> ProxyServer:
+    server = ProxyServer(address, port)
+    server.set_options(event_loop=loop)
     callback = ProxyCallback()
     server.register_callback(callback)
+    return server
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_logging()
+    if args.workers is not None:
+        supervisor = WorkerSupervisor(
+            lambda: create_server(args.address, args.port, args.loop), args.workers)
+        raise SystemExit(supervisor.run())
+
+    server = create_server(args.address, args.port, args.loop)
     try:
-        asyncio.run(server.run())
+        server.run_forever()
     except KeyboardInterrupt:
         print("Exiting.")
@@ -0,0 +1,189 @@
+"""
+Batched access log
+
+Requests are recorded as plain tuples in a fixed-size ring buffer, which is
+all the work done while handling them. A background task wakes up every
+FLUSH_INTERVAL seconds (or sooner when the buffer is half full), formats
+what has accumulated and writes it in one go from a worker thread, so
+neither formatting nor file I/O happens on the request path. When records
+come in faster than they're written, the oldest are dropped and counted.
+"""
+
+import asyncio
+from collections import deque
+from enum import Enum
+import json
+import logging
+import os
+import random
+import time
+from typing import BinaryIO, Deque, List, Optional, Tuple
+
+_LOGGER = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 1.0
+
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+    "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+# time, client address, method, target, version, status, bytes sent,
+# duration in seconds, callback action
+Record = Tuple[float, str, str, str, str, int, int, float, str]
+
+
+class AccessLogFormat(str, Enum):
+    # Common Log Format, followed by the duration in milliseconds and the
+    # callback action
+    Common = "common"
+    Json = "json"
+
+
+def _clf_time(timestamp: float) -> str:
+    t = time.localtime(timestamp)
+    offset = t.tm_gmtoff // 60
+    sign = "-" if offset < 0 else "+"
+    return (f"{t.tm_mday:02d}/{_MONTHS[t.tm_mon - 1]}/{t.tm_year}:"
+        f"{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d} "
+        f"{sign}{abs(offset) // 60:02d}{abs(offset) % 60:02d}")
+
+
+def format_common(record: Record) -> str:
+    timestamp, client, method, target, version, status, size, duration, action = record
+    return (f'{client} - - [{_clf_time(timestamp)}] "{method} {target} {version}" '
+        f'{status} {size or "-"} {duration * 1000:.3f} {action}\n')
+
+
+def format_json(record: Record) -> str:
+    timestamp, client, method, target, version, status, size, duration, action = record
+    return json.dumps({
+        "time": timestamp,
+        "client": client,
+        "method": method,
+        "target": target,
+        "version": version,
+        "status": status,
+        "bytes": size,
+        "duration_ms": round(duration * 1000, 3),
+        "action": action,
+    }) + "\n"
+
+
+class AccessLog:
+    """
+    Writes access records to path. sample_rate is the fraction of requests
+    logged (server errors are always logged). The file is rotated once it
+    reaches max_bytes (0 for never), keeping `backups` old files as path.1,
+    path.2 and so on.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        format: str = AccessLogFormat.Common,
+        sample_rate: float = 1.0,
+        max_bytes: int = 0,
+        backups: int = 5,
+        buffer_size: int = 8192):
+
+        self.path = path
+        self._format = (format_json if AccessLogFormat(format) == AccessLogFormat.Json
+            else format_common)
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._records: Deque[Record] = deque(maxlen=max(buffer_size, 1))
+        self._batch_size = max(buffer_size // 2, 1)
+        self._wakeup = asyncio.Event()
+        self._writer: Optional["asyncio.Task[None]"] = None
+        self._closing = False
+        self._file: Optional[BinaryIO] = None
+        self._size = 0
+        self.dropped = 0
+
+    def record(
+        self,
+        client: str,
+        method: str,
+        target: str,
+        version: str,
+        status: int,
+        size: int,
+        duration: float,
+        action: str = "-") -> None:
+
+        if (self.sample_rate < 1.0 and status < 500
+            and random.random() >= self.sample_rate):
+            return
+        records = self._records
+        if len(records) == records.maxlen:
+            self.dropped += 1
+        records.append((time.time(), client, method, target, version, status,
+            size, duration, action))
+        if len(records) >= self._batch_size:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        if self._writer is None:
+            self._closing = False
+            self._writer = asyncio.create_task(self._run(), name="access log")
+
+    async def close(self) -> None:
+        """Writes out what's left and closes the file."""
+        self._closing = True
+        self._wakeup.set()
+        if self._writer is not None:
+            # Not cancelled: it could be halfway through a write
+            await self._writer
+            self._writer = None
+        try:
+            await self.flush()
+        except OSError as e:
+            _LOGGER.error("writing the access log failed: %r", e)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except OSError as e:
+                _LOGGER.error("writing the access log failed: %r", e)
+
+    async def flush(self) -> None:
+        if not self._records:
+            return
+        records: List[Record] = list(self._records)
+        self._records.clear()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write, records)
+
+    def _write(self, records: List[Record]) -> None:
+        data = "".join(map(self._format, records)).encode()
+        if self._file is None:
+            self._file = open(self.path, "ab")
+            self._size = self._file.tell()
+        if self.max_bytes and self._size and self._size + len(data) > self.max_bytes:
+            self._rotate()
+        assert self._file is not None
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def _rotate(self) -> None:
+        assert self._file is not None
+        self._file.close()
+        if self.backups > 0:
+            for n in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{n}"):
+                    os.replace(f"{self.path}.{n}", f"{self.path}.{n + 1}")
+            os.replace(self.path, f"{self.path}.1")
+            self._file = open(self.path, "ab")
+        else:
+            self._file = open(self.path, "wb")
+        self._size = 0
@@ -0,0 +1,158 @@
+"""
+Admission control for client connections
+
+The server accepts connections itself rather than through asyncio.Server, so
+that it can stop accepting while it's at its connection limit: clients then
+wait in the listen backlog instead of each costing a task and buffers. Limits
+per client IP address are enforced after accepting, by turning connections
+away. A slot is only taken once a connection is accepted, so idle listeners
+don't hold any; with several listeners, one may still accept a connection
+just as another fills the last slot, and that connection is turned away too.
+Every connection's task is kept in a TaskRegistry so that the server can wait
+for them (or cancel them) when it shuts down.
+"""
+
+import asyncio
+import errno
+import logging
+import os
+import socket
+from typing import Any, Coroutine, Dict, List, Optional, Set
+
+_LOGGER = logging.getLogger(__name__)
+
+# accept() errors that go away once connections are closed, and how long to
+# stop accepting when running into one
+RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+ACCEPT_RETRY_DELAY = 1.0
+
+REJECT_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+
+
+class AdmissionControl:
+    """
+    Connection slots: at most max_connections in total and max_per_ip for any
+    one client address (0 for no limit).
+    """
+
+    def __init__(self, max_connections: int = 0, max_per_ip: int = 0):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.active = 0
+        self._per_ip: Dict[str, int] = { }
+        self._room = asyncio.Event()
+
+    def is_full(self) -> bool:
+        return bool(self.max_connections) and self.active >= self.max_connections
+
+    async def wait_for_room(self) -> None:
+        """Waits until there's a free slot, without taking it."""
+        while self.is_full():
+            self._room.clear()
+            await self._room.wait()
+
+    def try_reserve(self) -> bool:
+        """Takes a free slot if there is one, and returns whether there was."""
+        if self.is_full():
+            return False
+        self.active += 1
+        return True
+
+    def admit(self, ip: str) -> bool:
+        """
+        Assigns a reserved slot to a client address, or frees it and returns
+        False if that address is over its limit.
+        """
+        count = self._per_ip.get(ip, 0)
+        if self.max_per_ip and count >= self.max_per_ip:
+            self.release()
+            return False
+        self._per_ip[ip] = count + 1
+        return True
+
+    def release(self, ip: Optional[str] = None) -> None:
+        """Frees a slot, admitted for ip if given."""
+        self.active -= 1
+        if ip is not None:
+            count = self._per_ip[ip] - 1
+            if count:
+                self._per_ip[ip] = count
+            else:
+                del self._per_ip[ip]
+        self._room.set()
+
+    def count(self, ip: str) -> int:
+        return self._per_ip.get(ip, 0)
+
+
+class TaskRegistry:
+    """The running tasks of a kind, so they can be waited for or cancelled."""
+
+    def __init__(self) -> None:
+        self._tasks: Set["asyncio.Task[Any]"] = set()
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def spawn(self, coro: Coroutine[Any, Any, Any], name: str) -> "asyncio.Task[Any]":
+        task = asyncio.create_task(coro, name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """Waits up to timeout for all tasks to finish. Returns if they did."""
+        if not self._tasks:
+            return True
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        return not pending
+
+    async def cancel(self) -> None:
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def bind(
+    host: Optional[str], port: int, backlog: int = 100, reuse_port: bool = False
+    ) -> List[socket.socket]:
+    """
+    Listening sockets for host (all interfaces if None) and port. With port 0,
+    they all listen on the port the first one gets.
+    """
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(host or None, port,
+        type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
+    sockets: List[socket.socket] = []
+    try:
+        for family, type, proto, _, address in dict.fromkeys(infos):
+            sock = socket.socket(family, type, proto)
+            sockets.append(sock)
+            if os.name == "posix":
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if family == socket.AF_INET6 and hasattr(socket, "IPPROTO_IPV6"):
+                # Leave IPv4 to its own socket
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            if port == 0 and len(sockets) > 1:
+                address = (address[0], sockets[0].getsockname()[1], *address[2:])
+            sock.bind(address)
+            sock.listen(backlog)
+            sock.setblocking(False)
+    except BaseException:
+        for sock in sockets:
+            sock.close()
+        raise
+    return sockets
+
+
+def reject(sock: socket.socket) -> None:
+    """Turns a connection away with a 503 response, as far as it fits."""
+    try:
+        sock.send(REJECT_RESPONSE)
+    except OSError:
+        pass
+    sock.close()
@@ -0,0 +1,168 @@
+"""
+Storage for message bodies that are read in full
+
+Small bodies are kept in memory as long as there's room under a memory budget
+shared by all the bodies a BodyStore holds. Bodies over the spill threshold,
+or that don't fit in the budget, are spooled to a temporary file and read
+back through a memory map, so a few large uploads can't run the process out
+of memory. Either way the stored body is read as a memoryview, without
+copying it.
+"""
+
+import logging
+import mmap
+import tempfile
+from typing import IO, List, Optional
+
+_LOGGER = logging.getLogger(__name__)
+
+SPILL_THRESHOLD = 1024 * 1024
+MEMORY_BUDGET = 64 * 1024 * 1024
+
+
+class MemoryBudget:
+    """Bytes of body data held in memory, up to limit (0 for no limit)."""
+
+    __slots__ = ("limit", "used")
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+
+    def reserve(self, size: int) -> bool:
+        if self.limit and self.used + size > self.limit:
+            return False
+        self.used += size
+        return True
+
+    def release(self, size: int) -> None:
+        self.used -= size
+
+
+class BodyStore:
+    def __init__(
+        self,
+        spill_threshold: int = SPILL_THRESHOLD,
+        memory_budget: int = MEMORY_BUDGET,
+        spool_dir: Optional[str] = None):
+
+        self.spill_threshold = spill_threshold
+        self.budget = MemoryBudget(memory_budget)
+        self.spool_dir = spool_dir
+        self.spilled = 0
+
+    def create(self, size_hint: int = -1) -> "StoredBody":
+        """
+        Returns an empty body to write to. size_hint, if known, is the size
+        the body will have.
+        """
+        return StoredBody(self, size_hint)
+
+
+class StoredBody:
+    """
+    A body being written to a BodyStore. Once written, getbuffer() gives read
+    access to it. close() frees the memory or file it takes up.
+    """
+
+    def __init__(self, store: BodyStore, size_hint: int = -1):
+        self._store = store
+        self._chunks: List[bytes] = []
+        self._size = 0
+        # Bytes reserved from the store's memory budget
+        self._reserved = 0
+        self._value: Optional[bytes] = None
+        self._file: Optional[IO[bytes]] = None
+        self._map: Optional[mmap.mmap] = None
+        self._closed = False
+        if size_hint > 0 and not self._fits(size_hint):
+            self._spill()
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def _fits(self, size: int) -> bool:
+        if size > self._store.spill_threshold:
+            return False
+        extra = size - self._reserved
+        if extra > 0:
+            if not self._store.budget.reserve(extra):
+                return False
+            self._reserved += extra
+        return True
+
+    def _release(self) -> None:
+        self._store.budget.release(self._reserved)
+        self._reserved = 0
+
+    def _spill(self) -> None:
+        self._file = tempfile.TemporaryFile(dir=self._store.spool_dir)
+        self._store.spilled += 1
+        _LOGGER.debug("spooling body to disk after %d bytes", self._size)
+        for chunk in self._chunks:
+            self._file.write(chunk)
+        self._chunks.clear()
+        self._release()
+
+    def write(self, data: bytes) -> None:
+        if self._value is not None or self._closed:
+            raise ValueError("body already written")
+        if self._file is None and not self._fits(self._size + len(data)):
+            self._spill()
+        self._size += len(data)
+        if self._file is not None:
+            # Written through the page cache; this doesn't wait on the disk
+            self._file.write(data)
+        else:
+            self._chunks.append(data)
+
+    def getbuffer(self) -> memoryview:
+        """The whole body. Writing to the body is no longer possible."""
+        if self._closed:
+            raise ValueError("body is closed")
+        if self._file is None:
+            return memoryview(self.getvalue())
+        if self._map is None:
+            self._file.flush()
+            if self._size == 0:
+                return memoryview(b"")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)
+
+    def getvalue(self) -> bytes:
+        """The whole body as bytes, which copies it if it was spooled."""
+        if self._file is not None:
+            return bytes(self.getbuffer())
+        if self._value is None:
+            self._value = b"".join(self._chunks)
+            self._chunks.clear()
+            # Hand back memory reserved for a size that didn't materialize
+            if self._reserved > self._size:
+                self._store.budget.release(self._reserved - self._size)
+                self._reserved = self._size
+        return self._value
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._release()
+        self._chunks.clear()
+        self._value = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Still referenced (say, by a transport's write buffer); the
+                # mapping goes away with the last reference
+                pass
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+
+    def __del__(self) -> None:
+        self.close()
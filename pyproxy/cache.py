@@ -0,0 +1,317 @@
+"""
+Bounded in-memory HTTP response cache (a subset of RFC 9111 for a shared cache)
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .headers import HttpHeaders
+from .httprequest import HttpRequest, HttpResponse
+
+# Status codes we're willing to store (heuristically cacheable by default)
+CACHEABLE_STATUS = frozenset((200, 203, 300, 301, 308, 404, 410))
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX = 24 * 60 * 60
+
+# Header fields a 304 response updates in the stored response
+UPDATED_FIELDS = ("Cache-Control", "Date", "ETag", "Expires", "Last-Modified", "Vary")
+
+_LOGGER = logging.getLogger(__name__)
+
+VariantKey = Tuple[Optional[str], ...]
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    revalidations: int = 0
+    stores: int = 0
+    evictions: int = 0
+
+
+def parse_cache_control(values: List[str]) -> Dict[str, Optional[str]]:
+    directives: Dict[str, Optional[str]] = { }
+    for value in values:
+        for directive in value.split(","):
+            name, _, argument = directive.strip().partition("=")
+            if name:
+                directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+
+def _parse_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_seconds(value: Optional[str]) -> Optional[int]:
+    try:
+        return max(0, int(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+def freshness_lifetime(headers: HttpHeaders, cache_control: Dict[str, Optional[str]]) -> float:
+    for directive in ("s-maxage", "max-age"):
+        seconds = _parse_seconds(cache_control.get(directive))
+        if seconds is not None:
+            return seconds
+
+    date = _parse_date(headers.get("Date")) or time.time()
+    if "Expires" in headers:
+        # An invalid Expires (e.g. "0") means already expired
+        expires = _parse_date(headers.get("Expires"))
+        return max(0.0, expires - date) if expires else 0.0
+
+    last_modified = _parse_date(headers.get("Last-Modified"))
+    if last_modified:
+        return min(HEURISTIC_MAX, max(0.0, (date - last_modified) * HEURISTIC_FRACTION))
+    return 0.0
+
+
+class CacheEntry:
+    def __init__(self, head: bytes, body: bytes, vary: Tuple[str, ...]):
+        self.head = head
+        self.body = body
+        self.vary = vary
+        self.size = len(head) + len(body)
+        self._update_freshness(HttpHeaders.from_head(head))
+
+    def _update_freshness(self, headers: HttpHeaders) -> None:
+        cache_control = parse_cache_control(headers.get_all("Cache-Control"))
+        self.response_time = time.time()
+        self.initial_age = float(_parse_seconds(headers.get("Age")) or 0)
+        self.lifetime = freshness_lifetime(headers, cache_control)
+        self.must_revalidate = "no-cache" in cache_control
+        self.etag = headers.get("ETag")
+        self.last_modified = headers.get("Last-Modified")
+
+    @property
+    def age(self) -> float:
+        return self.initial_age + time.time() - self.response_time
+
+    def is_fresh(self) -> bool:
+        return not self.must_revalidate and self.age < self.lifetime
+
+    def has_validators(self) -> bool:
+        return bool(self.etag or self.last_modified)
+
+    def add_conditions(self, request: HttpRequest) -> bool:
+        """
+        Turns request into a conditional request to revalidate this entry.
+        Requests that are already conditional are left alone.
+        """
+        if (not self.has_validators() or "If-None-Match" in request.headers
+            or "If-Modified-Since" in request.headers):
+            return False
+        if self.etag:
+            request.headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            request.headers["If-Modified-Since"] = self.last_modified
+        return True
+
+    def refresh(self, not_modified: HttpResponse) -> None:
+        """Updates the stored head with the fields from a 304 response."""
+        headers = HttpHeaders.from_head(self.head)
+        for name in UPDATED_FIELDS:
+            values = not_modified.headers.get_all(name)
+            if values:
+                headers[name] = values[0]
+                for value in values[1:]:
+                    headers.add(name, value)
+        self.head = headers.head
+        self.size = len(self.head) + len(self.body)
+        self._update_freshness(headers)
+
+    def to_response(self, request: HttpRequest) -> HttpResponse:
+        response = HttpResponse(request_method=request.method)
+        response.set_head(self.head)
+        response.headers["Age"] = str(int(self.age))
+        response.set_body(self.body)
+        return response
+
+
+class CacheWriter:
+    """Collects a response body as it's relayed, up to a size limit."""
+
+    def __init__(self, key: str, head: bytes, vary: Tuple[str, ...], limit: int):
+        self.key = key
+        self.head = head
+        self.vary = vary
+        self._limit = limit - len(head)
+        self._chunks: List[bytes] = []
+        self._size = 0
+        self.overflowed = False
+
+    def write(self, data: bytes) -> None:
+        if self.overflowed:
+            return
+        self._size += len(data)
+        if self._size > self._limit:
+            self.overflowed = True
+            self._chunks.clear()
+        else:
+            self._chunks.append(data)
+
+    def get_entry(self) -> CacheEntry:
+        return CacheEntry(self.head, b"".join(self._chunks), self.vary)
+
+
+class ResponseCache:
+    """
+    Stores GET responses in memory, up to max_bytes in total, evicting the
+    least recently used entries first. Responses that vary on request header
+    fields are stored once per variant.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.stats = CacheStats()
+        self._entries: "OrderedDict[Tuple[str, VariantKey], CacheEntry]" = OrderedDict()
+        # Request header fields each URL varies on, and how many variants of
+        # it are stored
+        self._vary: Dict[str, Tuple[str, ...]] = { }
+        self._variants: Dict[str, int] = { }
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def get_key(request: HttpRequest, hostname: str, port: int) -> str:
+        url = request.url
+        target = f"{url.path or '/'}?{url.query}" if url.query else url.path or "/"
+        # http and https on the same port are different servers
+        return f"{url.scheme or 'http'}://{hostname}:{port}{target}"
+
+    @staticmethod
+    def is_cacheable_request(request: HttpRequest) -> bool:
+        if request.method != "GET" or "Authorization" in request.headers:
+            return False
+        cache_control = parse_cache_control(request.headers.get_all("Cache-Control"))
+        return "no-store" not in cache_control
+
+    @staticmethod
+    def wants_revalidation(request: HttpRequest) -> bool:
+        """Whether the client asked us not to serve a stored response as is."""
+        cache_control = parse_cache_control(request.headers.get_all("Cache-Control"))
+        return ("no-cache" in cache_control
+            or _parse_seconds(cache_control.get("max-age")) == 0
+            or (not cache_control
+                and "no-cache" in (request.headers.get("Pragma") or "")))
+
+    @staticmethod
+    def _variant(request: HttpRequest, vary: Tuple[str, ...]) -> VariantKey:
+        return tuple(request.headers.get(name) for name in vary)
+
+    def lookup(self, request: HttpRequest, key: str) -> Optional[CacheEntry]:
+        vary = self._vary.get(key)
+        if vary is None:
+            return None
+        entry_key = (key, self._variant(request, vary))
+        entry = self._entries.get(entry_key)
+        if entry:
+            self._entries.move_to_end(entry_key)
+        return entry
+
+    def start(self, request: HttpRequest, response: HttpResponse, key: str
+        ) -> Optional[CacheWriter]:
+        """Returns a CacheWriter if the response can be stored."""
+        if response.response_code not in CACHEABLE_STATUS:
+            return None
+
+        headers = response.headers
+        cache_control = parse_cache_control(headers.get_all("Cache-Control"))
+        if ("no-store" in cache_control or "private" in cache_control
+            or "Set-Cookie" in headers):
+            return None
+
+        vary = tuple(sorted({ v.strip().lower()
+            for value in headers.get_all("Vary") for v in value.split(",")
+            if v.strip() }))
+        if "*" in vary:
+            return None
+
+        if (freshness_lifetime(headers, cache_control) <= 0
+            and "ETag" not in headers and "Last-Modified" not in headers):
+            # It would be stale right away with no way to revalidate it
+            return None
+
+        length = response.get_content_length()
+        if length > self.max_entry_bytes:
+            return None
+        return CacheWriter(key, response.get_head(), vary, self.max_entry_bytes)
+
+    def store(self, request: HttpRequest, writer: CacheWriter) -> None:
+        if writer.overflowed:
+            return
+
+        entry = writer.get_entry()
+        key = writer.key
+        if self._vary.get(key) != entry.vary:
+            # Variants stored under different Vary fields are unreachable now
+            self._remove_url(key)
+
+        entry_key = (key, self._variant(request, entry.vary))
+        self._remove(entry_key)
+        self._vary[key] = entry.vary
+        self._entries[entry_key] = entry
+        self._variants[key] = self._variants.get(key, 0) + 1
+        self._size += entry.size
+        self.stats.stores += 1
+        _LOGGER.debug("cache: stored %s (%d bytes)", key, entry.size)
+        self._evict()
+
+    def refresh(self, entry: CacheEntry, not_modified: HttpResponse) -> None:
+        self._size -= entry.size
+        entry.refresh(not_modified)
+        self._size += entry.size
+        self.stats.revalidations += 1
+        self._evict()
+
+    def _forget(self, key: str, entry: CacheEntry) -> None:
+        self._size -= entry.size
+        count = self._variants.get(key, 0) - 1
+        if count > 0:
+            self._variants[key] = count
+        else:
+            self._variants.pop(key, None)
+            self._vary.pop(key, None)
+
+    def _remove(self, entry_key: Tuple[str, VariantKey]) -> None:
+        entry = self._entries.pop(entry_key, None)
+        if entry:
+            self._forget(entry_key[0], entry)
+
+    def _remove_url(self, key: str) -> None:
+        if key in self._variants:
+            for entry_key in [k for k in self._entries if k[0] == key]:
+                self._remove(entry_key)
+        self._vary.pop(key, None)
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and self._entries:
+            (key, _), entry = self._entries.popitem(last=False)
+            self._forget(key, entry)
+            self.stats.evictions += 1
+            _LOGGER.debug("cache: evicted %s", key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._vary.clear()
+        self._variants.clear()
+        self._size = 0
@@ -60,3 +60,50 @@ class ProxyServerCallback(ABC):
         response: HttpResponse) -> None:
 
         pass
+
+
+class ProxyServerSyncCallback(ProxyServerCallback):
+    """
+    A callback with plain functions for hooks, for policy code that is slow
+    or CPU-heavy. The server runs them in its callback thread pool
+    (callback_threads threads, at most callback_concurrency hooks at a time),
+    so they don't hold up other connections while they work.
+
+    Hooks get the request and response objects themselves, and must not
+    touch them once they return. With read_bodies set, bodies are read in
+    full before the hooks are called, for them to look at through
+    get_body_buffer() (a view of the stored body, which isn't copied).
+    """
+
+    read_bodies: bool = False
+
+    @abstractmethod
+    def on_new_request(self, request: HttpRequest) -> ProxyServerAction:
+        pass
+
+    @abstractmethod
+    def on_new_response(
+        self,
+        action: ProxyServerAction,
+        request: HttpRequest,
+        response: HttpResponse) -> None:
+
+        pass
+
+    # Used when the callback is called directly rather than by the server:
+    # then the hooks run on the event loop
+
+    async def on_new_request_async(self, request: HttpRequest) -> ProxyServerAction:
+        if self.read_bodies:
+            await request.read_body_buffer()
+        return self.on_new_request(request)
+
+    async def on_new_response_async(
+        self,
+        action: ProxyServerAction,
+        request: HttpRequest,
+        response: HttpResponse) -> None:
+
+        if self.read_bodies and action == ProxyServerAction.Forward:
+            await response.read_body_buffer()
+        self.on_new_response(action, request, response)
@@ -0,0 +1,51 @@
+"""
+A thread pool for synchronous callback hooks
+
+ProxyServerSyncCallback hooks run here instead of on the event loop. The
+number of hooks in flight is capped separately from the number of threads,
+so that a burst of requests to a slow hook waits on the event loop (where it
+costs nothing but a task) instead of piling up in the executor's queue.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+from typing import Any, Callable, Optional, TypeVar
+
+_LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class CallbackPool:
+    """
+    Runs functions in `threads` threads, with at most `concurrency` of them
+    (threads if 0) running or queued at a time.
+    """
+
+    def __init__(self, threads: int = 4, concurrency: int = 0):
+        self.threads = max(threads, 1)
+        self.concurrency = concurrency if concurrency > 0 else self.threads
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self.active = 0
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        async with self._slots:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.threads,
+                    thread_name_prefix="callback")
+            loop = asyncio.get_running_loop()
+            self.active += 1
+            try:
+                return await loop.run_in_executor(
+                    self._executor, functools.partial(func, *args))
+            finally:
+                self.active -= 1
+
+    def close(self) -> None:
+        """Stops the threads once the hooks they're running return."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
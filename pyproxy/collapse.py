@@ -0,0 +1,238 @@
+"""
+Collapsed forwarding
+
+Identical requests that arrive while one of them is being fetched from
+upstream wait for that fetch instead of going upstream themselves. The fetch
+runs in a task of its own (a Flight), which reads the response body into a
+buffer that every attached request reads from at its own pace, so a slow or
+departed client doesn't hold up the others.
+
+A flight buffers at most max_buffer bytes beyond its slowest reader, and
+stops reading upstream until there's room. Once it has had to let go of the
+start of the body, requests that come later can't attach to it any more.
+"""
+
+import asyncio
+from asyncio.streams import StreamReader
+from collections import deque
+import logging
+from typing import Coroutine, Deque, Dict, Iterable, Optional, Set, Tuple
+import weakref
+
+from .framing import BodyFraming
+from .httprequest import HttpRequest, HttpResponse
+
+_LOGGER = logging.getLogger(__name__)
+
+COLLAPSED_METHODS = frozenset(("GET", "HEAD"))
+# Requests with these fields may want a different response than the others
+CONDITIONAL_FIELDS = ("If-Match", "If-None-Match", "If-Modified-Since",
+    "If-Unmodified-Since", "If-Range", "Range")
+
+
+class Flight:
+    """An upstream fetch, and the body read so far."""
+
+    def __init__(self, max_buffer: int):
+        self.max_buffer = max_buffer
+        # The response head, and whether anyone but the first request can
+        # have the response
+        self.head: "asyncio.Future[Tuple[bytes, bool]]" = (
+            asyncio.get_running_loop().create_future())
+        self._chunks: Deque[bytes] = deque()
+        # Index of the first chunk kept in _chunks
+        self._first = 0
+        self._buffered = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._readers: "weakref.WeakSet[FlightReader]" = weakref.WeakSet()
+        self._changed: "asyncio.Future[None]" = self.head.get_loop().create_future()
+
+    @property
+    def joinable(self) -> bool:
+        return self._first == 0 and self.error is None
+
+    def reader(self) -> "FlightReader":
+        assert self.joinable
+        reader = FlightReader(self)
+        self._readers.add(reader)
+        return reader
+
+    def remove(self, reader: "FlightReader") -> None:
+        self._readers.discard(reader)
+        self._notify()
+
+    def chunk(self, index: int) -> Optional[bytes]:
+        """The body chunk at index, if it has been read."""
+        position = index - self._first
+        return self._chunks[position] if position < len(self._chunks) else None
+
+    async def wait(self) -> None:
+        """Waits for more of the body, its end, or a reader to make progress."""
+        await asyncio.shield(self._changed)
+
+    def _notify(self) -> None:
+        if not self._changed.done():
+            self._changed.set_result(None)
+            self._changed = self.head.get_loop().create_future()
+
+    def set_head(self, head: bytes, shareable: bool) -> None:
+        self.head.set_result((head, shareable))
+
+    def feed(self, data: bytes) -> None:
+        self._chunks.append(data)
+        self._buffered += len(data)
+        self._trim()
+        self._notify()
+
+    def finish(self) -> None:
+        self.done = True
+        self._notify()
+
+    def fail(self, error: BaseException) -> None:
+        self.error = error
+        if not self.head.done():
+            self.head.set_exception(error)
+            # Retrieved or not, it has been dealt with
+            self.head.exception()
+        self._notify()
+
+    def has_room(self) -> bool:
+        self._trim()
+        return self._buffered <= self.max_buffer
+
+    def _trim(self) -> None:
+        """Lets go of chunks every reader is done with, once over the limit."""
+        if self._buffered <= self.max_buffer:
+            return
+        keep = min((reader.index for reader in self._readers),
+            default=self._first + len(self._chunks))
+        while self._first < keep and self._chunks:
+            self._buffered -= len(self._chunks.popleft())
+            self._first += 1
+
+
+class FlightReader(StreamReader):
+    """Reads a flight's response body from the start, as it arrives."""
+
+    def __init__(self, flight: Flight):
+        self._flight = flight
+        # The chunk being read, and where in it
+        self.index = 0
+        self._offset = 0
+
+    def close(self) -> None:
+        self._flight.remove(self)
+
+    async def read(self, n: int = -1) -> bytes:
+        flight = self._flight
+        while True:
+            chunk = flight.chunk(self.index)
+            if chunk is not None:
+                end = len(chunk) if n < 0 else min(self._offset + n, len(chunk))
+                data = chunk[self._offset:end]
+                if end == len(chunk):
+                    self.index += 1
+                    self._offset = 0
+                    # The fetch may be waiting for readers to catch up
+                    flight._notify()
+                else:
+                    self._offset = end
+                return data
+            if flight.error is not None:
+                raise ConnectionResetError(
+                    f"collapsed upstream fetch failed: {flight.error!r}")
+            if flight.done:
+                flight.remove(self)
+                return b""
+            await flight.wait()
+
+    def at_eof(self) -> bool:
+        return self._flight.done and self._flight.chunk(self.index) is None
+
+
+class Collapser:
+    """
+    Keeps track of the flights in progress. Requests are collapsed when their
+    method, target and key_headers fields match. Requests with a body, a
+    method other than GET or HEAD, any of the exclude_headers fields (such as
+    credentials), conditions, ranges or Cache-Control: no-store always go
+    upstream on their own.
+    """
+
+    def __init__(
+        self,
+        key_headers: Iterable[str] = (),
+        exclude_headers: Iterable[str] = (),
+        max_buffer: int = 1024 * 1024):
+
+        self.key_headers = tuple(key_headers)
+        self.exclude_headers = tuple(exclude_headers)
+        self.max_buffer = max_buffer
+        self._flights: Dict[str, Flight] = { }
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def get_key(self, request: HttpRequest, hostname: str, port: int) -> Optional[str]:
+        """What request is collapsed under, or None if it isn't to be."""
+        if request.method not in COLLAPSED_METHODS:
+            return None
+        headers = request.headers
+        if any(name in headers for name in self.exclude_headers + CONDITIONAL_FIELDS):
+            return None
+        if "no-store" in ",".join(headers.get_all("Cache-Control")).lower():
+            return None
+        if request.get_body_framing()[0] != BodyFraming.NoBody:
+            return None
+        url = request.url
+        target = f"{url.path or '/'}?{url.query}" if url.query else url.path or "/"
+        fields = "\n".join(f"{name}:{','.join(headers.get_all(name))}"
+            for name in self.key_headers)
+        return (f"{request.method} {url.scheme or 'http'}://{hostname}:{port}{target}"
+            f"\n{fields}")
+
+    def is_shareable(self, response: HttpResponse) -> bool:
+        """Whether a response can go to requests other than the one it's for."""
+        headers = response.headers
+        cache_control = ",".join(headers.get_all("Cache-Control")).lower()
+        if "private" in cache_control or "no-store" in cache_control:
+            return False
+        if "Set-Cookie" in headers:
+            return False
+        keyed = { name.lower() for name in self.key_headers }
+        vary = { v.strip().lower() for value in headers.get_all("Vary")
+            for v in value.split(",") if v.strip() }
+        return vary <= keyed
+
+    def join(self, key: str) -> Tuple[Flight, FlightReader, bool]:
+        """
+        Attaches to the flight for key, or starts one. Returns the flight, a
+        reader for its body and whether it's a new flight (which the caller
+        is to start).
+        """
+        flight = self._flights.get(key)
+        if flight is not None and flight.joinable:
+            return flight, flight.reader(), False
+        flight = self._flights[key] = Flight(self.max_buffer)
+        return flight, flight.reader(), True
+
+    def start(self, key: str, flight: Flight, fetch: Coroutine[None, None, None]) -> None:
+        """Runs fetch, which is to feed flight, in the background."""
+        task = asyncio.create_task(fetch, name="collapsed fetch")
+        self._tasks.add(task)
+
+        def done(task: "asyncio.Task[None]") -> None:
+            self._tasks.discard(task)
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+        task.add_done_callback(done)
+
+    async def close(self) -> None:
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._flights.clear()
@@ -0,0 +1,212 @@
+"""
+On-the-fly response compression
+
+Uncompressed responses of compressible types are compressed for clients that
+accept it, as they're relayed: gzip is always available, br and zstd when the
+brotli and zstandard modules are installed. The compressed body is streamed
+through a body transform, so it's sent chunked. Compressing large chunks runs
+in a thread pool (zlib, brotli and zstandard release the GIL while they
+work), keeping the event loop free for other connections.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from typing import AsyncIterator, Callable, Dict, Iterable, Optional, Protocol, Tuple
+import zlib
+
+from .framing import BodyFraming
+from .httprequest import HttpRequest, HttpResponse
+
+try:
+    import brotli  # type: ignore[import-not-found]
+except ImportError:
+    brotli = None  # type: ignore[assignment]
+
+try:
+    import zstandard  # type: ignore[import-not-found]
+except ImportError:
+    zstandard = None  # type: ignore[assignment]
+
+_LOGGER = logging.getLogger(__name__)
+
+ACCEPT_ENCODING = "Accept-Encoding"
+CONTENT_ENCODING = "Content-Encoding"
+
+# Media types compressed by default. "type/*" matches any subtype.
+COMPRESSIBLE_TYPES: Tuple[str, ...] = (
+    "text/*",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "application/xhtml+xml",
+    "application/rss+xml",
+    "application/atom+xml",
+    "application/ld+json",
+    "application/problem+json",
+    "application/manifest+json",
+    "application/wasm",
+    "image/svg+xml",
+)
+
+# Chunks smaller than this are compressed on the event loop: handing them to
+# a thread costs more than it saves
+OFFLOAD_SIZE = 16 * 1024
+
+
+class Compressor(Protocol):
+    def compress(self, data: bytes) -> bytes: ...
+    def flush(self) -> bytes: ...
+
+
+class _BrotliCompressor:
+    def __init__(self) -> None:
+        self._compressor = brotli.Compressor(quality=4)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)  # type: ignore[no-any-return]
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()  # type: ignore[no-any-return]
+
+
+def _codecs() -> Dict[str, Callable[[], Compressor]]:
+    """Available encodings, in order of preference."""
+    codecs: Dict[str, Callable[[], Compressor]] = { }
+    if brotli is not None:
+        codecs["br"] = _BrotliCompressor
+    if zstandard is not None:
+        codecs["zstd"] = lambda: zstandard.ZstdCompressor(level=3).compressobj()
+    # wbits=31 makes zlib write the gzip header and trailer
+    codecs["gzip"] = lambda: zlib.compressobj(6, zlib.DEFLATED, 31)
+    return codecs
+
+CODECS = _codecs()
+
+
+def choose_encoding(accept_encoding: Optional[str], available: Iterable[str]) -> Optional[str]:
+    """
+    The encoding in available the client prefers according to its
+    Accept-Encoding header, or None if it accepts none of them. Ties go to
+    the first one in available.
+    """
+    if not accept_encoding:
+        return None
+    qualities: Dict[str, float] = { }
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            qualities["gzip" if name == "x-gzip" else name] = quality
+
+    default = qualities.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for encoding in available:
+        quality = qualities.get(encoding, default)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _media_type(content_type: str) -> str:
+    return content_type.split(";", 1)[0].strip().lower()
+
+
+class ResponseCompressor:
+    """
+    Decides which responses to compress and compresses them, in a pool of
+    `threads` threads.
+    """
+
+    def __init__(
+        self,
+        min_size: int = 1024,
+        types: Iterable[str] = COMPRESSIBLE_TYPES,
+        threads: int = 2,
+        encodings: Optional[Iterable[str]] = None):
+
+        self.min_size = min_size
+        self.encodings = tuple(e for e in (encodings or CODECS) if e in CODECS)
+        types = [t.lower() for t in types]
+        self._types = frozenset(t for t in types if not t.endswith("/*"))
+        self._type_prefixes = tuple(t[:-1] for t in types if t.endswith("/*"))
+        self._executor = ThreadPoolExecutor(max(threads, 1),
+            thread_name_prefix="compression")
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    def is_compressible(self, response: HttpResponse) -> bool:
+        """Whether response is one to compress for clients that accept it."""
+        code = response.response_code
+        if not 200 <= code < 300 or code in (204, 206):
+            return False
+        headers = response.headers
+        if ((headers.get(CONTENT_ENCODING) or "identity").strip().lower() != "identity"
+            or "Content-Range" in headers
+            or "no-transform" in (headers.get("Cache-Control") or "").lower()):
+            return False
+
+        media_type = _media_type(headers.get("Content-Type") or "")
+        if (media_type not in self._types
+            and not media_type.startswith(self._type_prefixes)):
+            return False
+
+        framing, length = response.get_body_framing()
+        return (framing != BodyFraming.NoBody
+            and (length < 0 or length >= self.min_size))
+
+    def apply(self, request: HttpRequest, response: HttpResponse) -> Optional[str]:
+        """
+        Sets response up to be compressed if it's compressible and the client
+        accepts one of our encodings. Returns the encoding used, if any.
+        """
+        if not self.encodings or not self.is_compressible(response):
+            return None
+
+        headers = response.headers
+        # The response depends on Accept-Encoding from here on, whether or
+        # not it's compressed for this client
+        vary = headers.get("Vary")
+        if not vary:
+            headers["Vary"] = ACCEPT_ENCODING
+        elif "*" not in vary and ACCEPT_ENCODING.lower() not in vary.lower():
+            headers["Vary"] = f"{vary}, {ACCEPT_ENCODING}"
+
+        encoding = choose_encoding(request.headers.get(ACCEPT_ENCODING), self.encodings)
+        if encoding is None:
+            return None
+
+        _LOGGER.debug("compressing response with %s", encoding)
+        headers[CONTENT_ENCODING] = encoding
+        etag = headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            # The compressed body is a different representation
+            headers["ETag"] = f"W/{etag}"
+        response.set_body_transform(
+            lambda chunks: self.compress(chunks, encoding))
+        return encoding
+
+    async def compress(self, chunks: AsyncIterator[bytes], encoding: str
+        ) -> AsyncIterator[bytes]:
+
+        loop = asyncio.get_running_loop()
+        compressor = CODECS[encoding]()
+        async for chunk in chunks:
+            if len(chunk) >= OFFLOAD_SIZE:
+                data = await loop.run_in_executor(
+                    self._executor, compressor.compress, chunk)
+            else:
+                data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
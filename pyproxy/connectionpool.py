@@ -0,0 +1,238 @@
+import asyncio
+from asyncio.streams import StreamReader, StreamWriter
+from collections import deque
+import logging
+import time
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from .stream import StreamPair
+from .tls import TlsContexts, TlsProfile
+
+_LOGGER = logging.getLogger(__name__)
+
+# Host, port and the TLS profile of connections made over TLS
+PoolKey = Tuple[str, int, Optional[TlsProfile]]
+Connector = Callable[[str, int, Optional[TlsProfile]], Awaitable[StreamPair]]
+
+
+class PooledConnection:
+    """An upstream connection owned by a ConnectionPool."""
+
+    def __init__(self, key: PoolKey, reader: StreamReader, writer: StreamWriter):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.idle_since = 0.0
+        self.reused = False
+
+    @property
+    def tls(self) -> Optional[TlsProfile]:
+        return self.key[2]
+
+    def is_healthy(self) -> bool:
+        # An idle keep-alive connection the server has since closed (or reset)
+        # shows up as EOF or an exception on the reader.
+        return not (self.writer.is_closing() or self.reader.at_eof()
+            or self.reader.exception() is not None)
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class ConnectionPool:
+    """
+    Keeps idle keep-alive upstream connections, per (host, port, TLS profile),
+    so they can be reused by any client session.
+
+    max_idle caps the number of idle connections across all hosts, idle_ttl is
+    how long (in seconds) an idle connection is kept around and max_per_host
+    caps the number of connections (idle or in use) to a single host. A
+    max_per_host of 0 means no limit. New connections are opened with
+    connector, given the host, port and TLS profile (None for plain TCP). By
+    default it's asyncio.open_connection, with an SSLContext per profile.
+    """
+
+    def __init__(
+        self,
+        max_idle: int = 64,
+        idle_ttl: float = 30.0,
+        max_per_host: int = 0,
+        connector: Optional[Connector] = None):
+
+        self._connector: Connector = connector or TlsContexts().open_connection
+        self.max_idle = max_idle
+        self.idle_ttl = idle_ttl
+        self.max_per_host = max_per_host
+        self._idle: Dict[PoolKey, Deque[PooledConnection]] = { }
+        self._idle_count = 0
+        # Connections handed out (or being established) per host
+        self._active: Dict[PoolKey, int] = { }
+        self._waiters: Dict[PoolKey, Deque["asyncio.Future[None]"]] = { }
+        self._closed = False
+
+    @property
+    def idle_count(self) -> int:
+        return self._idle_count
+
+    def _host_count(self, key: PoolKey) -> int:
+        idle = self._idle.get(key)
+        return self._active.get(key, 0) + (len(idle) if idle else 0)
+
+    def _pop_idle(self, key: PoolKey) -> Optional[PooledConnection]:
+        idle = self._idle.get(key)
+        now = time.monotonic()
+        while idle:
+            # Most recently used first: it's the least likely to be stale
+            connection = idle.pop()
+            self._idle_count -= 1
+            if (now - connection.idle_since < self.idle_ttl
+                and connection.is_healthy()):
+                return connection
+
+            _LOGGER.debug("discarding stale connection to %s:%d", key[0], key[1])
+            connection.close()
+        return None
+
+    def _prune(self) -> None:
+        """Drop expired and unhealthy idle connections across all hosts."""
+        now = time.monotonic()
+        for key, idle in list(self._idle.items()):
+            for connection in list(idle):
+                if (now - connection.idle_since >= self.idle_ttl
+                    or not connection.is_healthy()):
+                    idle.remove(connection)
+                    self._idle_count -= 1
+                    connection.close()
+            if not idle:
+                del self._idle[key]
+                self._wake_waiter(key)
+
+    def _evict_oldest(self) -> None:
+        oldest_key = min(self._idle, key=lambda k: self._idle[k][0].idle_since)
+        idle = self._idle[oldest_key]
+        connection = idle.popleft()
+        self._idle_count -= 1
+        if not idle:
+            del self._idle[oldest_key]
+        _LOGGER.debug("evicting idle connection to %s:%d", oldest_key[0], oldest_key[1])
+        connection.close()
+        self._wake_waiter(oldest_key)
+
+    def _wake_waiter(self, key: PoolKey) -> None:
+        waiters = self._waiters.get(key)
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+        if waiters is not None and not waiters:
+            del self._waiters[key]
+
+    async def acquire(
+        self,
+        host: str,
+        port: int,
+        fresh: bool = False,
+        tls: Optional[TlsProfile] = None) -> PooledConnection:
+        """
+        Returns a connection to host:port, over TLS with the tls profile if
+        one is given, reusing an idle one when possible. With fresh=True a new
+        connection is always established.
+        """
+        if self._closed:
+            raise RuntimeError("connection pool is closed")
+
+        key = (host, port, tls)
+        while True:
+            if not fresh:
+                connection = self._pop_idle(key)
+                if connection:
+                    _LOGGER.debug("reusing pooled connection to %s:%d", host, port)
+                    connection.reused = True
+                    self._active[key] = self._active.get(key, 0) + 1
+                    return connection
+
+            if self.max_per_host <= 0 or self._host_count(key) < self.max_per_host:
+                break
+
+            if fresh and self._idle.get(key):
+                # Make room for the new connection
+                self._idle[key].popleft().close()
+                self._idle_count -= 1
+                continue
+
+            _LOGGER.debug("waiting for a connection slot to %s:%d", host, port)
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(key, deque()).append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Pass our turn on if we were woken up but never got to use it
+                if waiter.done() and not waiter.cancelled():
+                    self._wake_waiter(key)
+                raise
+
+        self._active[key] = self._active.get(key, 0) + 1
+        try:
+            _LOGGER.debug("connecting to %s:%d...", host, port)
+            reader, writer = await self._connector(host, port, tls)
+        except BaseException:
+            self._release_slot(key)
+            raise
+
+        _LOGGER.debug("HTTP connection established to %s:%d", host, port)
+        return PooledConnection(key, reader, writer)
+
+    def _release_slot(self, key: PoolKey) -> None:
+        count = self._active.get(key, 0) - 1
+        if count > 0:
+            self._active[key] = count
+        else:
+            self._active.pop(key, None)
+        self._wake_waiter(key)
+
+    def release(self, connection: PooledConnection, reusable: bool) -> None:
+        """
+        Returns a connection to the pool. Connections that are not reusable
+        (or that can't be kept idle) are closed.
+        """
+        key = connection.key
+        count = self._active.get(key, 0) - 1
+        if count > 0:
+            self._active[key] = count
+        else:
+            self._active.pop(key, None)
+
+        if (not reusable or self._closed or self.max_idle <= 0
+            or not connection.is_healthy()):
+            connection.close()
+            self._wake_waiter(key)
+            return
+
+        connection.idle_since = time.monotonic()
+        self._idle.setdefault(key, deque()).append(connection)
+        self._idle_count += 1
+        _LOGGER.debug("connection to %s:%d returned to pool", key[0], key[1])
+
+        self._prune()
+        if self._idle_count > self.max_idle:
+            self._evict_oldest()
+        self._wake_waiter(key)
+
+    async def close(self) -> None:
+        self._closed = True
+        connections = [c for idle in self._idle.values() for c in idle]
+        self._idle.clear()
+        self._idle_count = 0
+        for connection in connections:
+            connection.close()
+        for connection in connections:
+            try:
+                await connection.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        for waiters in self._waiters.values():
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.cancel()
+        self._waiters.clear()
@@ -2,3 +2,7 @@ from typing import Final
 
 CRLF: Final = b"\r\n"
 CONTENT_LENGTH: Final = "Content-Length"
+CONNECTION: Final = "Connection"
+TRANSFER_ENCODING: Final = "Transfer-Encoding"
+
+BUFFER_SIZE: Final = 16 * 1024
@@ -0,0 +1,282 @@
+"""
+Incremental form body parsing
+
+FormParser takes an application/x-www-form-urlencoded or multipart/form-data
+body in chunks of any size, as they arrive, and returns the fields completed
+by each chunk. Field values are collected in memory up to a size limit. File
+uploads can instead be handed to a sink as they stream past, so a callback can
+look at (or hash, or scan) a large upload without holding all of it.
+"""
+
+from dataclasses import dataclass, field
+import logging
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import unquote_to_bytes
+
+_LOGGER = logging.getLogger(__name__)
+
+URLENCODED = "application/x-www-form-urlencoded"
+MULTIPART = "multipart/form-data"
+
+MAX_FIELD_SIZE = 1024 * 1024
+# For the headers of a multipart part
+MAX_HEADER_SIZE = 16 * 1024
+
+
+class FormError(ValueError):
+    """The body isn't a well-formed form, or a field is too large."""
+
+
+@dataclass
+class FormPart:
+    """A form field, or a file uploaded with the form."""
+    name: str
+    # Empty for files streamed to a sink
+    value: bytes = b""
+    filename: Optional[str] = None
+    content_type: Optional[str] = None
+    # Of multipart parts, with lowercase names
+    headers: Dict[str, str] = field(default_factory=dict)
+    # Bytes of data, including any streamed to a sink
+    size: int = 0
+
+    @property
+    def is_file(self) -> bool:
+        return self.filename is not None
+
+    def text(self, encoding: str = "utf-8") -> str:
+        return self.value.decode(encoding, "replace")
+
+
+# Called with each file part once its headers are parsed. Returns a function
+# to write the file's data to, or None to keep the data in the part's value.
+FileSink = Callable[[FormPart], Optional[Callable[[bytes], None]]]
+
+
+def parse_header_value(value: str) -> Tuple[str, Dict[str, str]]:
+    """
+    Splits a header field value like Content-Type or Content-Disposition into
+    its lowercased first item and its parameters (names lowercased).
+    """
+    head, _, rest = value.partition(";")
+    params: Dict[str, str] = { }
+    position = 0
+    while position < len(rest):
+        equals = rest.find("=", position)
+        if equals < 0:
+            break
+        name = rest[position:equals].strip(" \t;").lower()
+        position = equals + 1
+        while position < len(rest) and rest[position] in " \t":
+            position += 1
+        if rest[position:position + 1] == '"':
+            # Quoted string, with backslash escapes
+            chars = []
+            position += 1
+            while position < len(rest) and rest[position] != '"':
+                if rest[position] == "\\" and position + 1 < len(rest):
+                    position += 1
+                chars.append(rest[position])
+                position += 1
+            params[name] = "".join(chars)
+            end = rest.find(";", position)
+        else:
+            end = rest.find(";", position)
+            params[name] = rest[position:end if end >= 0 else len(rest)].strip()
+        position = end + 1 if end >= 0 else len(rest)
+    return head.strip().lower(), params
+
+
+class UrlEncodedParser:
+    """Parses an application/x-www-form-urlencoded body."""
+
+    def __init__(self, max_field_size: int = MAX_FIELD_SIZE):
+        self.max_field_size = max_field_size
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[FormPart]:
+        self._buffer += data
+        end = self._buffer.rfind(b"&")
+        if end < 0:
+            if self.max_field_size and len(self._buffer) > self.max_field_size:
+                raise FormError("form field too large")
+            return []
+        fields = bytes(self._buffer[:end])
+        del self._buffer[:end + 1]
+        return [self._part(f) for f in fields.split(b"&") if f]
+
+    def close(self) -> List[FormPart]:
+        fields = bytes(self._buffer)
+        self._buffer.clear()
+        return [self._part(fields)] if fields else []
+
+    def _part(self, data: bytes) -> FormPart:
+        if self.max_field_size and len(data) > self.max_field_size:
+            raise FormError("form field too large")
+        # A field without "=" has an empty value; any later "=" belongs to it
+        name, _, value = data.partition(b"=")
+        value = unquote_to_bytes(value.replace(b"+", b" "))
+        return FormPart(
+            unquote_to_bytes(name.replace(b"+", b" ")).decode("utf-8", "replace"),
+            value, size=len(value))
+
+
+class MultipartParser:
+    """Parses a multipart/form-data body with the given boundary."""
+
+    _PREAMBLE, _HEADERS, _DATA, _BOUNDARY_END, _DONE = range(5)
+
+    def __init__(
+        self,
+        boundary: bytes,
+        file_sink: Optional[FileSink] = None,
+        max_field_size: int = MAX_FIELD_SIZE):
+
+        if not boundary or len(boundary) > 70:
+            raise FormError("invalid multipart boundary")
+        self.max_field_size = max_field_size
+        self._file_sink = file_sink
+        # Within the body, each delimiter starts on a new line
+        self._delimiter = b"\r\n--" + boundary
+        self._buffer = bytearray(b"\r\n")
+        self._state = self._PREAMBLE
+        self._part: Optional[FormPart] = None
+        self._write: Optional[Callable[[bytes], None]] = None
+        self._value = bytearray()
+
+    def feed(self, data: bytes) -> List[FormPart]:
+        self._buffer += data
+        parts: List[FormPart] = []
+        while self._step(parts):
+            pass
+        return parts
+
+    def close(self) -> List[FormPart]:
+        if self._state != self._DONE:
+            raise FormError("multipart body ended early")
+        return []
+
+    def _step(self, parts: List[FormPart]) -> bool:
+        """Parses what it can from the buffer. Returns whether to go on."""
+        buffer = self._buffer
+        if self._state == self._PREAMBLE:
+            start = buffer.find(self._delimiter)
+            if start < 0:
+                # Keep what could be the start of the delimiter
+                del buffer[:max(len(buffer) - len(self._delimiter), 0)]
+                return False
+            del buffer[:start + len(self._delimiter)]
+            self._state = self._BOUNDARY_END
+            return True
+
+        if self._state == self._BOUNDARY_END:
+            if len(buffer) < 2:
+                return False
+            if buffer[:2] == b"--":
+                self._state = self._DONE
+                buffer.clear()
+                return False
+            # Transport padding may follow the boundary
+            end = buffer.find(b"\r\n")
+            if end < 0:
+                if len(buffer) > MAX_HEADER_SIZE:
+                    raise FormError("malformed multipart boundary")
+                return False
+            del buffer[:end + 2]
+            self._state = self._HEADERS
+            return True
+
+        if self._state == self._HEADERS:
+            # A part may have no headers at all
+            end = -2 if buffer[:2] == b"\r\n" else buffer.find(b"\r\n\r\n")
+            if end == -1:
+                if len(buffer) > MAX_HEADER_SIZE:
+                    raise FormError("multipart part headers too large")
+                return False
+            self._start_part(bytes(buffer[:max(end, 0)]))
+            del buffer[:end + 4]
+            self._state = self._DATA
+            return True
+
+        if self._state == self._DATA:
+            end = buffer.find(self._delimiter)
+            if end < 0:
+                # All but what could be the start of the delimiter is data
+                safe = len(buffer) - len(self._delimiter) + 1
+                if safe > 0:
+                    self._data(buffer[:safe])
+                    del buffer[:safe]
+                return False
+            self._data(buffer[:end])
+            del buffer[:end + len(self._delimiter)]
+            assert self._part is not None
+            self._part.value = bytes(self._value)
+            parts.append(self._part)
+            self._part = self._write = None
+            self._value.clear()
+            self._state = self._BOUNDARY_END
+            return True
+
+        # The epilogue is ignored
+        buffer.clear()
+        return False
+
+    def _start_part(self, head: bytes) -> None:
+        headers: Dict[str, str] = { }
+        for line in head.decode("utf-8", "replace").split("\r\n") if head else []:
+            name, colon, value = line.partition(":")
+            if not colon:
+                raise FormError(f"malformed multipart header {line!r}")
+            headers[name.strip().lower()] = value.strip()
+
+        disposition, params = parse_header_value(headers.get("content-disposition", ""))
+        if disposition != "form-data" or "name" not in params:
+            raise FormError("multipart part without a form-data name")
+        part = FormPart(params["name"], filename=params.get("filename"),
+            content_type=headers.get("content-type"), headers=headers)
+        self._part = part
+        self._write = (self._file_sink(part)
+            if part.is_file and self._file_sink else None)
+
+    def _data(self, data: bytearray) -> None:
+        part = self._part
+        assert part is not None
+        part.size += len(data)
+        if self._write is not None:
+            self._write(bytes(data))
+            return
+        if self.max_field_size and part.size > self.max_field_size:
+            raise FormError(f"form field {part.name!r} too large")
+        self._value += data
+
+
+class FormParser:
+    """
+    Parses a form body of the type given by content_type (the request's
+    Content-Type header field). Fields over max_field_size bytes (0 for no
+    limit) raise FormError, except for files streamed to file_sink.
+    """
+
+    def __init__(
+        self,
+        content_type: str,
+        file_sink: Optional[FileSink] = None,
+        max_field_size: int = MAX_FIELD_SIZE):
+
+        media_type, params = parse_header_value(content_type)
+        self._parser: Union[UrlEncodedParser, MultipartParser]
+        if media_type == URLENCODED:
+            self._parser = UrlEncodedParser(max_field_size)
+        elif media_type == MULTIPART:
+            self._parser = MultipartParser(params.get("boundary", "").encode("latin-1"),
+                file_sink, max_field_size)
+        else:
+            raise FormError(f"not a form: {content_type!r}")
+
+    def feed(self, data: bytes) -> List[FormPart]:
+        """Parses the next chunk of the body. Returns the fields it completed."""
+        return self._parser.feed(data)
+
+    def close(self) -> List[FormPart]:
+        """Ends the body. Returns the last field, if there was one left."""
+        return self._parser.close()
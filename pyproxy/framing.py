@@ -0,0 +1,107 @@
+"""
+HTTP/1.1 message body framing (RFC 9112, section 6)
+"""
+
+from asyncio.streams import StreamReader
+from enum import IntEnum, auto
+import logging
+from typing import AsyncIterator, Callable, Final, Optional
+
+from .const import *
+
+LAST_CHUNK: Final = b"0" + CRLF + CRLF
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class BodyFraming(IntEnum):
+    NoBody = auto()
+    ContentLength = auto()
+    Chunked = auto()
+    UntilClose = auto()
+
+
+def encode_chunk(data: bytes) -> bytes:
+    """Frames data as a single chunk of a chunked body"""
+    return b"%x\r\n%b\r\n" % (len(data), data)
+
+
+def parse_chunk_size(line: bytes) -> int:
+    # Chunk extensions (after ';') are relayed but otherwise ignored
+    size = line.split(b";", 1)[0].strip()
+    try:
+        return int(size, 16)
+    except ValueError:
+        raise ValueError(f"invalid chunk size line: {line!r}") from None
+
+
+async def iter_chunked(
+    reader: StreamReader, on_data: Optional[Callable[[bytes], None]] = None
+    ) -> AsyncIterator[bytes]:
+    """
+    Yields a chunked body exactly as it appears on the wire, chunk by chunk,
+    including the last chunk and any trailer fields. on_data, if given, is
+    called with the payload data (without framing) as it goes by.
+    """
+    while True:
+        line = await reader.readuntil(CRLF)
+        size = parse_chunk_size(line)
+        yield line
+        if size == 0:
+            break
+
+        while size > 0:
+            data = await reader.readexactly(min(BUFFER_SIZE, size))
+            size -= len(data)
+            if on_data:
+                on_data(data)
+            yield data
+        yield await reader.readexactly(len(CRLF))
+
+    # Trailer section, terminated by an empty line
+    while True:
+        line = await reader.readuntil(CRLF)
+        yield line
+        if line == CRLF:
+            break
+
+
+async def iter_chunked_data(reader: StreamReader) -> AsyncIterator[bytes]:
+    """Yields the payload of a chunked body, without any framing"""
+    while True:
+        size = parse_chunk_size(await reader.readuntil(CRLF))
+        if size == 0:
+            break
+
+        while size > 0:
+            data = await reader.readexactly(min(BUFFER_SIZE, size))
+            size -= len(data)
+            yield data
+        await reader.readexactly(len(CRLF))
+
+    # Trailers can't be represented once the body is no longer chunked
+    while await reader.readuntil(CRLF) != CRLF:
+        pass
+
+
+async def iter_body_data(
+    reader: StreamReader, framing: BodyFraming, length: int = -1
+    ) -> AsyncIterator[bytes]:
+    """Yields the payload of a message body, without any framing"""
+    if framing == BodyFraming.Chunked:
+        async for data in iter_chunked_data(reader):
+            yield data
+    elif framing == BodyFraming.ContentLength:
+        while length > 0:
+            data = await reader.read(min(BUFFER_SIZE, length))
+            if not data:
+                raise ConnectionResetError(
+                    f"connection closed with {length} bytes of body left")
+            length -= len(data)
+            yield data
+    elif framing == BodyFraming.UntilClose:
+        while True:
+            data = await reader.read(BUFFER_SIZE)
+            if not data:
+                break
+            yield data
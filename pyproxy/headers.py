@@ -0,0 +1,188 @@
+from typing import Iterator, List, MutableMapping, Optional, Tuple, Union
+
+from .const import CRLF
+
+# [lowercased name, line start, colon, line end (past the CRLF)]
+_Field = List
+
+_EMPTY_HEAD = CRLF + CRLF
+
+
+def _encode(text: str) -> bytes:
+    try:
+        return text.encode("latin-1")
+    except UnicodeEncodeError:
+        return text.encode()
+
+
+class HttpHeaders(MutableMapping[str, str]):
+    """
+    Case-insensitive header fields backed by the raw message head.
+
+    Fields are only located (and decoded) when first looked up, and changes are
+    spliced into the head bytes in place, so an untouched head is forwarded
+    exactly as it was received. Repeated fields are kept: lookups return the
+    first value, get_all() returns them all and add() appends another one.
+    """
+
+    __slots__ = ("_raw", "_offset", "_fields", "_modified")
+
+    def __init__(self, head: bytes = _EMPTY_HEAD, offset: int = len(CRLF)):
+        """
+        head is a full message head (start line, fields and the empty line
+        that ends them) and offset is where the first field starts.
+        """
+        self._raw: Union[bytes, bytearray] = head
+        self._offset = offset
+        self._fields: Optional[List[_Field]] = None
+        self._modified = False
+
+    @classmethod
+    def from_head(cls, head: bytes) -> "HttpHeaders":
+        offset = head.find(CRLF)
+        return cls(head, offset + len(CRLF) if offset >= 0 else len(head))
+
+    @property
+    def modified(self) -> bool:
+        return self._modified
+
+    @property
+    def start_line(self) -> bytes:
+        return bytes(self._raw[:self._offset - len(CRLF)])
+
+    @start_line.setter
+    def start_line(self, line: bytes) -> None:
+        self._splice(0, self._offset - len(CRLF), line)
+        self._modified = True
+
+    @property
+    def head(self) -> bytes:
+        """The start line and all fields, as they would go on the wire."""
+        if isinstance(self._raw, bytearray):
+            self._raw = bytes(self._raw)
+        return self._raw
+
+    def _parse(self) -> List[_Field]:
+        if self._fields is None:
+            fields = []
+            raw = self._raw
+            end = len(raw) - len(CRLF)
+            start = self._offset
+            while start < end:
+                line_end = raw.find(CRLF, start, end + len(CRLF))
+                if line_end < 0:
+                    line_end = end
+                colon = raw.find(b":", start, line_end)
+                if colon > start:
+                    name = raw[start:colon].strip().decode("latin-1").lower()
+                    fields.append([name, start, colon, line_end + len(CRLF)])
+                start = line_end + len(CRLF)
+            self._fields = fields
+        return self._fields
+
+    def _value(self, field: _Field) -> str:
+        return (self._raw[field[2] + 1:field[3] - len(CRLF)]
+            .strip().decode("latin-1"))
+
+    def _splice(self, start: int, end: int, data: bytes) -> None:
+        """Replaces raw[start:end] with data, shifting the fields that follow."""
+        fields = self._parse()
+        if not isinstance(self._raw, bytearray):
+            self._raw = bytearray(self._raw)
+        self._raw[start:end] = data
+        delta = len(data) - (end - start)
+        if delta:
+            if start < self._offset:
+                self._offset += delta
+            for field in fields:
+                if field[1] >= end:
+                    field[1] += delta
+                    field[2] += delta
+                    field[3] += delta
+
+    def _remove(self, field: _Field) -> None:
+        fields = self._parse()
+        fields.remove(field)
+        self._splice(field[1], field[3], b"")
+
+    def get_all(self, name: str) -> List[str]:
+        name = name.lower()
+        return [self._value(f) for f in self._parse() if f[0] == name]
+
+    def fields(self) -> List[Tuple[str, str]]:
+        """All fields in order, with names as they appear in the head."""
+        return [(bytes(self._raw[f[1]:f[2]]).strip().decode("latin-1"),
+            self._value(f)) for f in self._parse()]
+
+    def add(self, name: str, value: str) -> None:
+        end = len(self._raw) - len(CRLF)
+        line = _encode(f"{name}: {value}") + CRLF
+        self._splice(end, end, line)
+        self._parse().append(
+            [name.lower(), end, end + len(_encode(name)), end + len(line)])
+        self._modified = True
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:  # type: ignore[override]
+        name = name.lower()
+        for field in self._parse():
+            if field[0] == name:
+                return self._value(field)
+        return default
+
+    def __getitem__(self, name: str) -> str:
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name: str, value: str) -> None:
+        lname = name.lower()
+        matches = [f for f in self._parse() if f[0] == lname]
+        if not matches:
+            self.add(name, value)
+            return
+
+        # Replace the first occurrence in place and drop any others
+        for field in matches[1:]:
+            self._remove(field)
+        field = matches[0]
+        line = _encode(f"{name}: {value}") + CRLF
+        self._splice(field[1], field[3], line)
+        field[2] = field[1] + len(_encode(name))
+        field[3] = field[1] + len(line)
+        self._modified = True
+
+    def __delitem__(self, name: str) -> None:
+        lname = name.lower()
+        matches = [f for f in self._parse() if f[0] == lname]
+        if not matches:
+            raise KeyError(name)
+        for field in matches:
+            self._remove(field)
+        self._modified = True
+
+    def __contains__(self, name: object) -> bool:
+        if not isinstance(name, str):
+            return False
+        name = name.lower()
+        return any(f[0] == name for f in self._parse())
+
+    def __iter__(self) -> Iterator[str]:
+        seen = set()
+        for field in self._parse():
+            if field[0] not in seen:
+                seen.add(field[0])
+                yield bytes(self._raw[field[1]:field[2]]).strip().decode("latin-1")
+
+    def __len__(self) -> int:
+        return len({f[0] for f in self._parse()})
+
+    def clear(self) -> None:
+        end = len(self._raw) - len(CRLF)
+        if end > self._offset:
+            self._raw = bytes(self._raw[:self._offset]) + CRLF
+            self._modified = True
+        self._fields = []
+
+    def __repr__(self) -> str:
+        return f"HttpHeaders({self.fields()!r})"
@@ -1,30 +1,50 @@
 import asyncio
 from asyncio.streams import StreamReader
 import logging
-from typing import Dict, List, Optional, Tuple
-from urllib.parse import ParseResult, unquote, urlparse
+import time
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple
+from urllib.parse import ParseResult, urlparse
 
+from .bodystore import BodyStore, StoredBody
 from .const import *
+from .forms import MAX_FIELD_SIZE, FileSink, FormParser, FormPart, UrlEncodedParser
+from .framing import BodyFraming, iter_body_data
+from .headers import HttpHeaders
 from .stream import MemoryStreamReader
 
 _LOGGER = logging.getLogger(__name__)
 
+# Takes the body payload in chunks and yields the payload to send instead
+BodyTransform = Callable[[AsyncIterator[bytes]], AsyncIterator[bytes]]
+
 
 def parse_form_data(form_data: bytes) -> Dict[bytes, str]:
     """Convert URL encoded HTML form data into a dictionary"""
-    values = { k:unquote(v) for (k,v) in
-        [entry.split(b"=") for entry in form_data.split(b"&")]
-    }
-    return values
+    parser = UrlEncodedParser(max_field_size=0)
+    return { part.name.encode(): part.text()
+        for part in parser.feed(form_data) + parser.close() }
+
+
+# Where bodies read with read_body are kept, unless given another store
+_DEFAULT_BODY_STORE = BodyStore()
 
 
 class HttpMessageBase:
-    def __init__(self, reader: Optional[StreamReader]):
+    def __init__(
+        self, reader: Optional[StreamReader], body_store: Optional[BodyStore] = None):
+
         self._reader = reader
-        self._start_line: str = ""
-        self._headers: Dict[str, str] = { }
+        self._headers = HttpHeaders()
         self._body = b""
-        self._dirty = False
+        self._body_read = False
+        self._body_store = body_store or _DEFAULT_BODY_STORE
+        self._stored: Optional[StoredBody] = None
+        # A body iter_body stopped reading partway through: where it's kept,
+        # the rest of its payload and its framing
+        self._partial: Optional[
+            Tuple[StoredBody, AsyncIterator[bytes], BodyFraming]] = None
+        self._transform: Optional[BodyTransform] = None
+        self._source_framing: Tuple[BodyFraming, int] = (BodyFraming.NoBody, 0)
 
     async def _read_headers(self) -> bytes:
         if self._reader:
@@ -36,39 +56,231 @@ class HttpMessageBase:
         else:
             return b''
 
-    def _parse_headers(self, lines: List[bytes]) -> None:
-        self._headers.clear()
-        for line in lines:
-            if not line:
-                break
-            name, value = line.decode().split(": ")
-            self._headers[name] = value
+    def _parse_head(self, data: bytes) -> str:
+        """Sets up the headers from the raw head and returns the start line."""
+        self._headers = HttpHeaders.from_head(data)
+        return self._headers.start_line.decode()
 
     @property
-    def headers(self) -> Dict[str, str]:
+    def headers(self) -> HttpHeaders:
         return self._headers
 
     def get_streamreader(self) -> StreamReader:
+        if self._stored is not None:
+            return MemoryStreamReader(self._stored.getbuffer())
         if self._body:
             return MemoryStreamReader(self._body)
         else:
             assert self._reader is not None
             return self._reader
 
+    def _is_persistent(self, version: str) -> bool:
+        connection = (self._headers.get(CONNECTION) or "").lower()
+        if version == "HTTP/1.0":
+            return "keep-alive" in connection
+        return "close" not in connection
+
     def get_content_length(self) -> int:
         return int(self._headers[CONTENT_LENGTH]
             if CONTENT_LENGTH in self._headers else -1)
 
+    def is_chunked(self) -> bool:
+        # Chunked must be the final transfer coding when present
+        codings = self._headers.get_all(TRANSFER_ENCODING)
+        return bool(codings) and (
+            codings[-1].rsplit(",", 1)[-1].strip().lower() == "chunked")
+
+    def get_body_framing(self) -> Tuple[BodyFraming, int]:
+        """Returns how the body is delimited and, if known, its length."""
+        if self._transform:
+            return BodyFraming.Chunked, -1
+        if self._body:
+            return BodyFraming.ContentLength, len(self._body)
+        if self._stored is not None and len(self._stored) > 0:
+            return BodyFraming.ContentLength, len(self._stored)
+        if self._stored is not None:
+            return BodyFraming.NoBody, 0
+        if self.is_chunked():
+            return BodyFraming.Chunked, -1
+        length = self.get_content_length()
+        if length > 0:
+            return BodyFraming.ContentLength, length
+        return BodyFraming.NoBody, 0
+
+    async def _store_body(self) -> StoredBody:
+        if self._stored is None:
+            if self._partial is None:
+                async for _ in self.iter_body():
+                    pass
+            else:
+                await self.finish_body()
+        assert self._stored is not None
+        return self._stored
+
+    async def iter_body(self) -> AsyncIterator[bytes]:
+        """
+        Yields the body payload as it's read, keeping it (see BodyStore) to be
+        sent on afterwards, as read_body would. A body already read is yielded
+        from where it's kept. When the iteration stops early, the server reads
+        the rest once the callback hook returns.
+        """
+        if self._transform:
+            raise RuntimeError("the body is streamed through a transform")
+        if self._partial is not None:
+            raise RuntimeError("the body is already being read")
+        buffer = self.get_body_buffer()
+        if buffer is not None:
+            for start in range(0, len(buffer), BUFFER_SIZE):
+                yield bytes(buffer[start:start + BUFFER_SIZE])
+            return
+
+        assert self._reader is not None
+        framing, length = self.get_body_framing()
+        stored = self._body_store.create(length)
+        payload = iter_body_data(self._reader, framing, length)
+        self._partial = (stored, payload, framing)
+        try:
+            async for data in payload:
+                stored.write(data)
+                yield data
+        except GeneratorExit:
+            # Stopped early: the rest is left to finish_body
+            raise
+        except BaseException:
+            self._partial = None
+            stored.close()
+            raise
+        self._finish_stored()
+
+    async def finish_body(self) -> None:
+        """Reads the rest of a body iter_body stopped partway through."""
+        if self._partial is None:
+            return
+        stored, payload, _ = self._partial
+        try:
+            async for data in payload:
+                stored.write(data)
+        except BaseException:
+            self._partial = None
+            stored.close()
+            raise
+        self._finish_stored()
+
+    def _finish_stored(self) -> None:
+        assert self._partial is not None
+        stored, _, framing = self._partial
+        self._partial = None
+        self._stored = stored
+        self._body_read = True
+        if framing in (BodyFraming.Chunked, BodyFraming.UntilClose):
+            # The body is now stored with a known length
+            self._headers.pop(TRANSFER_ENCODING, None)
+            self._headers[CONTENT_LENGTH] = str(len(stored))
+
+    async def discard_body(self) -> None:
+        """
+        Reads past a body that won't be sent on, without keeping it, so the
+        reader is left at the start of the next message.
+        """
+        if self._body or self._body_read or self._transform or self._reader is None:
+            return
+        if self._partial is not None:
+            await self.finish_body()
+            return
+        framing, length = self.get_body_framing()
+        if framing == BodyFraming.NoBody:
+            return
+        async for _ in iter_body_data(self._reader, framing, length):
+            pass
+        self._body_read = True
+
     async def read_body(self) -> bytes:
-        if not self._body:
-            assert self._reader is not None
-            self._body = await self._reader.readexactly(self.get_content_length())
-        return self._body
+        """
+        Reads the whole body. Large bodies are spooled to disk (see BodyStore),
+        so read_body_buffer is the better choice for those: this copies them
+        back into memory.
+        """
+        if self._body:
+            return self._body
+        return (await self._store_body()).getvalue()
+
+    async def read_body_buffer(self) -> memoryview:
+        """Reads the whole body, which is returned without being copied."""
+        if self._body:
+            return memoryview(self._body)
+        return (await self._store_body()).getbuffer()
+
+    def get_body_buffer(self) -> Optional[memoryview]:
+        """The body, if it was read in full or set, without copying it."""
+        if self._body:
+            return memoryview(self._body)
+        if self._stored is not None:
+            return self._stored.getbuffer()
+        return None
+
+    def release_body(self) -> None:
+        """Frees the memory or disk space taken by a body read in full."""
+        if self._partial is not None:
+            self._partial[0].close()
+            self._partial = None
+        if self._stored is not None:
+            self._stored.close()
+            self._stored = None
+
+    def is_body_from_reader(self) -> bool:
+        """
+        Whether the body sent on is the one on the reader, as opposed to one
+        set with set_body that left the original body unread.
+        """
+        return not self._body or self._body_read
 
     def set_body(self, body: bytes) -> None:
+        if self._stored is not None:
+            self._stored.close()
+            self._stored = None
         self._body = body
+        self._transform = None
+        self._headers.pop(TRANSFER_ENCODING, None)
         self._headers[CONTENT_LENGTH] = str(len(body))
-        self._dirty = True
+
+    @property
+    def body_transform(self) -> Optional[BodyTransform]:
+        return self._transform
+
+    def get_source_framing(self) -> Tuple[BodyFraming, int]:
+        """How the body to be transformed is delimited where it's read from."""
+        return self._source_framing
+
+    def set_body_transform(self, transform: BodyTransform) -> None:
+        """
+        Streams the body through transform as it's relayed, instead of sending
+        it on as is. transform is called with an async iterator over the body
+        payload and yields the payload to send, typically as an async
+        generator:
+
+            async def upper(chunks):
+                async for chunk in chunks:
+                    yield chunk.upper()
+
+        The transformed body is sent chunked, since its length isn't known
+        up front. Whatever part of the body the transform doesn't consume is
+        read and discarded. Setting another transform chains it after the
+        first one. Messages without a body are left alone.
+        """
+        previous = self._transform
+        if previous:
+            self._transform = lambda chunks: transform(previous(chunks))
+            return
+
+        framing, length = self.get_body_framing()
+        if framing == BodyFraming.NoBody:
+            _LOGGER.debug("set_body_transform: message has no body")
+            return
+        self._source_framing = (framing, length)
+        self._transform = transform
+        self._headers.pop(CONTENT_LENGTH, None)
+        if not self.is_chunked():
+            self._headers[TRANSFER_ENCODING] = "chunked"
 
 
 class HttpRequest(HttpMessageBase):
@@ -78,9 +290,17 @@ class HttpRequest(HttpMessageBase):
     version: str
     url: ParseResult
 
-    def __init__(self, addr: Tuple[str, int], reader: StreamReader):
-        super().__init__(reader)
-        self.clientip, self.clientport = addr
+    def __init__(
+        self,
+        addr: Tuple[str, int],
+        reader: StreamReader,
+        body_store: Optional[BodyStore] = None):
+
+        super().__init__(reader, body_store)
+        # IPv6 peer names also carry the flow info and scope id
+        self.clientip, self.clientport = addr[:2]
+        # When the request head arrived (time.perf_counter())
+        self.received_at = 0.0
         _LOGGER.debug("HttpRequest: clientip=%s, clientport=%d", self.clientip,
             self.clientport)
 
@@ -90,22 +310,49 @@ class HttpRequest(HttpMessageBase):
         if len(data) == 0:
             return 0
 
+        self.received_at = time.perf_counter()
         self.raw_request = data
-        http_request_lines = data.split(CRLF)
-
-        # Split the request (first) line
-        self._start_line = http_request_lines[0].decode()
-        self.method, self.raw_url, self.version = self._start_line.split(" ")
-        self.url = urlparse(self.raw_url)
 
-        self._parse_headers(http_request_lines[1:])
+        # Split the request (first) line. Header fields are only parsed once
+        # somebody looks at them.
+        self.method, self.raw_url, self.version = self._parse_head(data).split(" ")
+        self._request_line = (self.method, self.raw_url, self.version)
+        if self.method == "CONNECT":
+            # CONNECT targets are in authority form (host:port)
+            self.url = urlparse(f"//{self.raw_url}")
+        else:
+            self.url = urlparse(self.raw_url)
 
         _LOGGER.debug("HttpRequest: %s", self)
         return len(data)
 
+    def is_keep_alive(self) -> bool:
+        return self._is_persistent(self.version)
+
+    async def iter_form(
+        self,
+        file_sink: Optional[FileSink] = None,
+        max_field_size: int = MAX_FIELD_SIZE) -> AsyncIterator[FormPart]:
+        """
+        Yields the fields of a urlencoded or multipart form body as they're
+        read (see iter_body, and FormParser for the arguments). Raises
+        FormError if the body isn't a form.
+        """
+        parser = FormParser(self._headers.get("Content-Type") or "", file_sink,
+            max_field_size)
+        async for data in self.iter_body():
+            for part in parser.feed(data):
+                yield part
+        for part in parser.close():
+            yield part
+
     def get_head(self) -> bytes:
         """Returns the request start line and all headers."""
-        return self.raw_request
+        request_line = (self.method, self.raw_url, self.version)
+        if request_line != self._request_line:
+            self._headers.start_line = " ".join(request_line).encode()
+            self._request_line = request_line
+        return self._headers.head
 
     def __str__(self) -> str:
         return str(dict(url=self.url, hostname=self.url.hostname,
@@ -113,16 +360,45 @@ class HttpRequest(HttpMessageBase):
 
 
 class HttpResponse(HttpMessageBase):
-    def __init__(self, reader: Optional[StreamReader] = None):
-        self._raw_response: bytes = b""
+    def __init__(
+        self,
+        reader: Optional[StreamReader] = None,
+        request_method: str = "GET",
+        body_store: Optional[BodyStore] = None):
+
+        self._status_line: Tuple[str, int, str] = ("", 0, "")
         self.http_version: str = ""
         self.response_code: int = 0
+        # Bytes sent to the client, head included, once relayed
+        self.bytes_sent = 0
         self.response_text: str = ""
-        super().__init__(reader)
+        # Responses to HEAD never have a body, whatever their headers say
+        self.request_method = request_method
+        super().__init__(reader, body_store)
 
     def is_valid(self) -> bool:
-        return (len(self.http_version) > 0 and self.response_code > 0 and
-                len(self.response_text) > 0)
+        # The reason phrase may be empty
+        return len(self.http_version) > 0 and self.response_code > 0
+
+    def is_informational(self) -> bool:
+        """Interim (1xx) responses are followed by the final response."""
+        return 100 <= self.response_code < 200 and self.response_code != 101
+
+    def get_body_framing(self) -> Tuple[BodyFraming, int]:
+        if (self.request_method == "HEAD" or self.response_code < 200
+            or self.response_code in (204, 304)):
+            return BodyFraming.NoBody, 0
+        framing, length = super().get_body_framing()
+        if framing == BodyFraming.NoBody and CONTENT_LENGTH not in self._headers:
+            # Without explicit framing the body runs until the server closes
+            # the connection
+            return BodyFraming.UntilClose, -1
+        return framing, length
+
+    def set_chunked(self) -> None:
+        """Switches the response to chunked framing."""
+        self._headers.pop(CONTENT_LENGTH, None)
+        self._headers[TRANSFER_ENCODING] = "chunked"
 
     async def read(self) -> int:
         data = await self._read_headers()
@@ -130,16 +406,22 @@ class HttpResponse(HttpMessageBase):
         if len(data) == 0:
             return 0
 
-        self._raw_response = data
-        http_response_lines = data.split(CRLF)
+        self.set_head(data)
+        return len(data)
 
-        # Split the response (first) line
-        self._start_line = http_response_lines[0].decode()
-        self.http_version, response_code, self.response_text = self._start_line.split(" ")
+    def set_head(self, data: bytes) -> None:
+        """Sets the status line and headers from a raw response head."""
+        # Split the response (first) line. The reason phrase may contain spaces
+        # or be missing entirely.
+        status = self._parse_head(data).split(" ", 2)
+        self.http_version, response_code = status[0], status[1]
+        self.response_text = status[2] if len(status) > 2 else ""
         self.response_code = int(response_code)
+        self._status_line = (self.http_version, self.response_code,
+            self.response_text)
 
-        self._parse_headers(http_response_lines[1:])
-        return len(data)
+    def is_keep_alive(self) -> bool:
+        return self._is_persistent(self.http_version)
 
     def get_head(self) -> bytes:
         """Returns the status line and all headers."""
@@ -147,19 +429,13 @@ class HttpResponse(HttpMessageBase):
             raise AttributeError("HTTP version not set")
         if not self.response_code:
             raise AttributeError("response code not set")
-        if not self.response_text:
-            raise AttributeError("response text not set")
-
-        if self._dirty:
-            # Recalculate head (start line + headers)
-            headers = [f"{k}: {v}".encode() for k, v in self._headers.items()]
-            if not self._start_line:
-                self._start_line = (f"{self.http_version} {self.response_code} "
-                    f"{self.response_text}")
-            self._raw_response = (self._start_line.encode() + CRLF +
-                CRLF.join(headers) + CRLF + CRLF)
-            self._dirty = False
-        return self._raw_response
+
+        status_line = (self.http_version, self.response_code, self.response_text)
+        if status_line != self._status_line:
+            self._headers.start_line = (f"{self.http_version} "
+                f"{self.response_code} {self.response_text}").encode()
+            self._status_line = status_line
+        return self._headers.head
 
     def __str__(self) -> str:
         return str(dict(http_version=self.http_version,
@@ -9,35 +9,310 @@ from contextlib import closing
 from dataclasses import dataclass, asdict
 import logging
 import ipaddress
-from typing import Any, Optional, Tuple
-
-import async_timeout
-
-from .callback import ProxyServerAction, ProxyServerCallback
-from .httprequest import HttpRequest, HttpResponse
+import socket
+import time
+from typing import (
+    Any, AsyncIterator, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+)
+
+from .accesslog import AccessLog, AccessLogFormat
+from .admission import (
+    ACCEPT_RETRY_DELAY, RESOURCE_ERRORS, AdmissionControl, TaskRegistry, bind, reject
+)
+from .bodystore import BodyStore
+from .cache import CacheWriter, ResponseCache
+from .callback import ProxyServerAction, ProxyServerCallback, ProxyServerSyncCallback
+from .callbackpool import CallbackPool
+from .collapse import Collapser, Flight
+from .compression import COMPRESSIBLE_TYPES, ResponseCompressor
+from .const import BUFFER_SIZE, CONNECTION, TRANSFER_ENCODING
+from .connectionpool import ConnectionPool, PooledConnection
+from .framing import (
+    LAST_CHUNK, BodyFraming, encode_chunk, iter_body_data, iter_chunked
+)
+from .httprequest import BodyTransform, HttpMessageBase, HttpRequest, HttpResponse
+from .loops import EventLoop
+from .metrics import ProxyMetrics, start_admin_server
+from .pipeline import ResponsePipeline
+from .recording import Recorder, RecordingStore, RecordMode, recording_key
+from .relay import BufferPool, RelayEngine, attach_local, open_relay
+from .resolver import CachingResolver, Resolver, connect
+from .routing import CallbackRouter, Router
 from .stream import StreamPair
+from .timer import CHECKS, TimerWheel, current_deadline, phase, touch
+from .tls import TlsContexts, TlsProfile
+from .tunnel import TunnelMode, run_tunnel
+from .upstreams import Backend, BalanceMethod, UpstreamGroup
 
-BUFFER_SIZE = 16 * 1024
 LOOPBACK_NETWORK = ipaddress.ip_network("127.0.0.0/8")
 
+# Pipelined requests with these methods (and no body) are handled
+# concurrently. They have no side effects, so that can't change the outcome.
+PIPELINED_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "TRACE"))
+
 _LOGGER = logging.getLogger(__name__)
 
+class Exchange(NamedTuple):
+    """A request and what's needed to send its response."""
+    request: HttpRequest
+    callback: Optional[ProxyServerCallback]
+    proxy_action: ProxyServerAction
+    connection: Optional[PooledConnection]
+    response: HttpResponse
+    cache_writer: Optional[CacheWriter]
+
+
 @dataclass
 class HttpServerOptions:
     allow_loopback_target: bool = False
+    # Whether requests no upstream group (see register_upstream) is routed to
+    # are forwarded to the host they name. Without it, they get a 404
+    # response, as a reverse proxy would give. CONNECT requests get a 403
+    # response without it, and so do those for hosts a group is routed to.
+    forward_proxy: bool = True
+    # Event loop implementation ("auto", "asyncio" or "uvloop") for the entry
+    # points that start their own loop: ProxyServer.run_forever, worker
+    # processes and python -m pyproxy
+    event_loop: str = EventLoop.Auto
+    # Bind with SO_REUSEPORT so several processes can serve the same port
+    reuse_port: bool = False
+    # Client connection limits (0 for none): in total and per client IP
+    # address. At the total limit the server stops accepting, and up to
+    # listen_backlog more connections wait in the kernel. Connections over
+    # the per-address limit get a 503 response.
+    max_connections: int = 0
+    max_connections_per_ip: int = 0
+    listen_backlog: int = 100
+    # Upstream connection pool
+    pool_max_idle: int = 64
+    pool_idle_ttl: float = 30.0
+    pool_max_per_host: int = 0
+    # How CONNECT tunnels relay data: "auto", "splice", "recv_into" or
+    # "streams". Anything but "streams" falls back to it when unavailable.
+    tunnel_mode: str = TunnelMode.Auto
+    # Relay engine for CONNECT tunnels: "streams" (StreamReader/StreamWriter,
+    # subject to tunnel_mode) or "protocol" (BufferedProtocol with pooled
+    # buffers and watermark-based flow control)
+    relay_engine: str = RelayEngine.Streams
+    relay_buffer_size: int = 64 * 1024
+    relay_high_watermark: int = 256 * 1024
+    relay_low_watermark: int = 64 * 1024
+    # In-memory response cache, disabled when cache_max_bytes is 0
+    cache_max_bytes: int = 0
+    cache_max_entry_bytes: int = 1024 * 1024
+    # Upstream name resolution: how long (in seconds) successful and failed
+    # lookups are cached, and how long to wait on one address before also
+    # trying the next (RFC 8305 Happy Eyeballs)
+    dns_positive_ttl: float = 60.0
+    dns_negative_ttl: float = 5.0
+    happy_eyeballs_delay: float = 0.25
+    # Timeouts, in seconds (0 disables them): for connecting upstream, for a
+    # new client's first request head, for a keep-alive client's next request
+    # and for any single read while a request is in progress (which also
+    # covers tunnels). All but the connect timeout are checked every
+    # timer_resolution seconds, or more often if a timeout is short next to
+    # it, so they may run over by about a quarter. A reverse proxy backend
+    # that times out connecting counts as failed, like one that refuses.
+    connect_timeout: float = 10.0
+    header_timeout: float = 30.0
+    idle_timeout: float = 15.0
+    read_timeout: float = 60.0
+    timer_resolution: float = 0.25
+    # Serve metrics in the Prometheus text format at
+    # http://admin_address:admin_port/metrics (disabled when admin_port is 0).
+    # With several workers, each scrape is answered by one of them.
+    admin_address: str = "127.0.0.1"
+    admin_port: int = 0
+    # Bodies callbacks read in full are kept in memory up to
+    # body_spill_threshold bytes each and body_memory_budget bytes in total
+    # (0 for no limit). Others are spooled to temporary files in
+    # body_spool_dir (the system default when None).
+    body_spill_threshold: int = 1024 * 1024
+    body_memory_budget: int = 64 * 1024 * 1024
+    body_spool_dir: Optional[str] = None
+    # How many pipelined requests from a client can be in progress at once.
+    # 1 handles them one at a time.
+    pipeline_depth: int = 8
+    # Compress responses for clients that accept it, with gzip (or br or
+    # zstd, when the brotli or zstandard modules are installed). Only
+    # uncompressed responses of compression_types whose bodies are at least
+    # compression_min_size bytes (or of unknown length) are compressed, using
+    # compression_threads threads.
+    compression: bool = False
+    compression_min_size: int = 1024
+    compression_types: Tuple[str, ...] = COMPRESSIBLE_TYPES
+    compression_threads: int = 2
+    # Threads for the hooks of ProxyServerSyncCallback callbacks, and how many
+    # of those hooks can be running or waiting for a thread at once (0 for as
+    # many as there are threads). Any more wait their turn on the event loop.
+    callback_threads: int = 4
+    callback_concurrency: int = 0
+    # Access log file (none when None), with a line per request in "common"
+    # format (Common Log Format followed by the duration in milliseconds and
+    # the callback action) or "json". Lines are written in batches by a
+    # background task, from a ring buffer of access_log_buffer records.
+    # access_log_sample_rate is the fraction of requests logged (server
+    # errors are always logged). The file is rotated when it reaches
+    # access_log_max_bytes (0 for never), keeping access_log_backups old ones.
+    access_log: Optional[str] = None
+    access_log_format: str = AccessLogFormat.Common
+    access_log_sample_rate: float = 1.0
+    access_log_max_bytes: int = 0
+    access_log_backups: int = 5
+    access_log_buffer: int = 8192
+    # Record upstream responses to record_file ("record"), or answer requests
+    # with the responses recorded there without contacting upstream
+    # ("replay"). Responses are recorded under the request method, target and
+    # the values of the record_key_headers request header fields; bodies over
+    # record_max_body bytes aren't recorded. Up to record_max_pending bytes
+    # of responses wait to be written; any more are dropped (and logged).
+    # Requests with nothing recorded get a 502 response, or are forwarded if
+    # replay_forward_misses is set.
+    record_mode: str = RecordMode.Off
+    record_file: Optional[str] = None
+    record_key_headers: Tuple[str, ...] = ()
+    record_max_body: int = 16 * 1024 * 1024
+    record_max_pending: int = 64 * 1024 * 1024
+    replay_forward_misses: bool = False
+    # Collapsed forwarding: identical GET and HEAD requests that come in while
+    # one of them is being fetched share its upstream response instead of
+    # each going upstream. Requests are identical when their targets and
+    # collapse_key_headers fields match. Those with any of the
+    # collapse_exclude_headers fields always go upstream on their own, as do
+    # the later ones when the response is private (Set-Cookie, Cache-Control:
+    # private) or varies on fields outside the key. Up to
+    # collapse_max_buffer bytes of the body are kept for the slowest client.
+    collapse_forwarding: bool = False
+    collapse_key_headers: Tuple[str, ...] = ("Accept", "Accept-Encoding", "Accept-Language")
+    collapse_exclude_headers: Tuple[str, ...] = (
+        "Authorization", "Cookie", "Proxy-Authorization")
+    collapse_max_buffer: int = 1024 * 1024
+    # TLS to upstream servers, for https request targets and backends (unless
+    # their group has a TlsProfile of its own). Servers are verified against
+    # upstream_tls_ca_file (the system's trusted certificates when None)
+    # unless upstream_tls_verify is off. upstream_tls_cert_file and
+    # upstream_tls_key_file are the client certificate, for servers that ask
+    # for one. Each profile's SSLContext is shared by all its connections, and
+    # keeps the last session with each of up to tls_session_cache_size servers
+    # to resume it on the next connection.
+    upstream_tls_verify: bool = True
+    upstream_tls_ca_file: Optional[str] = None
+    upstream_tls_cert_file: Optional[str] = None
+    upstream_tls_key_file: Optional[str] = None
+    tls_session_cache_size: int = 256
 
 
 class HttpServer:
     def __init__(self, address: str, port: int):
         self._proxy_address = address
         self._proxy_port = port
-        self._server: asyncio.Server
-        self._callback: Optional[ProxyServerCallback] = None
+        self._listeners: List[socket.socket] = []
+        self._admission = AdmissionControl()
+        self._accepting = TaskRegistry()
+        self._sessions = TaskRegistry()
+        # Connections waiting for a request, and their pending responses
+        self._waiting: Dict[StreamWriter, ResponsePipeline[Exchange]] = { }
+        self._draining = False
+        self._closed = False
+        # Set while listening
+        self._started = asyncio.Event()
+        self._router = CallbackRouter()
+        self._upstreams: Router[UpstreamGroup] = Router()
+        # The upstream group and backend of connections to backends in use
+        self._backends: Dict[PooledConnection, Tuple[UpstreamGroup, Backend]] = { }
         self._options = HttpServerOptions()
+        self._pool = ConnectionPool()
+        self._tls = TlsContexts()
+        self._tls_profile = TlsProfile()
+        self._buffers = BufferPool()
+        self._cache: Optional[ResponseCache] = None
+        self._base_resolver: Optional[Resolver] = None
+        self._resolver: Resolver = CachingResolver()
+        self._timers = TimerWheel()
+        self._metrics = ProxyMetrics()
+        self._admin_server: Optional[asyncio.Server] = None
+        self._body_store = BodyStore()
+        self._compressor: Optional[ResponseCompressor] = None
+        self._callback_pool = CallbackPool()
+        self._access_log: Optional[AccessLog] = None
+        self._recorder: Optional[Recorder] = None
+        self._replay_store: Optional[RecordingStore] = None
+        self._collapser: Optional[Collapser] = None
+
+
+    @property
+    def cache(self) -> Optional[ResponseCache]:
+        return self._cache
+
+
+    @property
+    def metrics(self) -> ProxyMetrics:
+        return self._metrics
+
+
+    @property
+    def options(self) -> HttpServerOptions:
+        return self._options
+
 
+    @property
+    def port(self) -> int:
+        """The port served on, which is picked when listening on port 0."""
+        if self._listeners:
+            return self._listeners[0].getsockname()[1]
+        return self._proxy_port
 
-    def register_callback(self, callback: ProxyServerCallback) -> None:
-        self._callback = callback
+
+    async def wait_started(self) -> None:
+        """Waits until the server is listening."""
+        await self._started.wait()
+
+
+    def register_callback(
+        self,
+        callback: ProxyServerCallback,
+        hosts: Optional[Iterable[str]] = None,
+        paths: Optional[Iterable[str]] = None,
+        methods: Optional[Iterable[str]] = None,
+        ports: Optional[Iterable[int]] = None) -> None:
+        """
+        Has callback handle the requests that match all the given criteria
+        (see CallbackRouter), or every request if none are given. Requests no
+        callback matches are relayed without calling into any of them.
+        """
+        self._router.add(callback, hosts, paths, methods, ports)
+
+
+    def register_upstream(
+        self,
+        backends: Iterable[str],
+        hosts: Optional[Iterable[str]] = None,
+        paths: Optional[Iterable[str]] = None,
+        methods: Optional[Iterable[str]] = None,
+        balance: str = BalanceMethod.LeastOutstanding,
+        max_fails: int = 3,
+        eject_time: float = 10.0,
+        tls: Optional[TlsProfile] = None) -> UpstreamGroup:
+        """
+        Reverse proxies the requests that match all the given criteria (as
+        for register_callback, with hosts matched against the Host header
+        field) to a group of backends, given as "host:port" addresses, or
+        "https://host:port" for TLS (with the tls profile, or the upstream_tls
+        options when None). Each request goes to one of them, picked with
+        balance (see UpstreamGroup). Callbacks, the cache and the rest apply
+        as for forwarded requests.
+        """
+        group = UpstreamGroup(backends, balance, max_fails, eject_time, tls=tls)
+        self._upstreams.add(group, hosts, paths, methods)
+        return group
+
+
+    def set_resolver(self, resolver: Resolver) -> None:
+        """
+        Resolves upstream host names with resolver instead of the system
+        resolver. Lookups are still cached according to the dns_* options.
+        """
+        self._base_resolver = resolver
 
 
     def set_options(self, **kwargs: Any) -> None:
@@ -48,16 +323,59 @@ class HttpServer:
             setattr(self._options, option, value)
 
 
-    async def close(self) -> None:
-        if self._server:
-            self._server.close()
-            await self._server.wait_closed()
+    async def close(self, drain_timeout: float = 0.0) -> None:
+        """
+        Stops accepting connections and closes those that are waiting for a
+        request. Requests in progress get drain_timeout seconds to finish
+        before their connections are closed too.
+        """
+        self._closed = True
+        self._draining = True
+        await self._accepting.cancel()
+        for sock in self._listeners:
+            sock.close()
+        self._listeners = []
+        if self._admin_server:
+            self._admin_server.close()
+            await self._admin_server.wait_closed()
+
+        # Connections with responses pending close once they're sent
+        for writer, pipeline in list(self._waiting.items()):
+            if not pipeline:
+                writer.close()
+        if drain_timeout > 0 and not await self._sessions.wait(drain_timeout):
+            _LOGGER.info("closing %d connections still busy after %.1fs",
+                len(self._sessions), drain_timeout)
+        await self._sessions.cancel()
+        if self._collapser is not None:
+            await self._collapser.close()
+            self._collapser = None
+        await self._pool.close()
+        if self._compressor:
+            self._compressor.close()
+            self._compressor = None
+        self._callback_pool.close()
+        if self._recorder:
+            await self._recorder.close()
+            self._recorder = None
+        if self._replay_store:
+            self._replay_store.close()
+            self._replay_store = None
+        if self._access_log:
+            await self._access_log.close()
+            self._access_log = None
 
 
     async def pipe_stream(
-        self, reader: StreamReader, writer: StreamWriter, n: int = -1, prefix: str = ""
-        ) -> None:
-
+        self,
+        reader: StreamReader,
+        writer: StreamWriter,
+        n: int = -1,
+        prefix: str = "",
+        sink: Optional[Callable[[bytes], None]] = None) -> int:
+        """Relays n bytes (or everything up to EOF) and returns the count."""
+
+        total = 0
         bytes_left = 0
         if n > 0:
             bytes_left = n
@@ -67,26 +385,165 @@ class HttpServer:
             bytes_to_read = BUFFER_SIZE
             _LOGGER.debug("pipe_stream(%s): reading until EOF", prefix)
 
+        # Checked once rather than per chunk, and the chunk itself is only
+        # formatted if it's logged
+        debug = _LOGGER.isEnabledFor(logging.DEBUG)
         while not reader.at_eof():
             data = await reader.read(bytes_to_read)
+            touch()
             bytes_read = len(data)
-            _LOGGER.debug("pipe_stream(%s): read(%d) = %d",
-                prefix, bytes_to_read, bytes_read)
-            if prefix:
-                _LOGGER.debug("pipe_stream(%s): %s", prefix, data.__repr__())
+            if debug:
+                _LOGGER.debug("pipe_stream(%s): read(%d) = %d",
+                    prefix, bytes_to_read, bytes_read)
+                if prefix:
+                    _LOGGER.debug("pipe_stream(%s): %r", prefix, data)
             writer.write(data)
+            if sink:
+                sink(data)
+            total += bytes_read
             await writer.drain()
 
             if n > 0:
                 bytes_left -= bytes_read
-                _LOGGER.debug("pipe_stream(%s): bytes left: %d bytes", prefix, bytes_left)
+                if debug:
+                    _LOGGER.debug("pipe_stream(%s): bytes left: %d bytes", prefix, bytes_left)
                 if bytes_left == 0:
                     break
                 bytes_to_read = min(BUFFER_SIZE, bytes_left)
+        return total
+
+
+    async def relay_body(
+        self,
+        reader: StreamReader,
+        writer: StreamWriter,
+        framing: BodyFraming,
+        length: int,
+        rechunk: bool = False,
+        prefix: str = "",
+        sink: Optional[Callable[[bytes], None]] = None) -> int:
+        """
+        Relays a message body as framed on the wire and returns the number of
+        bytes written. With rechunk=True, a body delimited by the connection
+        closing is sent on as a chunked body. sink, if given, is called with
+        the body payload as it's relayed.
+        """
+        total = 0
+        if framing == BodyFraming.ContentLength:
+            if length > 0:
+                total = await self.pipe_stream(reader, writer, length, prefix, sink)
+        elif framing == BodyFraming.Chunked:
+            _LOGGER.debug("relay_body(%s): relaying chunked body", prefix)
+            async for data in iter_chunked(reader, sink):
+                touch()
+                writer.write(data)
+                total += len(data)
+                await writer.drain()
+        elif framing == BodyFraming.UntilClose:
+            if not rechunk:
+                return await self.pipe_stream(reader, writer, prefix=prefix, sink=sink)
+
+            _LOGGER.debug("relay_body(%s): rechunking body", prefix)
+            async for data in iter_body_data(reader, framing):
+                touch()
+                chunk = encode_chunk(data)
+                writer.write(chunk)
+                total += len(chunk)
+                if sink:
+                    sink(data)
+                await writer.drain()
+            writer.write(LAST_CHUNK)
+            total += len(LAST_CHUNK)
+            await writer.drain()
+        return total
+
+
+    async def relay_transformed_body(
+        self,
+        reader: StreamReader,
+        writer: StreamWriter,
+        framing: BodyFraming,
+        length: int,
+        transform: BodyTransform,
+        chunked: bool = True,
+        prefix: str = "",
+        sink: Optional[Callable[[bytes], None]] = None) -> int:
+        """
+        Reads a body framed as given, streams its payload through transform
+        and sends the result on, chunked unless chunked=False. Returns the
+        number of bytes written. sink, if given, is called with the payload
+        before it's transformed.
+        """
+        _LOGGER.debug("relay_transformed_body(%s): transforming body", prefix)
+        source = iter_body_data(reader, framing, length)
+
+        def take(data: bytes) -> bytes:
+            touch()
+            # Bodies read in full come as memoryviews; transforms get bytes
+            data = bytes(data) if isinstance(data, memoryview) else data
+            if sink:
+                sink(data)
+            return data
+
+        async def payload() -> AsyncIterator[bytes]:
+            async for data in source:
+                yield take(data)
+
+        total = 0
+        async for data in transform(payload()):
+            if not data:
+                # An empty chunk would end a chunked body
+                continue
+            if chunked:
+                data = encode_chunk(data)
+            writer.write(data)
+            total += len(data)
+            await writer.drain()
+
+        # Keep the connection in sync if the transform stopped reading early
+        async for data in source:
+            take(data)
+
+        if chunked:
+            writer.write(LAST_CHUNK)
+            total += len(LAST_CHUNK)
+            await writer.drain()
+        return total
+
+
+    async def send_body(
+        self,
+        message: HttpMessageBase,
+        writer: StreamWriter,
+        framing: BodyFraming,
+        length: int,
+        rechunk: bool = False,
+        prefix: str = "",
+        sink: Optional[Callable[[bytes], None]] = None) -> int:
+        """
+        Sends a message body on, through the message's body transform if it
+        has one. framing and length describe how it's to be sent.
+        """
+        if framing == BodyFraming.NoBody or (
+            framing == BodyFraming.ContentLength and length == 0):
+            # Messages made up by the proxy have no reader to read from
+            return 0
+        reader = message.get_streamreader()
+        transform = message.body_transform
+        if transform:
+            return await self.relay_transformed_body(reader, writer,
+                *message.get_source_framing(), transform,
+                chunked=framing == BodyFraming.Chunked, prefix=prefix, sink=sink)
+        return await self.relay_body(reader, writer, framing, length,
+            rechunk=rechunk, prefix=prefix, sink=sink)
 
 
     async def connect_streams(
-        self, local_stream: StreamPair, remote_stream: StreamPair) -> None:
+        self, local_stream: StreamPair, remote_stream: StreamPair) -> Tuple[int, int]:
+        """
+        Relays data both ways until either side is done. Returns the bytes
+        relayed each way (local to remote, remote to local).
+        """
 
         local_reader, local_writer = local_stream
         remote_reader, remote_writer = remote_stream
@@ -99,17 +556,73 @@ class HttpServer:
                 self.pipe_stream(remote_reader, local_writer, prefix="<="),
                 name="RemoteToLocalPipe")
             )
-        _, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-        for task in pending:
-            _LOGGER.debug("cancelling task %s", task.get_name())
-            task.cancel()
+        pending = set(tasks)
+        try:
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 1:
+                # Pass a clean EOF on and let the other direction finish
+                task = done.pop()
+                writer = remote_writer if task is tasks[0] else local_writer
+                if task.exception() is None and writer.can_write_eof():
+                    writer.write_eof()
+                    _, pending = await asyncio.wait(pending)
+        finally:
+            for task in pending:
+                _LOGGER.debug("cancelling task %s", task.get_name())
+                task.cancel()
+
+        sent = [t.result() if t.done() and not t.cancelled() and not t.exception()
+            else 0 for t in tasks]
+        return sent[0], sent[1]
+
+
+    async def connect(self, host: str, port: int) -> socket.socket:
+        """
+        Returns a socket connected to host:port. Raises TimeoutError if that
+        takes longer than connect_timeout.
+        """
+        start = time.perf_counter()
+        try:
+            # Timed out here rather than by the task's deadline, which would
+            # cancel the whole exchange instead of failing just this connect
+            with phase(0):
+                sock = await asyncio.wait_for(connect(host, port, self._resolver,
+                    self._options.happy_eyeballs_delay),
+                    self._options.connect_timeout or None)
+        except BaseException:
+            self._metrics.upstream_errors.inc()
+            raise
+        self._metrics.upstream_connect_seconds.observe(time.perf_counter() - start)
+        return sock
+
+
+    async def open_connection(
+        self, host: str, port: int, tls: Optional[TlsProfile] = None) -> StreamPair:
+        """Connects to host:port, over TLS with the tls profile if one is given."""
+        sock = await self.connect(host, port)
+        try:
+            if tls is None:
+                return await asyncio.open_connection(sock=sock)
+            with phase(0):
+                reader, writer = await asyncio.wait_for(
+                    self._tls.open_connection(host, port, tls, sock),
+                    self._options.connect_timeout or None)
+        except BaseException:
+            sock.close()
+            raise
+        ssl_object = writer.get_extra_info("ssl_object")
+        self._metrics.upstream_tls_handshakes.inc()
+        if ssl_object is not None and ssl_object.session_reused:
+            self._metrics.upstream_tls_resumed.inc()
+        return reader, writer
 
 
     def get_proxy_target(self, request: HttpRequest) -> Tuple[str, int]:
         if request.url.hostname:
             _LOGGER.debug("get_proxy_target: using hostname/port from url")
             hostname = request.url.hostname
-            port = request.url.port or 80
+            port = request.url.port or (443 if request.url.scheme == "https" else 80)
         else:
             host = request.headers["Host"] if "Host" in request.headers else None
             if not host:
@@ -144,160 +657,848 @@ class HttpServer:
         client_reader: StreamReader,
         client_writer: StreamWriter) -> None:
 
-        target_hostname = None
-        target_port = None
-        server_writer = None
-        while True:
-            # Read request from client
-            request = HttpRequest(addr, client_reader)
-            bytes_read = await request.read_headers()
-            if bytes_read == 0:
-                break
-
-            if request.method == 'CONNECT':  # https
-                await self.https_handler(client_reader, client_writer, request)
-                break
-
-            # Evaluate if we need to connect to a new target
-            new_hostname, new_port = self.get_proxy_target(request)
-            if (not self._options.allow_loopback_target
-                and self.is_loopback(new_hostname)):
-
-                _LOGGER.error("cannot have loopback as a proxy target")
-                break
-
-            if target_hostname != new_hostname and target_port != new_port:
-                target_hostname = new_hostname
-                target_port = new_port
-                if server_writer:
-                    server_writer.close()
-                    await server_writer.wait_closed()
-
-                _LOGGER.debug("connecting to %s:%d...", target_hostname,
-                    target_port)
-                server_reader, server_writer = await asyncio.open_connection(
-                    target_hostname, target_port)
-                _LOGGER.debug("HTTP connection established to %s:%d",
-                    target_hostname, target_port)
-
-            # assert(server_reader is not None)
-            assert server_writer is not None
-
-            _LOGGER.debug(">>> request phase >>>")
-            proxy_action = ProxyServerAction.Forward
-            if self._callback:
-                proxy_action = await self._callback.on_new_request_async(request)
-                _LOGGER.debug("proxy action: %s", proxy_action.name)
-
-            if proxy_action == ProxyServerAction.Forward:
-                # Send the request line and headers to the server unaltered
-                head = request.get_head()
-                _LOGGER.debug("sending to server: %s", head)
-                server_writer.write(head)
-                await server_writer.drain()
-
-                # For requests that have a body, send the body next
-                request_length = request.get_content_length()
-                if request_length > 0:
-                    await self.pipe_stream(request.get_streamreader(),
-                        server_writer, request_length, prefix="=>")
-
-            #
-            # Read server response
-            #
-
-            _LOGGER.debug("<<< response phase <<<")
-
-            # It only really makes sense to read a response from the server if
-            # we forwarded the request up to the server in the first place. If
-            # we have suppressed the request, the only option we have is to give
-            # the callback an opportunity to provide one.
-            if proxy_action == ProxyServerAction.Forward:
-                response = HttpResponse(server_reader)
-                await response.read()
-            else:
-                response = HttpResponse()
+        metrics = self._metrics
+        start = time.perf_counter()
 
-            if self._callback:
-                await self._callback.on_new_response_async(
-                    proxy_action, request, response)
+        async def send(exchange: Exchange) -> bool:
+            keep_alive = await self.finish_exchange(exchange, client_writer)
+            # When shutting down, close the connection after the last response
+            return keep_alive and not (self._draining and not pipeline)
 
-            # If weCheck if the callback provided a proper response. If nothing
-            # was provided, respond with 500 Internal Error back to the client.
-            if not response.is_valid():
-                _LOGGER.error("invalid response from callback. "
-                    "Sending internal error (500) to client.")
+        pipeline: ResponsePipeline[Exchange] = ResponsePipeline(
+            self._options.pipeline_depth, send, self.discard_exchange,
+            # Wakes up the read of the next request when no more responses
+            # are to be sent
+            on_stop=client_writer.close)
+        try:
+            while not self._draining:
+                # Read request from client
+                request = HttpRequest(addr, client_reader, self._body_store)
+                self._waiting[client_writer] = pipeline
+                try:
+                    bytes_read = await request.read_headers()
+                finally:
+                    del self._waiting[client_writer]
+                if bytes_read == 0 or pipeline.closed:
+                    break
+                metrics.requests.inc()
+                if start:
+                    metrics.first_request_seconds.observe(time.perf_counter() - start)
+                    start = 0.0
+                deadline = current_deadline()
+                if deadline:
+                    deadline.reset(self._options.read_timeout)
+
+                target_hostname, target_port = self.get_proxy_target(request)
+                # Requests routed to an upstream group go to its backends, but
+                # tunnels always go to the host they name
+                if (not self._options.allow_loopback_target
+                    and self.is_loopback(target_hostname)
+                    and (request.method == 'CONNECT' or self.match_upstream(
+                        request, target_hostname, target_port) is None)):
+
+                    _LOGGER.error("cannot have loopback as a proxy target")
+                    break
+
+                if request.method == 'CONNECT':  # https
+                    await pipeline.drain()
+                    if (not self._options.forward_proxy or self.match_upstream(
+                        request, target_hostname, target_port) is not None):
+                        # Only a forward proxy tunnels, and only to hosts it
+                        # would forward requests to
+                        _LOGGER.info("refusing to tunnel to %s:%d", target_hostname,
+                            target_port)
+                        client_writer.write(b"HTTP/1.1 403 Forbidden\r\n"
+                            b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+                        await client_writer.drain()
+                        break
+                    metrics.tunnels.inc()
+                    metrics.tunnels_active.inc()
+                    try:
+                        sent = await self.https_handler(
+                            client_reader, client_writer, request)
+                    finally:
+                        metrics.tunnels_active.dec()
+                    if self._access_log and sent:
+                        self._access_log.record(request.clientip, request.method,
+                            request.raw_url, request.version, 200, sent[1],
+                            time.perf_counter() - request.received_at)
+                    break
+
+                _LOGGER.debug(">>> request phase >>>")
+                if (pipeline.depth > 1 and request.method in PIPELINED_METHODS
+                    and request.get_body_framing()[0] == BodyFraming.NoBody):
+                    # The next request can be read right away, and handled
+                    # while this one is in progress
+                    await pipeline.put(asyncio.create_task(
+                        self.run_exchange(request, target_hostname, target_port),
+                        name="exchange"))
+                    if not request.is_keep_alive():
+                        break
+                else:
+                    # Anything with side effects or a body to read waits for
+                    # the responses before it and has its own sent before the
+                    # next request is looked at
+                    await pipeline.drain()
+                    if pipeline.closed:
+                        break
+                    exchange = await self.start_exchange(
+                        request, target_hostname, target_port)
+                    if not await self.finish_exchange(exchange, client_writer):
+                        break
+
+                if deadline:
+                    # Stay on the read timeout while responses are pending
+                    deadline.reset(self._options.read_timeout if pipeline
+                        else self._options.idle_timeout)
+
+            await pipeline.drain()
+        finally:
+            await pipeline.close()
+
+        _LOGGER.debug("http_handler: done")
 
+
+    async def start_exchange(
+        self, request: HttpRequest, hostname: str, port: int) -> Exchange:
+        """
+        Runs the request callback and, unless it suppresses the request, gets
+        the response head from upstream (or the cache).
+        """
+        proxy_action = ProxyServerAction.Forward
+        callback = None
+        if len(self._router):
+            callback = self._router.match(hostname, port,
+                request.method, request.url.path or "/")
+        if callback:
+            callback_start = time.perf_counter()
+            proxy_action = await self.call_request_hook(callback, request)
+            self._metrics.request_callback_seconds.observe(
+                time.perf_counter() - callback_start)
+            _LOGGER.debug("proxy action: %s", proxy_action.name)
+
+        connection = None
+        cache_writer = None
+        response = HttpResponse(request_method=request.method,
+            body_store=self._body_store)
+        if proxy_action == ProxyServerAction.Forward:
+            replayed = self._replay_store is not None and self.replay_response(
+                request, hostname, port, response)
+            if replayed:
+                # Answered without upstream, but the next request comes after
+                # the body
+                await request.discard_body()
+            if (not replayed and not self._options.forward_proxy
+                and self.match_upstream(request, hostname, port) is None):
+                # The body goes nowhere, but the next request comes after it
+                await request.discard_body()
                 response.http_version = request.version
-                response.response_code = 500
-                response.response_text = "Internal Error"
-                response.set_body("""
-                <html>
-                    <title>Internal Application Error</title>
-                    <body>
-                        <h1>pyProxy Application Error</h1>
-                        <p>The application callback did not provide a valid HTTP
-                        response after suppressing a request.</p>
-                    </body>
-                </html>""".encode())
-
-            # Send the response line and headers back to the client unaltered
-            head = response.get_head()
-            _LOGGER.debug("sending to client: %s", head)
-            client_writer.write(head)
-            await client_writer.drain()
+                response.response_code = 404
+                response.response_text = "Not Found"
+                response.set_body(b"")
+            elif not replayed:
+                try:
+                    connection, response, cache_writer = await self.fetch_response(
+                        request, hostname, port)
+                except (OSError, asyncio.TimeoutError) as e:
+                    if self.match_upstream(request, hostname, port) is None:
+                        raise
+                    # None of the group's backends could take it
+                    _LOGGER.warning("no backend for %s %s:%d%s: %r", request.method,
+                        hostname, port, request.url.path, e)
+                    timed_out = isinstance(e, asyncio.TimeoutError)
+                    response.http_version = request.version
+                    response.response_code = 504 if timed_out else 502
+                    response.response_text = ("Gateway Timeout" if timed_out
+                        else "Bad Gateway")
+                    response.set_body(b"")
+                    if request.get_body_framing()[0] != BodyFraming.NoBody:
+                        # Some of the body may have been sent already, so
+                        # there's no telling where the next request starts
+                        request.headers[CONNECTION] = "close"
+                        response.headers[CONNECTION] = "close"
+        return Exchange(request, callback, proxy_action, connection, response,
+            cache_writer)
+
+
+    def replay_response(
+        self, request: HttpRequest, hostname: str, port: int, response: HttpResponse
+        ) -> bool:
+        """
+        Sets response to the one recorded for request. Returns False if the
+        request is to be forwarded instead.
+        """
+        assert self._replay_store is not None
+        key = recording_key(request, hostname, port, self._options.record_key_headers)
+        recorded = self._replay_store.lookup(key)
+        if recorded is not None:
+            self._metrics.responses_replayed.inc()
+            head, body = recorded
+            response.set_head(head)
+            response.set_body(body)
+            return True
 
-            # For responses that have a body, send the body next
-            response_length = response.get_content_length()
-            if response_length > 0:
-                await self.pipe_stream(response.get_streamreader(),
-                    client_writer, response_length, prefix="<=")
+        self._metrics.replay_misses.inc()
+        if self._options.replay_forward_misses:
+            return False
+        _LOGGER.info("replay: nothing recorded for %s %s:%d%s", request.method,
+            hostname, port, request.url.path)
+        response.http_version = request.version
+        response.response_code = 502
+        response.response_text = "Bad Gateway"
+        response.set_body(b"")
+        return True
+
+
+    async def call_request_hook(
+        self, callback: ProxyServerCallback, request: HttpRequest) -> ProxyServerAction:
+        """Has callback look at a request, in a thread if its hooks are sync."""
+        if not isinstance(callback, ProxyServerSyncCallback):
+            action = await callback.on_new_request_async(request)
+            # In case the callback stopped reading the body partway through
+            await request.finish_body()
+            return action
+        if callback.read_bodies:
+            await request.read_body_buffer()
+        return await self._callback_pool.run(callback.on_new_request, request)
+
+
+    async def call_response_hook(
+        self,
+        callback: ProxyServerCallback,
+        action: ProxyServerAction,
+        request: HttpRequest,
+        response: HttpResponse) -> None:
+        """Has callback look at a response, in a thread if its hooks are sync."""
+        if not isinstance(callback, ProxyServerSyncCallback):
+            await callback.on_new_response_async(action, request, response)
+            await response.finish_body()
+            return
+        if callback.read_bodies and action == ProxyServerAction.Forward:
+            await response.read_body_buffer()
+        await self._callback_pool.run(callback.on_new_response, action, request, response)
+
+
+    async def run_exchange(
+        self, request: HttpRequest, hostname: str, port: int) -> Exchange:
+        """start_exchange for a pipelined request, with its own read timeout."""
+        with self._timers.deadline(self._options.read_timeout):
+            return await self.start_exchange(request, hostname, port)
+
+
+    async def finish_exchange(
+        self, exchange: Exchange, client_writer: StreamWriter) -> bool:
+        """
+        Sends the response to the client. Returns whether the client
+        connection can be kept alive.
+        """
+        request, callback, proxy_action, connection, response, cache_writer = exchange
+        try:
+            keep_alive, reusable = await self.relay_response(
+                request, proxy_action, response, client_writer, cache_writer,
+                callback)
+            if proxy_action == ProxyServerAction.Suppress:
+                # Whatever of the body the callback didn't read comes before
+                # the next request
+                await request.discard_body()
+        except BaseException:
+            self.discard_exchange(exchange)
+            raise
+
+        if connection:
+            self.release_connection(connection, reusable and response.is_keep_alive())
+        if self._access_log:
+            self._access_log.record(request.clientip, request.method,
+                request.raw_url, request.version, response.response_code,
+                response.bytes_sent, time.perf_counter() - request.received_at,
+                proxy_action.name if callback else "-")
+        request.release_body()
+        response.release_body()
+        return keep_alive and request.is_keep_alive()
+
+
+    def discard_exchange(self, exchange: Exchange) -> None:
+        """Cleans up after an exchange whose response won't be sent."""
+        if exchange.connection:
+            self.release_connection(exchange.connection, reusable=False)
+        exchange.request.release_body()
+        exchange.response.release_body()
+
+
+    async def send_request(
+        self, request: HttpRequest, connection: PooledConnection) -> HttpResponse:
+
+        # Send the request line and headers to the server unaltered
+        start = time.perf_counter()
+        head = request.get_head()
+        _LOGGER.debug("sending to server: %s", head)
+        connection.writer.write(head)
+        await connection.writer.drain()
+
+        # For requests that have a body, send the body next
+        framing, length = request.get_body_framing()
+        sent = await self.send_body(request, connection.writer, framing, length,
+            prefix="=>")
+        self._metrics.bytes_to_upstream.inc(len(head) + sent)
+
+        response = HttpResponse(connection.reader, request.method, self._body_store)
+        await response.read()
+        self._metrics.time_to_first_byte_seconds.observe(time.perf_counter() - start)
+        return response
+
+
+    async def fetch_response(
+        self, request: HttpRequest, hostname: str, port: int
+        ) -> Tuple[Optional[PooledConnection], HttpResponse, Optional[CacheWriter]]:
+        """
+        Gets the response to a request, from the cache if possible. Returns the
+        server connection the response is to be read from (if any), the
+        response and, if the response can be cached, a CacheWriter for it.
+        """
+        cache = self._cache
+        if cache is None or not cache.is_cacheable_request(request):
+            collapsed = await self.fetch_collapsed(request, hostname, port)
+            if collapsed is not None:
+                return None, collapsed, None
+            return (*await self.forward_request(request, hostname, port), None)
+
+        key = cache.get_key(request, hostname, port)
+        entry = cache.lookup(request, key)
+        if entry and entry.is_fresh() and not cache.wants_revalidation(request):
+            _LOGGER.debug("cache: hit for %s", key)
+            cache.stats.hits += 1
+            return None, entry.to_response(request), None
+        if entry is None:
+            collapsed = await self.fetch_collapsed(request, hostname, port, key)
+            if collapsed is not None:
+                return None, collapsed, None
+
+        revalidating = entry is not None and entry.add_conditions(request)
+        connection, response = await self.forward_request(request, hostname, port)
+        if revalidating and response.response_code == 304:
+            assert entry is not None
+            _LOGGER.debug("cache: revalidated %s", key)
+            cache.refresh(entry, response)
+            self.release_connection(connection, response.is_keep_alive())
+            return None, entry.to_response(request), None
+
+        cache.stats.misses += 1
+        return connection, response, cache.start(request, response, key)
+
+
+    async def fetch_collapsed(
+        self,
+        request: HttpRequest,
+        hostname: str,
+        port: int,
+        cache_key: Optional[str] = None) -> Optional[HttpResponse]:
+        """
+        Gets the response to request from the upstream fetch of an identical
+        request in progress, or starts one others can share. Returns None if
+        request is to be forwarded on its own. The response is stored in the
+        cache under cache_key, if given.
+        """
+        collapser = self._collapser
+        key = (collapser.get_key(request, hostname, port) if collapser is not None
+            else None)
+        if collapser is None or key is None:
+            return None
+
+        flight, reader, leader = collapser.join(key)
+        if leader:
+            collapser.start(key, flight,
+                self.run_flight(flight, request, hostname, port, cache_key))
+        else:
+            self._metrics.requests_collapsed.inc()
+            _LOGGER.debug("collapsed %s %s:%d%s", request.method, hostname, port,
+                request.url.path)
+        head, shareable = await asyncio.shield(flight.head)
+        if not leader and not shareable:
+            reader.close()
+            return None
 
-        if server_writer:
-            server_writer.close()
-            await server_writer.wait_closed()
+        response = HttpResponse(reader, request.method, self._body_store)
+        response.set_head(head)
+        return response
 
-        _LOGGER.debug("http_handler: done")
 
+    async def run_flight(
+        self,
+        flight: Flight,
+        request: HttpRequest,
+        hostname: str,
+        port: int,
+        cache_key: Optional[str]) -> None:
+        """Forwards request and reads the response into flight."""
+        connection = None
+        reusable = False
+        try:
+            with self._timers.deadline(self._options.read_timeout):
+                connection, response = await self.forward_request(request, hostname, port)
+                while response.is_informational():
+                    await response.read()
+                cache_writer = None
+                if cache_key is not None and self._cache is not None:
+                    self._cache.stats.misses += 1
+                    cache_writer = self._cache.start(request, response, cache_key)
+
+                # The body is passed on without its framing: attached requests
+                # send it as a body delimited by the end of the connection,
+                # rechunked for HTTP/1.1 clients
+                framing, length = response.get_body_framing()
+                if framing == BodyFraming.Chunked:
+                    response.headers.pop(TRANSFER_ENCODING, None)
+                assert self._collapser is not None
+                flight.set_head(response.get_head(),
+                    self._collapser.is_shareable(response))
+
+                async for data in iter_body_data(connection.reader, framing, length):
+                    touch()
+                    flight.feed(data)
+                    if cache_writer:
+                        cache_writer.write(data)
+                    while not flight.has_room():
+                        await flight.wait()
+                flight.finish()
+                reusable = (framing != BodyFraming.UntilClose
+                    and response.is_keep_alive())
+                if cache_writer and self._cache is not None:
+                    self._cache.store(request, cache_writer)
+        except asyncio.CancelledError as e:
+            flight.fail(e)
+            raise
+        except Exception as e:
+            _LOGGER.info("collapsed fetch of %s:%d%s failed: %r", hostname, port,
+                request.url.path, e)
+            flight.fail(e)
+        finally:
+            if connection:
+                self.release_connection(connection, reusable)
+
+
+    def match_upstream(
+        self, request: HttpRequest, hostname: str, port: int) -> Optional[UpstreamGroup]:
+        """The upstream group request is reverse proxied to, if any."""
+        if not len(self._upstreams):
+            return None
+        return self._upstreams.match(hostname, port, request.method,
+            request.url.path or "/")
+
+
+    def release_connection(self, connection: PooledConnection, reusable: bool) -> None:
+        """Returns a connection forward_request got to the pool."""
+        upstream = self._backends.pop(connection, None)
+        if upstream:
+            group, backend = upstream
+            group.end(backend)
+        if connection.tls is not None:
+            # A TLS 1.3 server only sends what's needed to resume once the
+            # handshake is over, so this session may be better than the last
+            self._tls.get(connection.tls).save_session(
+                connection.writer.get_extra_info("ssl_object"))
+        self._pool.release(connection, reusable)
+
+
+    async def forward_request(
+        self, request: HttpRequest, hostname: str, port: int
+        ) -> Tuple[PooledConnection, HttpResponse]:
+        """
+        Sends request to hostname:port, or to a backend of its upstream group,
+        and reads the response head. The connection is to be given back with
+        release_connection.
+        """
+        group = self.match_upstream(request, hostname, port)
+        if group is None:
+            tls = self._tls_profile if request.url.scheme == "https" else None
+            return await self.send_upstream(request, hostname, port, tls)
+
+        headers = request.headers
+        headers.add("X-Forwarded-For", request.clientip)
+        if "X-Forwarded-Host" not in headers and "Host" in headers:
+            headers["X-Forwarded-Host"] = headers["Host"]
+        # Requests that are safe to repeat are tried on another backend when
+        # one fails to answer
+        retry = (request.method in PIPELINED_METHODS
+            and request.get_body_framing()[0] == BodyFraming.NoBody)
+        tried: List[Backend] = []
+        while True:
+            backend = group.choose(tried)
+            started = group.begin(backend)
+            try:
+                connection, response = await self.send_upstream(request,
+                    backend.host, backend.port,
+                    (group.tls or self._tls_profile) if backend.tls else None)
+            except (OSError, asyncio.TimeoutError) as e:
+                group.end(backend)
+                if group.record(backend, started):
+                    self._metrics.backend_ejections.inc()
+                tried.append(backend)
+                if not retry or len(tried) >= len(group.backends):
+                    raise
+                _LOGGER.info("backend %r failed (%r), trying another", backend, e)
+                continue
+            except BaseException:
+                group.end(backend)
+                raise
+            if group.record(backend, started, response.response_code):
+                self._metrics.backend_ejections.inc()
+            self._backends[connection] = (group, backend)
+            return connection, response
+
+
+    async def send_upstream(
+        self, request: HttpRequest, hostname: str, port: int,
+        tls: Optional[TlsProfile] = None) -> Tuple[PooledConnection, HttpResponse]:
+
+        connection = await self._pool.acquire(hostname, port, tls=tls)
+        try:
+            try:
+                response = await self.send_request(request, connection)
+                if response.is_valid() or not connection.reused:
+                    return connection, response
+            except ConnectionError:
+                if not connection.reused:
+                    raise
+
+            # The server closed the pooled connection before we got a response.
+            # Retry on a fresh connection if we can still replay the request.
+            if request.get_body_framing()[0] != BodyFraming.NoBody:
+                raise ConnectionResetError("pooled connection closed by server")
+        except BaseException:
+            self._pool.release(connection, reusable=False)
+            raise
+
+        _LOGGER.debug("pooled connection to %s:%d went stale, reconnecting",
+            hostname, port)
+        self._pool.release(connection, reusable=False)
+        connection = await self._pool.acquire(hostname, port, fresh=True, tls=tls)
+        try:
+            return connection, await self.send_request(request, connection)
+        except BaseException:
+            self._pool.release(connection, reusable=False)
+            raise
+
+
+    async def relay_response(
+        self,
+        request: HttpRequest,
+        proxy_action: ProxyServerAction,
+        response: HttpResponse,
+        client_writer: StreamWriter,
+        cache_writer: Optional[CacheWriter] = None,
+        callback: Optional[ProxyServerCallback] = None) -> Tuple[bool, bool]:
+        """
+        Gives the callback a chance to look at (or provide) the response and
+        sends it to the client. Returns whether the client connection can be
+        kept alive and whether the server connection can be reused afterwards.
+        The response is stored in the cache through cache_writer, unless the
+        callback changed it.
+        """
+
+        _LOGGER.debug("<<< response phase <<<")
+
+        # Interim responses (e.g. 100 Continue) go straight to the client
+        metrics = self._metrics
+        while response.is_informational():
+            head = response.get_head()
+            client_writer.write(head)
+            metrics.bytes_to_client.inc(len(head))
+            await client_writer.drain()
+            await response.read()
+
+        # It only really makes sense to read a response from the server if
+        # we forwarded the request up to the server in the first place. If
+        # we have suppressed the request, the only option we have is to give
+        # the callback an opportunity to provide one.
+        upstream_framing, _ = response.get_body_framing()
+        recording = None
+        if (self._recorder and proxy_action == ProxyServerAction.Forward
+            and response.is_valid() and response.is_body_from_reader()):
+            # What upstream sent, before the callback has a go at it
+            recording = CacheWriter("", response.get_head(), (),
+                len(response.get_head()) + self._options.record_max_body)
+        if callback:
+            callback_start = time.perf_counter()
+            await self.call_response_hook(callback, proxy_action, request, response)
+            metrics.response_callback_seconds.observe(
+                time.perf_counter() - callback_start)
+
+        # Check if the callback provided a proper response. If nothing was
+        # provided, respond with 500 Internal Error back to the client.
+        if not response.is_valid():
+            _LOGGER.error("invalid response from callback. "
+                "Sending internal error (500) to client.")
+
+            response.http_version = request.version
+            response.response_code = 500
+            response.response_text = "Internal Error"
+            response.set_body("""
+            <html>
+                <title>Internal Application Error</title>
+                <body>
+                    <h1>pyProxy Application Error</h1>
+                    <p>The application callback did not provide a valid HTTP
+                    response after suppressing a request.</p>
+                </body>
+            </html>""".encode())
+
+        if self._draining:
+            response.headers[CONNECTION] = "close"
+        if cache_writer and (response.body_transform
+            or response.get_head() != cache_writer.head):
+            cache_writer = None
+        # The cache keeps the uncompressed body, to be compressed again for
+        # each client that accepts it
+        if self._compressor and self._compressor.apply(request, response):
+            metrics.responses_compressed.inc()
+
+        # A body delimited by the server closing the connection would force us
+        # to close the client connection as well, unless we chunk it ourselves
+        framing, length = response.get_body_framing()
+        rechunk = (framing == BodyFraming.UntilClose
+            and request.version != "HTTP/1.0")
+        if rechunk:
+            response.set_chunked()
+        elif (response.body_transform and framing == BodyFraming.Chunked
+            and request.version == "HTTP/1.0"):
+            # HTTP/1.0 clients don't know chunked: close the connection instead
+            response.headers.pop(TRANSFER_ENCODING, None)
+            framing = BodyFraming.UntilClose
+
+        # Send the response line and headers back to the client unaltered
+        head = response.get_head()
+        _LOGGER.debug("sending to client: %s", head)
+        client_writer.write(head)
+        await client_writer.drain()
+
+        # For responses that have a body, send the body next
+        sinks = [writer.write for writer in (cache_writer, recording) if writer]
+
+        def sink(data: bytes) -> None:
+            for write in sinks:
+                write(data)
+
+        sent = await self.send_body(response, client_writer, framing, length,
+            rechunk=rechunk, prefix="<=", sink=sink if sinks else None)
+        response.bytes_sent = len(head) + sent
+        metrics.bytes_to_client.inc(response.bytes_sent)
+        if cache_writer and self._cache is not None:
+            self._cache.store(request, cache_writer)
+        if (recording and self._recorder and not recording.overflowed
+            and response.is_body_from_reader()):
+            hostname, port = self.get_proxy_target(request)
+            entry = recording.get_entry()
+            self._recorder.record(recording_key(request, hostname, port,
+                self._options.record_key_headers), entry.head, entry.body)
+
+        reusable = (upstream_framing != BodyFraming.UntilClose
+            and response.is_body_from_reader())
+        if response.response_code == 101:
+            # We don't relay upgraded protocols
+            return False, False
+        return framing != BodyFraming.UntilClose or rechunk, reusable
 
-    async def https_handler(
-        self, reader: StreamReader, writer: StreamWriter, request: HttpRequest) -> None:
 
-        remote_reader, remote_writer = await asyncio.open_connection(
+    async def https_handler(
+        self, reader: StreamReader, writer: StreamWriter, request: HttpRequest
+        ) -> Tuple[int, int]:
+        """
+        Tunnels a CONNECT request. Returns the number of bytes relayed
+        upstream and to the client.
+        """
+        if self._options.relay_engine == RelayEngine.Protocol:
+            return await self.https_relay_handler(reader, writer, request)
+
+        assert request.url.hostname and request.url.port
+        remote_reader, remote_writer = await self.open_connection(
             request.url.hostname, request.url.port)
         with closing(remote_writer):
             writer.write(b"HTTP/1.1 200 Connection Established\r\n\r\n")
             await writer.drain()
             _LOGGER.debug("HTTPS connection established")
 
-            await self.connect_streams((reader, writer), (remote_reader, remote_writer))
+            local_stream = (reader, writer)
+            remote_stream = (remote_reader, remote_writer)
+            sent = await run_tunnel(local_stream, remote_stream,
+                self._options.tunnel_mode)
+            if sent is None:
+                sent = await self.connect_streams(local_stream, remote_stream)
+        self._metrics.bytes_to_upstream.inc(sent[0])
+        self._metrics.bytes_to_client.inc(sent[1])
+        return sent
+
+
+    async def https_relay_handler(
+        self, reader: StreamReader, writer: StreamWriter, request: HttpRequest
+        ) -> Tuple[int, int]:
+
+        assert request.url.hostname and request.url.port
+        sock = await self.connect(request.url.hostname, request.url.port)
+        try:
+            relay = await open_relay(request.url.hostname, request.url.port,
+                self._buffers, self._options.relay_high_watermark,
+                self._options.relay_low_watermark, sock=sock)
+        except BaseException:
+            sock.close()
+            raise
+        try:
+            writer.write(b"HTTP/1.1 200 Connection Established\r\n\r\n")
+            await writer.drain()
+            _LOGGER.debug("HTTPS connection established (protocol relay)")
+
+            attach_local(relay, (reader, writer))
+        except BaseException:
+            relay.close()
+            raise
+
+        deadline = current_deadline()
+        if deadline:
+            # The relay moves data in protocol callbacks, outside this task
+            deadline.watch(
+                lambda: relay.local.bytes_received + relay.remote.bytes_received)
+        sent = await relay.wait()
+        self._metrics.bytes_to_upstream.inc(sent[0])
+        self._metrics.bytes_to_client.inc(sent[1])
+        return sent
 
 
     async def connection_handler(self, reader: StreamReader, writer: StreamWriter) -> None:
-        async def session() -> None:
-            addr = writer.get_extra_info('peername')
-            _LOGGER.debug("connection from %s", addr.__repr__())
+        addr = writer.get_extra_info('peername')
+        _LOGGER.debug("connection from %r", addr)
 
-            try:
-                async with async_timeout.timeout(30):
-                    with closing(writer):
-                        await self.http_handler(addr, reader, writer)
-            except asyncio.IncompleteReadError as e:
-                _LOGGER.debug("incomplete read: expected %dbytes, got %d bytes",
-                    e.expected, len(e.partial))
-            except asyncio.TimeoutError:
-                _LOGGER.debug("timeout")
+        self._metrics.connections_accepted.inc()
+        self._metrics.connections_active.inc()
+        try:
+            with self._timers.deadline(self._options.header_timeout), \
+                closing(writer):
+                await self.http_handler(addr, reader, writer)
+        except asyncio.IncompleteReadError as e:
+            _LOGGER.debug("incomplete read: expected %dbytes, got %d bytes",
+                e.expected, len(e.partial))
+        except asyncio.TimeoutError:
+            _LOGGER.debug("timeout")
+        finally:
+            self._metrics.connections_active.dec()
 
-            _LOGGER.debug("connection closed")
+        _LOGGER.debug("connection closed")
 
-        asyncio.create_task(session(), name="session")
 
+    async def serve_connection(self, sock: socket.socket, ip: str) -> None:
+        try:
+            reader, writer = await asyncio.open_connection(sock=sock)
+            await self.connection_handler(reader, writer)
+        finally:
+            self._admission.release(ip)
 
-    async def run(self) -> None:
-        self._server = await asyncio.start_server(
-            self.connection_handler, self._proxy_address, self._proxy_port)
-        addr = self._server.sockets[0].getsockname()
-        _LOGGER.debug("serving on %s", addr)
 
-        async with self._server:
-            await self._server.serve_forever()
+    async def accept_connections(self, listener: socket.socket) -> None:
+        loop = asyncio.get_running_loop()
+        admission = self._admission
+        while True:
+            # Leave connections in the backlog while at the limit
+            if admission.is_full():
+                _LOGGER.debug("at %d connections, pausing accept", admission.active)
+            await admission.wait_for_room()
+            try:
+                sock, addr = await loop.sock_accept(listener)
+            except OSError as e:
+                if isinstance(e, ConnectionAbortedError):
+                    continue
+                if e.errno not in RESOURCE_ERRORS:
+                    raise
+                _LOGGER.warning("accept failed (%s), retrying in %.1fs", e,
+                    ACCEPT_RETRY_DELAY)
+                await asyncio.sleep(ACCEPT_RETRY_DELAY)
+                continue
+
+            ip = addr[0]
+            if not admission.try_reserve():
+                # Another listener took the last slot while this one waited
+                _LOGGER.debug("at %d connections, turning %s away", admission.active, ip)
+                self._metrics.connections_rejected.inc()
+                reject(sock)
+                continue
+            if not admission.admit(ip):
+                _LOGGER.debug("too many connections from %s", ip)
+                self._metrics.connections_rejected.inc()
+                reject(sock)
+                continue
+            self._sessions.spawn(self.serve_connection(sock, ip), name="session")
+
+
+    async def run(self) -> None:
+        self._resolver = CachingResolver(self._base_resolver,
+            positive_ttl=self._options.dns_positive_ttl,
+            negative_ttl=self._options.dns_negative_ttl)
+        self._pool = ConnectionPool(
+            max_idle=self._options.pool_max_idle,
+            idle_ttl=self._options.pool_idle_ttl,
+            max_per_host=self._options.pool_max_per_host,
+            connector=self.open_connection)
+        self._tls = TlsContexts(self._options.tls_session_cache_size)
+        self._tls_profile = TlsProfile(self._options.upstream_tls_verify,
+            self._options.upstream_tls_ca_file, self._options.upstream_tls_cert_file,
+            self._options.upstream_tls_key_file)
+        self._buffers = BufferPool(self._options.relay_buffer_size)
+        # Ticks fine enough for the shortest timeout to come out about right
+        timeouts = (self._options.header_timeout, self._options.idle_timeout,
+            self._options.read_timeout)
+        self._timers = TimerWheel(min([self._options.timer_resolution]
+            + [timeout / CHECKS for timeout in timeouts if timeout > 0]))
+        self._body_store = BodyStore(self._options.body_spill_threshold,
+            self._options.body_memory_budget, self._options.body_spool_dir)
+        self._callback_pool = CallbackPool(self._options.callback_threads,
+            self._options.callback_concurrency)
+        if self._options.access_log:
+            self._access_log = AccessLog(self._options.access_log,
+                self._options.access_log_format, self._options.access_log_sample_rate,
+                self._options.access_log_max_bytes, self._options.access_log_backups,
+                self._options.access_log_buffer)
+            self._access_log.start()
+        mode = RecordMode(self._options.record_mode)
+        if mode != RecordMode.Off:
+            if not self._options.record_file:
+                raise ValueError(f"record_mode {mode.value} needs a record_file")
+            if mode == RecordMode.Record:
+                self._recorder = Recorder(RecordingStore(self._options.record_file,
+                    writable=True), self._options.record_max_pending)
+                self._recorder.start()
+            else:
+                self._replay_store = RecordingStore(self._options.record_file)
+        if self._options.compression:
+            self._compressor = ResponseCompressor(self._options.compression_min_size,
+                self._options.compression_types, self._options.compression_threads)
+        if self._options.collapse_forwarding:
+            self._collapser = Collapser(self._options.collapse_key_headers,
+                self._options.collapse_exclude_headers, self._options.collapse_max_buffer)
+        if self._options.cache_max_bytes > 0:
+            self._cache = ResponseCache(self._options.cache_max_bytes,
+                self._options.cache_max_entry_bytes)
+        if self._options.admin_port:
+            self._admin_server = await start_admin_server(self._metrics,
+                self._options.admin_address, self._options.admin_port,
+                reuse_port=self._options.reuse_port or None)
+        self._admission = AdmissionControl(self._options.max_connections,
+            self._options.max_connections_per_ip)
+        self._closed = self._draining = False
+        self._listeners = await bind(self._proxy_address, self._proxy_port,
+            self._options.listen_backlog, self._options.reuse_port)
+        addr = self._listeners[0].getsockname()
+        _LOGGER.debug("serving on %s (%s event loop)", addr,
+            type(asyncio.get_running_loop()).__module__)
+        self._started.set()
+
+        accepting = [self._accepting.spawn(self.accept_connections(listener),
+            name="accept") for listener in self._listeners]
+        try:
+            await asyncio.gather(*accepting)
+        except asyncio.CancelledError:
+            # close() stops the accept loops; anything else is a cancellation
+            # of run() itself
+            if not self._closed:
+                raise
+        finally:
+            self._started.clear()
+            await self._accepting.cancel()
+            for listener in self._listeners:
+                listener.close()
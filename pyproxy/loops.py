@@ -0,0 +1,73 @@
+"""
+Event loop implementations
+
+Entry points that start their own event loop (python -m pyproxy,
+WorkerSupervisor and ProxyServer.run_forever) use the implementation chosen
+with the event_loop option: the standard asyncio loop or uvloop. "auto" picks
+uvloop when it's installed and falls back to asyncio otherwise.
+"""
+
+import asyncio
+from enum import Enum
+import logging
+import sys
+from typing import Any, Callable, Coroutine, TypeVar
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None  # type: ignore[assignment]
+
+_LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+LoopFactory = Callable[[], asyncio.AbstractEventLoop]
+
+
+class EventLoop(str, Enum):
+    Auto = "auto"
+    Asyncio = "asyncio"
+    Uvloop = "uvloop"
+
+
+def uvloop_available() -> bool:
+    return uvloop is not None
+
+
+def loop_factory(kind: str = EventLoop.Auto) -> LoopFactory:
+    """Creates event loops of the given kind, or the closest available."""
+    kind = EventLoop(kind)
+    if kind != EventLoop.Asyncio:
+        if uvloop is not None:
+            return uvloop.new_event_loop  # type: ignore[no-any-return]
+        if kind == EventLoop.Uvloop:
+            _LOGGER.warning("uvloop is not installed, using the asyncio event loop")
+    return asyncio.new_event_loop
+
+
+def _cancel_all_tasks(loop: asyncio.AbstractEventLoop) -> None:
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
+def run(main: Coroutine[Any, Any, T], kind: str = EventLoop.Auto) -> T:
+    """Like asyncio.run(main), on an event loop of the given kind."""
+    factory = loop_factory(kind)
+    if sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=factory) as runner:
+            return runner.run(main)
+
+    loop = factory()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(main)
+    finally:
+        try:
+            _cancel_all_tasks(loop)
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
@@ -0,0 +1,281 @@
+"""
+Proxy metrics: counters, gauges and histograms, rendered in the Prometheus
+text exposition format
+
+Metrics are plain objects created up front, so recording is an attribute
+lookup and an addition: no labels are resolved and nothing is allocated per
+observation.
+"""
+
+import asyncio
+from asyncio.streams import StreamReader, StreamWriter
+from bisect import bisect_left
+import logging
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+_LOGGER = logging.getLogger(__name__)
+
+# Latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+    0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = labels + (extra,) if extra else labels
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = ""
+
+    __slots__ = ("name", "help", "labels")
+
+    def __init__(self, name: str, help: str, labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.help = help
+        self.labels: Labels = tuple(labels.items()) if labels else ()
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """(name suffix, formatted labels, value) for each exposed sample."""
+        raise NotImplementedError()
+
+    def snapshot(self) -> Any:
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    __slots__ = ("value",)
+
+    def __init__(self, name: str, help: str, labels: Optional[Dict[str, str]] = None):
+        super().__init__(name, help, labels)
+        # Gauges can be set to fractional values
+        self.value: Union[int, float] = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        return [("", _format_labels(self.labels), self.value)]
+
+    def snapshot(self) -> Union[int, float]:
+        return self.value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    __slots__ = ()
+
+    def dec(self, amount: int = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: Union[int, float]) -> None:
+        self.value = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        labels: Optional[Dict[str, str]] = None):
+
+        super().__init__(name, help, labels)
+        self.bounds = tuple(sorted(buckets))
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        samples: List[Tuple[str, str, float]] = []
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            samples.append(("_bucket",
+                _format_labels(self.labels, ("le", _format_value(float(bound)))),
+                total))
+        labels = _format_labels(self.labels)
+        samples.append(("_sum", labels, self.sum))
+        samples.append(("_count", labels, self.count))
+        return samples
+
+    def snapshot(self) -> Dict[str, Any]:
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return { "buckets": dict(zip(self.bounds + (float("inf"),), cumulative)),
+            "sum": self.sum, "count": self.count }
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    def __iter__(self):  # type: ignore[no-untyped-def]
+        return iter(self._metrics)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        described = set()
+        for metric in self._metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Current values by metric name. Metrics with labels are nested under
+        their label values, e.g. snapshot()["name"]["label value"].
+        """
+        result: Dict[str, Any] = { }
+        for metric in self._metrics:
+            value = metric.snapshot()
+            if metric.labels:
+                nested = result.setdefault(metric.name, { })
+                nested[",".join(v for _, v in metric.labels)] = value
+            else:
+                result[metric.name] = value
+        return result
+
+
+class ProxyMetrics(MetricsRegistry):
+    """The metrics an HttpServer records."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        r = self.register
+        self.connections_accepted: Counter = r(Counter(
+            "pyproxy_connections_accepted_total", "Client connections accepted"))
+        self.connections_active: Gauge = r(Gauge(
+            "pyproxy_connections_active", "Client connections currently open"))
+        self.connections_rejected: Counter = r(Counter(
+            "pyproxy_connections_rejected_total",
+            "Client connections turned away for being over the connection limit "
+            "or the per-address limit"))
+        self.requests: Counter = r(Counter(
+            "pyproxy_requests_total", "Requests received from clients"))
+        self.tunnels: Counter = r(Counter(
+            "pyproxy_tunnels_total", "CONNECT tunnels established"))
+        self.tunnels_active: Gauge = r(Gauge(
+            "pyproxy_tunnels_active", "CONNECT tunnels currently open"))
+        self.responses_compressed: Counter = r(Counter(
+            "pyproxy_responses_compressed_total",
+            "Responses compressed on the way to the client"))
+        self.backend_ejections: Counter = r(Counter(
+            "pyproxy_backend_ejections_total",
+            "Reverse proxy backends taken out of rotation for failing"))
+        self.requests_collapsed: Counter = r(Counter(
+            "pyproxy_requests_collapsed_total",
+            "Requests served from another request's upstream fetch"))
+        self.responses_replayed: Counter = r(Counter(
+            "pyproxy_responses_replayed_total",
+            "Responses served from a recording"))
+        self.replay_misses: Counter = r(Counter(
+            "pyproxy_replay_misses_total",
+            "Requests with no response recorded for them in replay mode"))
+        self.upstream_tls_handshakes: Counter = r(Counter(
+            "pyproxy_upstream_tls_handshakes_total",
+            "TLS handshakes with upstream servers"))
+        self.upstream_tls_resumed: Counter = r(Counter(
+            "pyproxy_upstream_tls_resumed_total",
+            "TLS handshakes with upstream servers that resumed an earlier session"))
+        self.upstream_errors: Counter = r(Counter(
+            "pyproxy_upstream_connect_errors_total",
+            "Failed attempts to connect upstream"))
+
+        self.first_request_seconds: Histogram = r(Histogram(
+            "pyproxy_first_request_seconds",
+            "Time from accepting a connection to having its first request head"))
+        self.request_callback_seconds: Histogram = r(Histogram(
+            "pyproxy_callback_seconds", "Time spent in callbacks",
+            labels={ "callback": "on_new_request_async" }))
+        self.response_callback_seconds: Histogram = r(Histogram(
+            "pyproxy_callback_seconds", "Time spent in callbacks",
+            labels={ "callback": "on_new_response_async" }))
+        self.upstream_connect_seconds: Histogram = r(Histogram(
+            "pyproxy_upstream_connect_seconds",
+            "Time to resolve and connect to upstream servers"))
+        self.time_to_first_byte_seconds: Histogram = r(Histogram(
+            "pyproxy_time_to_first_byte_seconds",
+            "Time from sending a request upstream to having the response head"))
+
+        self.bytes_to_upstream: Counter = r(Counter(
+            "pyproxy_relayed_bytes_total", "Bytes relayed, heads included",
+            labels={ "direction": "client_to_upstream" }))
+        self.bytes_to_client: Counter = r(Counter(
+            "pyproxy_relayed_bytes_total", "Bytes relayed, heads included",
+            labels={ "direction": "upstream_to_client" }))
+
+
+async def _admin_handler(
+    registry: MetricsRegistry, reader: StreamReader, writer: StreamWriter) -> None:
+
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+        method, target = head.split(b" ", 2)[:2]
+        if method in (b"GET", b"HEAD") and target.split(b"?")[0] == b"/metrics":
+            body = registry.render().encode()
+            status = b"200 OK"
+            content_type = CONTENT_TYPE.encode()
+        else:
+            body = b"not found\n"
+            status = b"404 Not Found"
+            content_type = b"text/plain"
+
+        writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: " + content_type +
+            b"\r\nContent-Length: " + str(len(body)).encode() +
+            b"\r\nConnection: close\r\n\r\n")
+        if method != b"HEAD":
+            writer.write(body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+        ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_admin_server(
+    registry: MetricsRegistry, address: str, port: int, **kwargs: Any
+    ) -> asyncio.Server:
+    """Serves registry.render() at /metrics on address:port."""
+    server = await asyncio.start_server(
+        lambda r, w: _admin_handler(registry, r, w), address, port, **kwargs)
+    _LOGGER.debug("serving metrics on %s", server.sockets[0].getsockname())
+    return server
@@ -0,0 +1,120 @@
+"""
+Ordered responses for pipelined requests
+
+HTTP/1.1 clients may send several requests without waiting for the responses,
+which must then come back in the order the requests were sent. A
+ResponsePipeline lets the work for each request (callbacks, the upstream
+round trip) run concurrently as a task while a single sender sends the
+results back one at a time, in order.
+"""
+
+import asyncio
+from collections import deque
+import logging
+from typing import Awaitable, Callable, Deque, Generic, Optional, TypeVar
+
+_LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ResponsePipeline(Generic[T]):
+    """
+    Exchanges (tasks producing a T) are sent with send, in the order they're
+    added. send returns whether to carry on; once it returns False or raises,
+    the pipeline is closed and on_stop is called. Exchanges that are never
+    sent are passed to discard (if they completed) so they can clean up.
+    """
+
+    def __init__(
+        self,
+        depth: int,
+        send: Callable[[T], Awaitable[bool]],
+        discard: Callable[[T], None],
+        on_stop: Optional[Callable[[], None]] = None):
+
+        self.depth = max(depth, 1)
+        self._send = send
+        self._discard = discard
+        self._on_stop = on_stop
+        self._exchanges: Deque["asyncio.Task[T]"] = deque()
+        self._sender: Optional["asyncio.Task[None]"] = None
+        self._progress = asyncio.Event()
+        self._error: Optional[BaseException] = None
+        self.closed = False
+
+    def __len__(self) -> int:
+        """The number of exchanges still to be sent."""
+        return len(self._exchanges)
+
+    async def _wait_progress(self) -> None:
+        self._progress.clear()
+        await self._progress.wait()
+
+    def _check(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    async def put(self, exchange: "asyncio.Task[T]") -> None:
+        """Queues exchange, after waiting for room if the pipeline is full."""
+        while len(self._exchanges) >= self.depth and not self.closed:
+            await self._wait_progress()
+        if self.closed:
+            # Nobody will send it, so don't leave it running
+            exchange.cancel()
+            self._check()
+            return
+
+        self._exchanges.append(exchange)
+        if self._sender is None:
+            self._sender = asyncio.create_task(self._run(), name="sender")
+
+    async def drain(self) -> None:
+        """Waits for everything queued to be sent."""
+        while self._exchanges and not self.closed:
+            await self._wait_progress()
+        self._check()
+
+    async def _run(self) -> None:
+        try:
+            while self._exchanges:
+                result = await self._exchanges[0]
+                self._exchanges.popleft()
+                self._progress.set()
+                if not await self._send(result):
+                    self._stop()
+                    break
+        except asyncio.CancelledError:
+            self._stop()
+            raise
+        except BaseException as e:
+            _LOGGER.debug("sending pipelined response failed: %r", e)
+            self._error = e
+            self._stop()
+        finally:
+            self._sender = None
+
+    def _stop(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self._progress.set()
+            if self._on_stop:
+                self._on_stop()
+
+    async def close(self) -> None:
+        """Stops sending and cleans up whatever was left unsent."""
+        self.closed = True
+        self._progress.set()
+        exchanges = list(self._exchanges)
+        self._exchanges.clear()
+        sender = self._sender
+        for task in (*exchanges, *([sender] if sender else [])):
+            task.cancel()
+        if sender is not None:
+            await asyncio.gather(sender, return_exceptions=True)
+        results = await asyncio.gather(*exchanges, return_exceptions=True)
+        for result in results:
+            # Exchanges that were cancelled or failed cleaned up after
+            # themselves
+            if not isinstance(result, BaseException):
+                self._discard(result)
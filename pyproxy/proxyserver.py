@@ -1,22 +1,75 @@
-from typing import Any, Union
+from typing import Any, Iterable, Optional, Union
 
+from .cache import ResponseCache
 from .callback import ProxyServerCallback
-from .httpserver import HttpServer
+from .httpserver import HttpServer, HttpServerOptions
+from .loops import run
+from .metrics import ProxyMetrics
+from .resolver import Resolver
+from .tls import TlsProfile
+from .upstreams import BalanceMethod, UpstreamGroup
 
 
 class ProxyServer:
     def __init__(self, address: str, port: int):
         self._server = HttpServer(address, port)
 
-    def register_callback(self, callback: ProxyServerCallback) -> None:
-        self._server.register_callback(callback)
+    @property
+    def cache(self) -> Optional[ResponseCache]:
+        return self._server.cache
+
+    @property
+    def metrics(self) -> ProxyMetrics:
+        return self._server.metrics
+
+    @property
+    def options(self) -> HttpServerOptions:
+        return self._server.options
+
+    @property
+    def port(self) -> int:
+        return self._server.port
+
+    async def wait_started(self) -> None:
+        await self._server.wait_started()
+
+    def register_callback(
+        self,
+        callback: ProxyServerCallback,
+        hosts: Optional[Iterable[str]] = None,
+        paths: Optional[Iterable[str]] = None,
+        methods: Optional[Iterable[str]] = None,
+        ports: Optional[Iterable[int]] = None) -> None:
+
+        self._server.register_callback(callback, hosts, paths, methods, ports)
+
+    def register_upstream(
+        self,
+        backends: Iterable[str],
+        hosts: Optional[Iterable[str]] = None,
+        paths: Optional[Iterable[str]] = None,
+        methods: Optional[Iterable[str]] = None,
+        balance: str = BalanceMethod.LeastOutstanding,
+        max_fails: int = 3,
+        eject_time: float = 10.0,
+        tls: Optional[TlsProfile] = None) -> UpstreamGroup:
+
+        return self._server.register_upstream(backends, hosts, paths, methods,
+            balance, max_fails, eject_time, tls)
+
+    def set_resolver(self, resolver: Resolver) -> None:
+        self._server.set_resolver(resolver)
 
     def set_options(self, **kwargs: Any) -> None:
         self._server.set_options(**kwargs)
 
-    async def close(self) -> None:
+    async def close(self, drain_timeout: float = 0.0) -> None:
         if self._server:
-            await self._server.close()
+            await self._server.close(drain_timeout)
 
     async def run(self) -> None:
         await self._server.run()
+
+    def run_forever(self) -> None:
+        """Runs the server on an event loop of its own, per the event_loop option."""
+        run(self.run(), self.options.event_loop)
@@ -0,0 +1,330 @@
+"""
+Recorded responses, for replaying without the network
+
+A RecordingStore is an append-only data file of (key, response head, body)
+entries, plus an index in a second file (path + ".idx"): an open addressing
+hash table of (key hash, entry offset) slots that is memory-mapped, so a
+lookup reads a slot or two and then the entry itself, however many entries
+there are. Entries recorded later under the same key replace earlier ones.
+
+The index records how much of the data file it covers. Entries past that
+point (say, after a crash) are indexed again when the store is opened, and a
+torn entry at the end is cut off.
+
+A Recorder sits between the server and the store: recording only queues the
+entry, and a background task appends queued entries in batches from a worker
+thread. At most max_pending bytes of entries are queued; when responses come
+in faster than they're written, the ones that don't fit are dropped, counted
+and logged.
+"""
+
+import asyncio
+from enum import Enum
+import hashlib
+import logging
+import mmap
+import os
+import struct
+from typing import BinaryIO, Iterable, List, Optional, Tuple
+
+from .httprequest import HttpRequest
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_MAGIC = b"PXRD\x01\0\0\0"
+INDEX_MAGIC = b"PXRI\x01\0\0\0"
+# Lengths of an entry's key, head and body, which follow
+_ENTRY = struct.Struct("<IIQ")
+# Magic, slot count, entry count, data file bytes indexed
+_INDEX_HEADER = struct.Struct("<8sQQQ")
+# Key hash, entry offset + 1 (0 for an empty slot)
+_SLOT = struct.Struct("<QQ")
+
+INITIAL_SLOTS = 1024
+FLUSH_INTERVAL = 0.1
+MAX_PENDING = 64 * 1024 * 1024
+
+Entry = Tuple[bytes, bytes, bytes]
+
+
+class RecordMode(str, Enum):
+    Off = "off"
+    Record = "record"
+    Replay = "replay"
+
+
+def key_hash(key: bytes) -> int:
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+def recording_key(
+    request: HttpRequest, hostname: str, port: int, headers: Iterable[str] = ()
+    ) -> bytes:
+    """
+    What a response is recorded under: the request method, scheme, target
+    and the values of the given request header fields.
+    """
+    url = request.url
+    target = f"{url.path or '/'}?{url.query}" if url.query else url.path or "/"
+    lines = [request.method, f"{url.scheme or 'http'}://{hostname}:{port}", target]
+    lines.extend(f"{name.lower()}:{','.join(request.headers.get_all(name))}"
+        for name in headers)
+    return "\n".join(lines).encode()
+
+
+class RecordingStore:
+    """
+    Recorded responses in the file at path, opened for appending if writable
+    and read-only (and memory-mapped) otherwise.
+    """
+
+    def __init__(self, path: str, writable: bool = False):
+        self.path = path
+        self.writable = writable
+        self._data: BinaryIO = open(path, "a+b" if writable else "rb")
+        self._data_map: Optional[mmap.mmap] = None
+        self._index_file: Optional[BinaryIO] = None
+        self._index: mmap.mmap
+        try:
+            self._open()
+        except BaseException:
+            self._data.close()
+            raise
+
+    def _open(self) -> None:
+        size = os.fstat(self._data.fileno()).st_size
+        if size == 0 and self.writable:
+            self._data.write(DATA_MAGIC)
+            self._data.flush()
+            size = len(DATA_MAGIC)
+        self._data.seek(0)
+        if self._data.read(len(DATA_MAGIC)) != DATA_MAGIC:
+            raise ValueError(f"{self.path} is not a recording")
+
+        self._open_index()
+        indexed = self._header()[3]
+        if indexed > size:
+            # The data file isn't the one this index was built for
+            self._new_index(INITIAL_SLOTS)
+            indexed = len(DATA_MAGIC)
+        if not self.writable:
+            self._data_map = mmap.mmap(self._data.fileno(), 0, access=mmap.ACCESS_READ)
+        self._catch_up(indexed, size)
+
+    def _open_index(self) -> None:
+        path = self.path + ".idx"
+        if self.writable:
+            exists = os.path.exists(path)
+            self._index_file = open(path, "r+b" if exists else "w+b")
+            if exists and os.fstat(self._index_file.fileno()).st_size >= _INDEX_HEADER.size:
+                self._index = mmap.mmap(self._index_file.fileno(), 0)
+                if self._header()[0] == INDEX_MAGIC:
+                    return
+                self._index.close()
+        elif os.path.exists(path):
+            with open(path, "rb") as index_file:
+                # A private copy: read-only stores may still need to index
+                # entries the index doesn't cover
+                self._index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_COPY)
+            if len(self._index) >= _INDEX_HEADER.size and self._header()[0] == INDEX_MAGIC:
+                return
+            self._index.close()
+        self._new_index(INITIAL_SLOTS)
+
+    def _new_index(self, slots: int) -> None:
+        size = _INDEX_HEADER.size + slots * _SLOT.size
+        if self._index_file is not None:
+            self._index_file.truncate(0)
+            self._index_file.truncate(size)
+            self._index = mmap.mmap(self._index_file.fileno(), size)
+        else:
+            self._index = mmap.mmap(-1, size)
+        _INDEX_HEADER.pack_into(self._index, 0, INDEX_MAGIC, slots, 0, len(DATA_MAGIC))
+
+    def _header(self) -> Tuple[bytes, int, int, int]:
+        return _INDEX_HEADER.unpack_from(self._index, 0)  # type: ignore[return-value]
+
+    def _set_header(self, count: int, indexed: int) -> None:
+        _, slots, _, _ = self._header()
+        _INDEX_HEADER.pack_into(self._index, 0, INDEX_MAGIC, slots, count, indexed)
+
+    def __len__(self) -> int:
+        return self._header()[2]
+
+    def _read(self, offset: int, size: int) -> bytes:
+        if self._data_map is not None:
+            return self._data_map[offset:offset + size]
+        return os.pread(self._data.fileno(), size, offset)
+
+    def _read_entry(self, offset: int, body: bool = True) -> Entry:
+        """The entry at offset, with an empty body if body is False."""
+        key_length, head_length, body_length = _ENTRY.unpack(
+            self._read(offset, _ENTRY.size))
+        length = key_length + head_length + (body_length if body else 0)
+        data = self._read(offset + _ENTRY.size, length)
+        return (data[:key_length], data[key_length:key_length + head_length],
+            data[key_length + head_length:])
+
+    def _catch_up(self, offset: int, size: int) -> None:
+        """Indexes the entries from offset to size."""
+        count = len(self)
+        while offset + _ENTRY.size <= size:
+            key_length, head_length, body_length = _ENTRY.unpack(
+                self._read(offset, _ENTRY.size))
+            end = offset + _ENTRY.size + key_length + head_length + body_length
+            if end > size:
+                break
+            key = self._read(offset + _ENTRY.size, key_length)
+            count += self._insert(key_hash(key), offset, key)
+            offset = end
+            self._set_header(count, offset)
+
+        if offset < size:
+            _LOGGER.warning("%s: ignoring %d bytes of incomplete entry at %d",
+                self.path, size - offset, offset)
+            if self.writable:
+                self._data.truncate(offset)
+
+    def _insert(self, hash: int, offset: int, key: bytes) -> int:
+        """Points key's slot at offset. Returns 1 for a new key, 0 otherwise."""
+        _, slots, count, _ = self._header()
+        if (count + 1) * 2 > slots:
+            self._grow(slots * 2)
+            slots *= 2
+        mask = slots - 1
+        slot = hash & mask
+        while True:
+            position = _INDEX_HEADER.size + slot * _SLOT.size
+            slot_hash, slot_offset = _SLOT.unpack_from(self._index, position)
+            if slot_offset == 0 or (slot_hash == hash
+                    and self._read_entry(slot_offset - 1, body=False)[0] == key):
+                _SLOT.pack_into(self._index, position, hash, offset + 1)
+                return 1 if slot_offset == 0 else 0
+            slot = (slot + 1) & mask
+
+    def _grow(self, slots: int) -> None:
+        _, old_slots, count, indexed = self._header()
+        used = [_SLOT.unpack_from(self._index, _INDEX_HEADER.size + n * _SLOT.size)
+            for n in range(old_slots)]
+        self._index.close()
+        self._new_index(slots)
+        mask = slots - 1
+        for hash, offset in used:
+            if not offset:
+                continue
+            slot = hash & mask
+            while _SLOT.unpack_from(self._index, _INDEX_HEADER.size + slot * _SLOT.size)[1]:
+                slot = (slot + 1) & mask
+            _SLOT.pack_into(self._index, _INDEX_HEADER.size + slot * _SLOT.size,
+                hash, offset)
+        self._set_header(count, indexed)
+
+    def lookup(self, key: bytes) -> Optional[Tuple[bytes, bytes]]:
+        """The head and body recorded for key, if any."""
+        hash = key_hash(key)
+        _, slots, _, _ = self._header()
+        mask = slots - 1
+        slot = hash & mask
+        while True:
+            slot_hash, slot_offset = _SLOT.unpack_from(
+                self._index, _INDEX_HEADER.size + slot * _SLOT.size)
+            if slot_offset == 0:
+                return None
+            if slot_hash == hash:
+                entry_key, head, body = self._read_entry(slot_offset - 1)
+                if entry_key == key:
+                    return head, body
+            slot = (slot + 1) & mask
+
+    def append(self, entries: List[Entry]) -> None:
+        """Appends entries to the data file and indexes them."""
+        assert self.writable
+        offset = self._header()[3]
+        data = bytearray()
+        for key, head, body in entries:
+            data += _ENTRY.pack(len(key), len(head), len(body))
+            data += key
+            data += head
+            data += body
+        self._data.write(data)
+        self._data.flush()
+        self._catch_up(offset, offset + len(data))
+
+    def close(self) -> None:
+        if self._data_map is not None:
+            self._data_map.close()
+        self._index.close()
+        if self._index_file is not None:
+            self._index_file.close()
+        self._data.close()
+
+
+class Recorder:
+    """
+    Records entries into a writable RecordingStore from a background task.
+    Lookups are only safe while nothing is being recorded.
+    """
+
+    def __init__(self, store: RecordingStore, max_pending: int = MAX_PENDING):
+        self.store = store
+        self.max_pending = max_pending
+        self._pending: List[Entry] = []
+        self._pending_bytes = 0
+        self._wakeup = asyncio.Event()
+        self._writer: Optional["asyncio.Task[None]"] = None
+        self._closing = False
+        self.dropped = 0
+        self._dropped_logged = 0
+
+    def record(self, key: bytes, head: bytes, body: bytes) -> None:
+        size = len(key) + len(head) + len(body)
+        if self._pending_bytes + size > self.max_pending:
+            self.dropped += 1
+            self._wakeup.set()
+            return
+        self._pending.append((key, head, body))
+        self._pending_bytes += size
+        if self._pending_bytes >= self.max_pending // 2:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        if self._writer is None:
+            self._closing = False
+            self._writer = asyncio.create_task(self._run(), name="recorder")
+
+    async def close(self) -> None:
+        """Writes out what's pending and closes the store."""
+        self._closing = True
+        self._wakeup.set()
+        if self._writer is not None:
+            # Not cancelled: it could be halfway through a write
+            await self._writer
+            self._writer = None
+        await self.flush()
+        self.store.close()
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self.dropped > self._dropped_logged:
+            _LOGGER.warning("recording fell behind: dropped %d responses (%d in all)",
+                self.dropped - self._dropped_logged, self.dropped)
+            self._dropped_logged = self.dropped
+        if not self._pending:
+            return
+        entries, self._pending = self._pending, []
+        self._pending_bytes = 0
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.store.append, entries)
+        except OSError as e:
+            _LOGGER.error("recording %d responses failed: %r", len(entries), e)
+
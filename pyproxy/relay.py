@@ -0,0 +1,224 @@
+"""
+Protocol-based relay engine
+
+An alternative to relaying through StreamReader/StreamWriter. Each side of
+the relay is an asyncio.BufferedProtocol that receives straight into a
+reusable buffer taken from a shared BufferPool and hands it to the other
+side's transport. Nothing is awaited per chunk: flow control comes from the
+transports' write buffer watermarks, which pause and resume reading on the
+opposite side.
+"""
+
+import asyncio
+from asyncio.streams import StreamReader, StreamWriter
+from enum import Enum
+import logging
+import socket
+from typing import List, Optional, Tuple, cast
+
+from .const import BUFFER_SIZE
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class RelayEngine(str, Enum):
+    Streams = "streams"
+    Protocol = "protocol"
+
+
+class BufferPool:
+    """A free list of fixed-size buffers, handed out as memoryviews."""
+
+    def __init__(self, buffer_size: int = 4 * BUFFER_SIZE, max_free: int = 256):
+        self.buffer_size = buffer_size
+        self.max_free = max_free
+        self._free: List[memoryview] = []
+        self.allocated = 0
+
+    def __len__(self) -> int:
+        """The number of free buffers."""
+        return len(self._free)
+
+    def acquire(self) -> memoryview:
+        if self._free:
+            return self._free.pop()
+        self.allocated += 1
+        return memoryview(bytearray(self.buffer_size))
+
+    def release(self, buffer: memoryview) -> None:
+        if len(self._free) < self.max_free:
+            self._free.append(buffer)
+
+
+class RelayProtocol(asyncio.BufferedProtocol):
+    """One side of a relay. Whatever it receives is written to its peer."""
+
+    def __init__(self, relay: "Relay"):
+        self._relay = relay
+        self._buffer: Optional[memoryview] = None
+        # Buffers written to the peer's transport that it may still hold
+        self._written: List[memoryview] = []
+        self.transport: Optional[asyncio.Transport] = None
+        self.peer: Optional["RelayProtocol"] = None
+        self.eof = False
+        self.bytes_received = 0
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        # Not an isinstance check: uvloop's transports don't derive from
+        # asyncio.Transport
+        transport = cast(asyncio.Transport, transport)
+        self.transport = transport
+        transport.set_write_buffer_limits(
+            self._relay.high_watermark, self._relay.low_watermark)
+        if self.peer is None or self.peer.transport is None:
+            # Nowhere to send data to yet
+            transport.pause_reading()
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._buffer is None:
+            self._buffer = self._relay.buffers.acquire()
+        return self._buffer
+
+    def buffer_updated(self, nbytes: int) -> None:
+        assert self._buffer is not None and self.peer is not None
+        assert self.peer.transport is not None
+        self.bytes_received += nbytes
+        peer_transport = self.peer.transport
+        peer_transport.write(self._buffer[:nbytes])
+        if peer_transport.get_write_buffer_size():
+            # Whatever couldn't be sent right away may still reference our
+            # buffer, so it can't be reused until the transport is done with it
+            self._written.append(self._buffer)
+            self._buffer = None
+        else:
+            self.release_written()
+
+    def release_written(self) -> None:
+        """
+        Returns the buffers written to the peer to the pool, once its
+        transport has sent everything (or is gone).
+        """
+        for buffer in self._written:
+            self._relay.buffers.release(buffer)
+        self._written.clear()
+
+    def eof_received(self) -> bool:
+        self.eof = True
+        assert self.peer is not None and self.peer.transport is not None
+        if self.peer.transport.can_write_eof():
+            self.peer.transport.write_eof()
+        self._relay.side_done()
+        # Keep the transport open so the other direction can finish
+        return True
+
+    def pause_writing(self) -> None:
+        # Our transport is backed up: stop reading from the peer
+        assert self.peer is not None and self.peer.transport is not None
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        assert self.peer is not None and self.peer.transport is not None
+        assert self.transport is not None
+        if not self.transport.get_write_buffer_size():
+            self.peer.release_written()
+        if not self.peer.eof:
+            self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self._buffer is not None:
+            self._relay.buffers.release(self._buffer)
+            self._buffer = None
+        # The transport doesn't hold on to what the peer wrote to it anymore
+        if self.peer is not None:
+            self.peer.release_written()
+        self._relay.connection_lost(exc)
+
+
+class Relay:
+    """Pairs two RelayProtocols and tracks when relaying is done."""
+
+    def __init__(
+        self,
+        buffers: BufferPool,
+        high_watermark: int = 256 * 1024,
+        low_watermark: int = 64 * 1024):
+
+        self.buffers = buffers
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.local = RelayProtocol(self)
+        self.remote = RelayProtocol(self)
+        self.local.peer = self.remote
+        self.remote.peer = self.local
+        self._done = asyncio.get_running_loop().create_future()
+
+    def side_done(self) -> None:
+        if self.local.eof and self.remote.eof and not self._done.done():
+            self._done.set_result(None)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if not self._done.done():
+            if exc:
+                _LOGGER.debug("relay: connection lost: %r", exc)
+            self._done.set_result(None)
+
+    def close(self) -> None:
+        for side in (self.local, self.remote):
+            if side.transport and not side.transport.is_closing():
+                side.transport.close()
+
+    async def wait(self) -> Tuple[int, int]:
+        """
+        Waits until both directions reached EOF or either connection was lost
+        and returns the bytes relayed each way (local to remote, remote to
+        local).
+        """
+        try:
+            await self._done
+        finally:
+            self.close()
+        return self.local.bytes_received, self.remote.bytes_received
+
+
+async def open_relay(
+    host: str,
+    port: int,
+    buffers: BufferPool,
+    high_watermark: int = 256 * 1024,
+    low_watermark: int = 64 * 1024,
+    sock: Optional[socket.socket] = None) -> Relay:
+    """
+    Connects to host:port with a RelayProtocol, or wraps sock if it's already
+    connected. Nothing is read from the connection until the local side is
+    attached with attach_local().
+    """
+    loop = asyncio.get_running_loop()
+    relay = Relay(buffers, high_watermark, low_watermark)
+    if sock is not None:
+        await loop.create_connection(lambda: relay.remote, sock=sock)
+    else:
+        await loop.create_connection(lambda: relay.remote, host, port)
+    return relay
+
+
+def attach_local(relay: Relay, local_stream: Tuple[StreamReader, StreamWriter]) -> None:
+    """Switches the local stream's transport over to the relay."""
+    reader, writer = local_stream
+    transport = cast(asyncio.Transport, writer.transport)
+    assert relay.remote.transport is not None
+
+    # Forward whatever the stream buffered before the switch
+    buffer = getattr(reader, "_buffer", None)
+    if buffer:
+        relay.remote.transport.write(bytes(buffer))
+        relay.local.bytes_received += len(buffer)
+        buffer.clear()
+
+    transport.set_protocol(relay.local)
+    relay.local.connection_made(transport)
+    if not transport.is_reading():
+        # The stream may have paused reading when its buffer filled up
+        transport.resume_reading()
+    relay.remote.transport.resume_reading()
+    if reader.at_eof():
+        relay.local.eof_received()
@@ -0,0 +1,233 @@
+"""
+Name resolution and connection establishment for upstream connections
+"""
+
+from abc import ABC, abstractmethod
+import asyncio
+import ipaddress
+import logging
+import socket
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple, Union, cast
+
+from .stream import StreamPair
+
+_LOGGER = logging.getLogger(__name__)
+
+# (family, type, proto, canonname, sockaddr), as returned by getaddrinfo
+AddrInfo = Tuple[int, int, int, str, Tuple[Any, ...]]
+
+
+class Resolver(ABC):
+    @abstractmethod
+    async def resolve(self, host: str, port: int) -> List[AddrInfo]:
+        """Returns the addresses to try for host:port, in order of preference."""
+        pass
+
+
+class SystemResolver(Resolver):
+    """Resolves names with the event loop's getaddrinfo."""
+
+    async def resolve(self, host: str, port: int) -> List[AddrInfo]:
+        loop = asyncio.get_running_loop()
+        addresses = await loop.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
+        return cast(List[AddrInfo], addresses)
+
+
+def numeric_addrinfo(host: str, port: int) -> Optional[List[AddrInfo]]:
+    """Returns the address info for a numeric IP address without a lookup."""
+    try:
+        ip = ipaddress.ip_address(host.strip("[]"))
+    except ValueError:
+        return None
+    if ip.version == 6:
+        return [(socket.AF_INET6, socket.SOCK_STREAM, socket.IPPROTO_TCP, "",
+            (str(ip), port, 0, 0))]
+    return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "",
+        (str(ip), port))]
+
+
+class CachingResolver(Resolver):
+    """
+    Caches the results of another resolver. Successful lookups are kept for
+    positive_ttl seconds and failed ones for negative_ttl seconds. Concurrent
+    lookups of the same name share a single query.
+    """
+
+    def __init__(
+        self,
+        resolver: Optional[Resolver] = None,
+        positive_ttl: float = 60.0,
+        negative_ttl: float = 5.0,
+        max_entries: int = 1024):
+
+        self._resolver = resolver or SystemResolver()
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._cache: Dict[Tuple[str, int],
+            Tuple[float, Union[List[AddrInfo], Exception]]] = { }
+        self._pending: Dict[Tuple[str, int], "asyncio.Task[List[AddrInfo]]"] = { }
+
+    async def resolve(self, host: str, port: int) -> List[AddrInfo]:
+        addresses = numeric_addrinfo(host, port)
+        if addresses:
+            return addresses
+
+        key = (host, port)
+        cached = self._cache.get(key)
+        if cached:
+            expires, result = cached
+            if time.monotonic() < expires:
+                if isinstance(result, Exception):
+                    raise result.with_traceback(None)
+                return result
+            del self._cache[key]
+
+        query = self._pending.get(key)
+        if query is None:
+            query = asyncio.create_task(self._query(host, port))
+            self._pending[key] = query
+        # A caller going away doesn't cancel the lookup for everyone else
+        return await asyncio.shield(query)
+
+    async def _query(self, host: str, port: int) -> List[AddrInfo]:
+        key = (host, port)
+        try:
+            result = await self._resolver.resolve(host, port)
+        except (OSError, UnicodeError) as e:
+            _LOGGER.debug("resolving %s failed: %s", host, e)
+            self._store(key, e, self.negative_ttl)
+            raise
+        finally:
+            del self._pending[key]
+        self._store(key, result, self.positive_ttl)
+        return result
+
+    def _store(
+        self,
+        key: Tuple[str, int],
+        result: Union[List[AddrInfo], Exception],
+        ttl: float) -> None:
+
+        if ttl <= 0:
+            return
+        if len(self._cache) >= self.max_entries:
+            # Drop the oldest entry
+            del self._cache[next(iter(self._cache))]
+        self._cache[key] = (time.monotonic() + ttl, result)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+def interleave_families(addresses: List[AddrInfo]) -> List[AddrInfo]:
+    """
+    Orders addresses so families alternate, starting with the family of the
+    first address (RFC 8305, section 4).
+    """
+    if not addresses:
+        return addresses
+    first_family = addresses[0][0]
+    first = [a for a in addresses if a[0] == first_family]
+    other = [a for a in addresses if a[0] != first_family]
+    ordered: List[AddrInfo] = []
+    for i in range(max(len(first), len(other))):
+        ordered.extend(family[i] for family in (first, other) if i < len(family))
+    return ordered
+
+
+async def _connect(address: AddrInfo) -> socket.socket:
+    family, type_, proto, _, sockaddr = address
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, sockaddr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def connect_happy_eyeballs(
+    addresses: List[AddrInfo], delay: float = 0.25) -> socket.socket:
+    """
+    Connects to the first address that answers. A new attempt is started every
+    delay seconds, or as soon as the previous one fails, so an unreachable
+    address doesn't hold up the others (RFC 8305).
+    """
+    if not addresses:
+        raise OSError("no addresses to connect to")
+    if len(addresses) == 1:
+        return await _connect(addresses[0])
+
+    pending: Set["asyncio.Task[socket.socket]"] = set()
+    errors: List[BaseException] = []
+    winner: Optional[socket.socket] = None
+
+    def collect(done: Set["asyncio.Task[socket.socket]"]) -> None:
+        nonlocal winner
+        for task in done:
+            exception = task.exception()
+            if exception:
+                errors.append(exception)
+            elif winner is None:
+                winner = task.result()
+            else:
+                task.result().close()
+
+    try:
+        for address in interleave_families(addresses):
+            pending.add(asyncio.create_task(_connect(address)))
+            while pending and winner is None:
+                done, pending = await asyncio.wait(
+                    pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                collect(done)
+                # Move on to the next address on timeout or failure
+                if not done or errors:
+                    break
+            if winner:
+                break
+
+        while pending and winner is None:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            collect(done)
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            for task in done:
+                if not task.cancelled() and not task.exception():
+                    task.result().close()
+
+    if winner is None:
+        if len(errors) == 1:
+            raise errors[0]
+        raise OSError(f"all connection attempts failed: {errors}")
+    return winner
+
+
+async def connect(
+    host: str, port: int, resolver: Resolver, delay: float = 0.25) -> socket.socket:
+    """Resolves host and returns a socket connected to one of its addresses."""
+    addresses = await resolver.resolve(host, port)
+    _LOGGER.debug("connecting to %s:%d (%d addresses)", host, port, len(addresses))
+    return await connect_happy_eyeballs(addresses, delay)
+
+
+async def open_connection(
+    host: str,
+    port: int,
+    resolver: Resolver,
+    delay: float = 0.25,
+    **kwargs: Any) -> StreamPair:
+    """Like asyncio.open_connection(), resolving host with resolver."""
+    sock = await connect(host, port, resolver, delay)
+    try:
+        return await asyncio.open_connection(sock=sock, **kwargs)
+    except BaseException:
+        sock.close()
+        raise
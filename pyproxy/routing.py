@@ -0,0 +1,176 @@
+"""
+Request routing
+
+Callbacks (and, in reverse-proxy mode, upstream groups) are registered with
+optional match criteria: host patterns, path prefixes, methods and ports.
+Routes are indexed by host in a trie keyed on the reversed domain labels and,
+under each host pattern, by path prefix, so finding the callback for a request
+is a handful of dictionary lookups however many callbacks there are.
+
+Host patterns are either exact ("api.example.com"), a wildcard for any
+subdomain ("*.example.com", which doesn't match example.com itself) or "*"
+for any host. Path prefixes match whole segments: "/api" matches "/api" and
+"/api/items" but not "/apiv2". When several routes match, the most specific
+host pattern wins, then the longest path prefix, then the route registered
+first.
+"""
+
+import logging
+from typing import Dict, FrozenSet, Generic, Iterable, List, Optional, TypeVar
+
+from .callback import ProxyServerCallback
+
+_LOGGER = logging.getLogger(__name__)
+
+# What requests are routed to: callbacks, or upstream groups
+T = TypeVar("T")
+
+
+class Route(Generic[T]):
+    __slots__ = ("callback", "methods", "ports")
+
+    def __init__(
+        self,
+        callback: T,
+        methods: Optional[FrozenSet[str]],
+        ports: Optional[FrozenSet[int]]):
+
+        self.callback = callback
+        self.methods = methods
+        self.ports = ports
+
+    def accepts(self, method: str, port: int) -> bool:
+        return ((self.methods is None or method in self.methods)
+            and (self.ports is None or port in self.ports))
+
+
+class _PathIndex(Generic[T]):
+    """Routes by path prefix, looked up longest prefix first."""
+
+    __slots__ = ("_prefixes", "_lengths")
+
+    def __init__(self) -> None:
+        self._prefixes: Dict[str, List[Route[T]]] = { }
+        # Distinct prefix lengths, longest first
+        self._lengths: List[int] = []
+
+    def add(self, prefix: str, route: Route[T]) -> None:
+        self._prefixes.setdefault(prefix, []).append(route)
+        if len(prefix) not in self._lengths:
+            self._lengths.append(len(prefix))
+            self._lengths.sort(reverse=True)
+
+    def match(self, path: str, method: str, port: int) -> Optional[Route[T]]:
+        for length in self._lengths:
+            routes = self._prefixes.get(path[:length])
+            if routes and not _splits_segment(path, length):
+                for route in routes:
+                    if route.accepts(method, port):
+                        return route
+        return None
+
+
+def _splits_segment(path: str, length: int) -> bool:
+    """Whether a prefix of path ends partway through a segment."""
+    return (0 < length < len(path) and path[length - 1] != "/"
+        and path[length] not in "/?")
+
+
+class _HostNode(Generic[T]):
+    __slots__ = ("children", "exact", "wildcard")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, _HostNode[T]] = { }
+        # Routes for exactly this host, and for any host below it
+        self.exact: Optional[_PathIndex[T]] = None
+        self.wildcard: Optional[_PathIndex[T]] = None
+
+
+def _split_host(host: str) -> List[str]:
+    return host.lower().rstrip(".").split(".")[::-1]
+
+
+class Router(Generic[T]):
+    """Routes requests to values of type T by host, path, method and port."""
+
+    def __init__(self) -> None:
+        self._root: _HostNode[T] = _HostNode()
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _path_index(self, pattern: str) -> _PathIndex[T]:
+        wildcard = False
+        if pattern == "*":
+            labels: List[str] = []
+            wildcard = True
+        elif pattern.startswith("*."):
+            labels = _split_host(pattern[2:])
+            wildcard = True
+        else:
+            labels = _split_host(pattern)
+        if "*" in "".join(labels) or "" in labels:
+            raise ValueError(f"invalid host pattern '{pattern}'")
+
+        node = self._root
+        for label in labels:
+            node = node.children.setdefault(label, _HostNode())
+        if wildcard:
+            if node.wildcard is None:
+                node.wildcard = _PathIndex()
+            return node.wildcard
+        if node.exact is None:
+            node.exact = _PathIndex()
+        return node.exact
+
+    def add(
+        self,
+        callback: T,
+        hosts: Optional[Iterable[str]] = None,
+        paths: Optional[Iterable[str]] = None,
+        methods: Optional[Iterable[str]] = None,
+        ports: Optional[Iterable[int]] = None) -> None:
+        """
+        Routes requests matching all of the given criteria to callback. Any
+        criterion left out matches everything.
+        """
+        # A single pattern or prefix is fine too
+        if isinstance(hosts, str):
+            hosts = (hosts,)
+        prefixes = (paths,) if isinstance(paths, str) else tuple(paths or ("",))
+        route: Route[T] = Route(callback,
+            frozenset(m.upper() for m in methods) if methods is not None else None,
+            frozenset(ports) if ports is not None else None)
+        indexes = [self._path_index(host) for host in (hosts or ("*",))]
+        for index in indexes:
+            for prefix in prefixes:
+                index.add(prefix, route)
+        self._count += 1
+
+    def match(
+        self, hostname: str, port: int, method: str, path: str
+        ) -> Optional[T]:
+        """What a request is routed to, or None if no route matches it."""
+        # Path indexes that apply to hostname, least specific first
+        indexes = []
+        node = self._root
+        for label in _split_host(hostname):
+            if node.wildcard:
+                indexes.append(node.wildcard)
+            child = node.children.get(label)
+            if child is None:
+                break
+            node = child
+        else:
+            if node.exact:
+                indexes.append(node.exact)
+
+        for index in reversed(indexes):
+            route = index.match(path, method, port)
+            if route:
+                return route.callback
+        return None
+
+
+CallbackRouter = Router[ProxyServerCallback]
@@ -1,27 +1,27 @@
 from asyncio.streams import StreamReader, StreamWriter
-from typing import Tuple
+from typing import Tuple, Union
 
 StreamPair = Tuple[StreamReader, StreamWriter]
 
-# TODO: Consider using io.BytesIO underneath
+
 class MemoryStreamReader(StreamReader):
-    def __init__(self, data: bytes):
-        self._data = data
+    """
+    Reads data held in memory (or memory mapped). Reads return memoryview
+    slices of the data instead of copies.
+    """
+
+    def __init__(self, data: Union[bytes, memoryview]):
+        self._data = memoryview(data)
         self._read_index = 0
 
     def close(self) -> None:
         pass
 
     async def read(self, n: int = -1) -> bytes:
-        data = b""
-        datalen = len(self._data)
-        data_left = datalen - self._read_index
-        if data_left > 0:
-            count = n if n > 0 else datalen
-            upper_index = self._read_index + count
-            data = self._data[self._read_index:upper_index]
-            self._read_index += count
-        return data
+        start = self._read_index
+        end = len(self._data) if n < 0 else min(start + n, len(self._data))
+        self._read_index = end
+        return self._data[start:end]  # type: ignore[return-value]
 
     def at_eof(self) -> bool:
-        return self._read_index == len(self._data) - 1
+        return self._read_index >= len(self._data)
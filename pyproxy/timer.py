@@ -0,0 +1,243 @@
+"""
+Coarse-grained timeouts on a shared timer wheel
+
+Every Deadline lives in one slot of a TimerWheel, and the wheel runs a single
+loop timer that ticks every `resolution` seconds while any deadline is
+pending, instead of one timer handle per connection. Pushing a deadline back
+(touch()) only sets a flag: it's picked up when the deadline's slot comes
+around, so it's cheap enough to do on every read.
+
+Deadlines are therefore approximate. Each one is looked at every
+timeout / CHECKS seconds, rounded up to whole ticks, so it expires between
+`timeout` and `timeout * (1 + 1 / CHECKS)` after the last activity, plus up
+to one `resolution`. A wheel whose resolution is coarse next to its shortest
+timeout makes that worse: keep it to a fraction of that timeout. phase()
+and reset() restart the countdown.
+"""
+
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+import logging
+import math
+from types import TracebackType
+from typing import Callable, Iterator, List, Optional, Set, Type
+
+_LOGGER = logging.getLogger(__name__)
+
+# How many times a deadline is checked for activity per timeout
+CHECKS = 4
+
+_current: ContextVar[Optional["Deadline"]] = ContextVar("deadline", default=None)
+
+
+def current_deadline() -> Optional["Deadline"]:
+    """The deadline of the current task, if it runs under one."""
+    return _current.get()
+
+
+def touch() -> None:
+    """Reports activity to the current task's deadline, if there is one."""
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.touched = True
+
+
+@contextmanager
+def phase(timeout: float) -> Iterator[None]:
+    """
+    Runs the block with a different timeout on the current task's deadline,
+    if there is one, and restores the previous timeout afterwards.
+    """
+    deadline = _current.get()
+    if deadline is None:
+        yield
+        return
+    previous = deadline.reset(timeout)
+    try:
+        yield
+    finally:
+        deadline.reset(previous)
+
+
+class Deadline:
+    """
+    Cancels the task that entered it (raising TimeoutError out of the with
+    block) when `timeout` seconds pass without the deadline being touched or
+    reset. A timeout of 0 (or less) never expires.
+    """
+
+    __slots__ = ("_wheel", "_timeout", "_expires", "_slot", "_task", "_token",
+        "_probe", "_probe_value", "touched", "expired")
+
+    def __init__(self, wheel: "TimerWheel", timeout: float):
+        self._wheel = wheel
+        self._timeout = timeout
+        self._expires = math.inf
+        self._slot: Optional[int] = None
+        self._task: Optional["asyncio.Task[object]"] = None
+        self._token: Optional[Token[Optional["Deadline"]]] = None
+        self._probe: Optional[Callable[[], int]] = None
+        self._probe_value = 0
+        self.touched = False
+        self.expired = False
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout
+
+    def touch(self) -> None:
+        self.touched = True
+
+    def reset(self, timeout: Optional[float] = None) -> float:
+        """
+        Restarts the countdown, optionally with a new timeout. Returns the
+        timeout that was in effect before.
+        """
+        previous = self._timeout
+        if timeout is not None:
+            self._timeout = timeout
+        self.touched = False
+        self._wheel._unschedule(self)
+        if self._timeout > 0 and self._task is not None:
+            self._expires = self._wheel.time() + self._timeout
+            self._wheel._schedule(self)
+        else:
+            self._expires = math.inf
+        return previous
+
+    def watch(self, probe: Optional[Callable[[], int]]) -> None:
+        """
+        Counts it as activity whenever probe() returns something new, for work
+        that happens outside the task (e.g. in protocol callbacks).
+        """
+        self._probe = probe
+        self._probe_value = probe() if probe else 0
+
+    def _is_active(self) -> bool:
+        if self.touched:
+            self.touched = False
+            return True
+        if self._probe:
+            value = self._probe()
+            if value != self._probe_value:
+                self._probe_value = value
+                return True
+        return False
+
+    def _expire(self) -> None:
+        self.expired = True
+        if self._task is not None and not self._task.done():
+            _LOGGER.debug("deadline of %s expired after %.2fs",
+                self._task.get_name(), self._timeout)
+            self._task.cancel()
+
+    def __enter__(self) -> "Deadline":
+        self._task = asyncio.current_task()
+        self._token = _current.set(self)
+        self.reset()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType]) -> None:
+
+        self._wheel._unschedule(self)
+        if self._token is not None:
+            _current.reset(self._token)
+            self._token = None
+        task, self._task = self._task, None
+        if self.expired and exc_type is asyncio.CancelledError:
+            uncancel = getattr(task, "uncancel", None)
+            if uncancel is None or uncancel() == 0:
+                raise asyncio.TimeoutError() from exc
+
+
+class TimerWheel:
+    """
+    A hashed timer wheel: `slots` buckets, each covering `resolution`
+    seconds. Deadlines further out than the wheel spans are parked in the last
+    bucket and re-slotted when it comes around.
+    """
+
+    def __init__(self, resolution: float = 0.25, slots: int = 512):
+        self.resolution = resolution
+        self._slots: List[Set[Deadline]] = [set() for _ in range(slots)]
+        self._position = 0
+        self._time = 0.0
+        self._count = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def time(self) -> float:
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        return self._loop.time()
+
+    def deadline(self, timeout: float) -> Deadline:
+        return Deadline(self, timeout)
+
+    def _schedule(self, deadline: Deadline) -> None:
+        now = self.time()
+        if self._handle is None:
+            # Idle wheels don't tick: start over from now
+            self._time = now
+            self._handle = self._loop.call_at(  # type: ignore[union-attr]
+                now + self.resolution, self._tick)
+
+        # Looked at again well before it expires, so activity since then
+        # can't push it back by much more than a timeout
+        check = min(deadline._expires, now + deadline._timeout / CHECKS)
+        ticks = math.ceil((check - self._time) / self.resolution)
+        ticks = min(max(ticks, 1), len(self._slots) - 1)
+        slot = (self._position + ticks) % len(self._slots)
+        self._slots[slot].add(deadline)
+        deadline._slot = slot
+        self._count += 1
+
+    def _unschedule(self, deadline: Deadline) -> None:
+        if deadline._slot is not None:
+            self._slots[deadline._slot].discard(deadline)
+            deadline._slot = None
+            self._count -= 1
+
+    def _tick(self) -> None:
+        now = self.time()
+        # The loop may run us a hair early (within its clock resolution)
+        while self._time + self.resolution <= now + 0.001 and self._count:
+            self._time += self.resolution
+            self._position = (self._position + 1) % len(self._slots)
+            slot = self._slots[self._position]
+            if not slot:
+                continue
+
+            self._slots[self._position] = set()
+            self._count -= len(slot)
+            for deadline in slot:
+                deadline._slot = None
+                if deadline._is_active():
+                    deadline._expires = now + deadline._timeout
+                elif deadline._expires <= now:
+                    deadline._expire()
+                    continue
+                self._schedule(deadline)
+
+        self._handle = None
+        if self._count:
+            self._handle = self._loop.call_at(  # type: ignore[union-attr]
+                self._time + self.resolution, self._tick)
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for slot in self._slots:
+            for deadline in slot:
+                deadline._slot = None
+            slot.clear()
+        self._count = 0
@@ -0,0 +1,212 @@
+"""
+CONNECT tunnel fast path
+
+Once a tunnel is established the proxy only needs to shovel opaque bytes
+between two sockets. Instead of going through StreamReader/StreamWriter (one
+new bytes object, a write and a drain for every chunk), the tunnel takes over
+duplicates of the raw sockets and moves data either with os.splice (in-kernel,
+no copy into Python at all) or with loop.sock_recv_into into a preallocated
+buffer.
+"""
+
+import asyncio
+from asyncio.streams import StreamReader, StreamWriter
+from enum import Enum
+import logging
+import os
+import socket
+from typing import Optional, Tuple, cast
+
+from .const import BUFFER_SIZE
+from .stream import StreamPair
+from .timer import touch
+
+SPLICE_SIZE = 64 * 1024
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class TunnelMode(str, Enum):
+    Auto = "auto"
+    Splice = "splice"
+    RecvInto = "recv_into"
+    Streams = "streams"
+
+
+def splice_supported() -> bool:
+    return hasattr(os, "splice")
+
+
+def _get_socket(writer: StreamWriter) -> Optional[socket.socket]:
+    if writer.get_extra_info("sslcontext") is not None:
+        return None
+    sock = writer.get_extra_info("socket")
+    if sock is None or sock.type != socket.SOCK_STREAM:
+        return None
+    return sock
+
+
+def _can_take_over(reader: StreamReader, writer: StreamWriter) -> bool:
+    # We need to be able to recover anything the stream already buffered and
+    # everything written so far must have made it to the socket
+    return (_get_socket(writer) is not None
+        and isinstance(getattr(reader, "_buffer", None), bytearray)
+        and writer.transport.get_write_buffer_size() == 0)
+
+
+def _take_over(reader: StreamReader, writer: StreamWriter) -> Tuple[socket.socket, bytes]:
+    """
+    Stops the transport from reading and returns a non-blocking duplicate of
+    its socket, along with any data the stream had already buffered.
+    """
+    cast(asyncio.Transport, writer.transport).pause_reading()
+    buffer: bytearray = getattr(reader, "_buffer")
+    pending = bytes(buffer)
+    buffer.clear()
+
+    raw = _get_socket(writer)
+    assert raw is not None
+    sock = raw.dup()
+    sock.setblocking(False)
+    return sock, pending
+
+
+async def _wait_fd(loop: asyncio.AbstractEventLoop, fd: int, write: bool) -> None:
+    waiter = loop.create_future()
+    if write:
+        loop.add_writer(fd, waiter.set_result, None)
+    else:
+        loop.add_reader(fd, waiter.set_result, None)
+    try:
+        await waiter
+    finally:
+        if write:
+            loop.remove_writer(fd)
+        else:
+            loop.remove_reader(fd)
+
+
+async def _relay_splice(
+    loop: asyncio.AbstractEventLoop, src: socket.socket, dst: socket.socket) -> int:
+
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    pipe_read, pipe_write = os.pipe()
+    total = 0
+    try:
+        while True:
+            try:
+                count = os.splice(src_fd, pipe_write, SPLICE_SIZE, flags=flags)
+            except BlockingIOError:
+                await _wait_fd(loop, src_fd, write=False)
+                continue
+            if count == 0:
+                break
+
+            touch()
+            while count > 0:
+                try:
+                    sent = os.splice(pipe_read, dst_fd, count, flags=flags)
+                except BlockingIOError:
+                    await _wait_fd(loop, dst_fd, write=True)
+                    continue
+                count -= sent
+                total += sent
+    finally:
+        os.close(pipe_read)
+        os.close(pipe_write)
+    return total
+
+
+async def _relay_recv_into(
+    loop: asyncio.AbstractEventLoop, src: socket.socket, dst: socket.socket) -> int:
+
+    buffer = bytearray(BUFFER_SIZE * 4)
+    view = memoryview(buffer)
+    total = 0
+    while True:
+        count = await loop.sock_recv_into(src, buffer)
+        if count == 0:
+            break
+        touch()
+        await loop.sock_sendall(dst, view[:count])
+        total += count
+    return total
+
+
+async def _relay(
+    loop: asyncio.AbstractEventLoop,
+    src: socket.socket,
+    dst: socket.socket,
+    use_splice: bool) -> int:
+
+    try:
+        if use_splice:
+            return await _relay_splice(loop, src, dst)
+        return await _relay_recv_into(loop, src, dst)
+    finally:
+        # Let the other end know we're done sending, but keep relaying the
+        # opposite direction until it is done too
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+async def run_tunnel(
+    local_stream: StreamPair, remote_stream: StreamPair, mode: str = TunnelMode.Auto
+    ) -> Optional[Tuple[int, int]]:
+    """
+    Relays data between both streams until both directions are done. Returns
+    the number of bytes relayed each way (local to remote, remote to local),
+    or None if the fast path isn't available, in which case the streams are
+    left untouched.
+    """
+    if mode == TunnelMode.Streams or os.name != "posix":
+        return None
+    if mode == TunnelMode.Splice and not splice_supported():
+        return None
+
+    local_reader, local_writer = local_stream
+    remote_reader, remote_writer = remote_stream
+    if not (_can_take_over(local_reader, local_writer)
+        and _can_take_over(remote_reader, remote_writer)):
+        return None
+
+    use_splice = mode != TunnelMode.RecvInto and splice_supported()
+    loop = asyncio.get_running_loop()
+    local, local_pending = _take_over(local_reader, local_writer)
+    remote, remote_pending = _take_over(remote_reader, remote_writer)
+    _LOGGER.debug("tunnel: relaying with %s",
+        "splice" if use_splice else "sock_recv_into")
+
+    with local, remote:
+        if local_pending:
+            await loop.sock_sendall(remote, local_pending)
+        if remote_pending:
+            await loop.sock_sendall(local, remote_pending)
+
+        tasks = (
+            asyncio.create_task(_relay(loop, local, remote, use_splice),
+                name="LocalToRemoteTunnel"),
+            asyncio.create_task(_relay(loop, remote, local, use_splice),
+                name="RemoteToLocalTunnel"),
+            )
+        try:
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        for task in done:
+            exception = task.exception()
+            if exception:
+                _LOGGER.debug("tunnel: %s failed: %r", task.get_name(), exception)
+
+        sent = [0 if t.cancelled() or t.exception() else t.result() for t in tasks]
+        sent[0] += len(local_pending)
+        sent[1] += len(remote_pending)
+        _LOGGER.debug("tunnel: done, %d bytes sent, %d bytes received", *sent)
+        return sent[0], sent[1]
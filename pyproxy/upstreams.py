@@ -0,0 +1,194 @@
+"""
+Load-balanced upstream groups, for reverse proxying
+
+An UpstreamGroup is a set of interchangeable backends. Each request goes to
+the backend picked by the group's balancing method:
+
+- least_outstanding: the backend with the fewest requests in progress
+- ewma: the backend with the lowest exponentially weighted moving average of
+  its response time (to the response head), scaled by its requests in
+  progress so that a backend that's fast but busy isn't piled onto
+
+Ties are broken at random. Health is tracked passively: connection failures
+and 502, 503 and 504 responses count against a backend, and max_fails of them
+in a row eject it for eject_time seconds (doubling, up to MAX_EJECT_TIME, for
+each ejection since its last success). If every backend is ejected, the
+one due back first is used anyway.
+
+Backends given as "https://host:port" are connected to over TLS.
+"""
+
+from enum import Enum
+import logging
+import math
+import random
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from .tls import TlsProfile
+
+_LOGGER = logging.getLogger(__name__)
+
+# Responses that count as backend failures
+FAILURE_STATUS = frozenset((502, 503, 504))
+MAX_EJECT_TIME = 300.0
+
+
+class BalanceMethod(str, Enum):
+    LeastOutstanding = "least_outstanding"
+    Ewma = "ewma"
+
+
+def parse_address(address: str, default_port: int = 80) -> Tuple[str, int]:
+    """Splits "host:port" (or "[v6 address]:port") into its host and port."""
+    if address.startswith("["):
+        host, _, rest = address[1:].partition("]")
+        return host, int(rest[1:]) if rest.startswith(":") else default_port
+    host, colon, port = address.rpartition(":")
+    if not colon or ":" in host:
+        # No port, or a bare IPv6 address
+        return address, default_port
+    return host, int(port)
+
+
+def parse_backend(address: str) -> Tuple[str, int, bool]:
+    """
+    Splits a backend address, "host:port" or "https://host:port", into its
+    host, port and whether it's to be connected to over TLS.
+    """
+    scheme, separator, rest = address.partition("://")
+    if not separator:
+        return (*parse_address(address), False)
+    scheme = scheme.lower()
+    if scheme not in ("http", "https"):
+        raise ValueError(f"unsupported backend address {address!r}")
+    tls = scheme == "https"
+    return (*parse_address(rest.rstrip("/"), 443 if tls else 80), tls)
+
+
+class Backend:
+    """A backend server in an upstream group, and what's known about it."""
+
+    def __init__(self, host: str, port: int, decay: float, tls: bool = False):
+        self.host = host
+        self.port = port
+        self.decay = decay
+        self.tls = tls
+        self.outstanding = 0
+        # Response time average, in seconds, and when it was last updated
+        self.ewma = 0.0
+        self._ewma_time = 0.0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    def __repr__(self) -> str:
+        return f"{'https://' if self.tls else ''}{self.host}:{self.port}"
+
+    def is_available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def load(self, method: BalanceMethod) -> float:
+        if method == BalanceMethod.Ewma:
+            # Backends not heard from yet look as fast as can be, so they
+            # get tried
+            return self.ewma * (self.outstanding + 1)
+        return self.outstanding
+
+    def observe(self, latency: float, now: float) -> None:
+        """Takes a response time into the moving average."""
+        if self._ewma_time == 0.0:
+            self.ewma = latency
+        else:
+            # Older samples weigh less the longer ago they were taken
+            weight = math.exp(-(now - self._ewma_time) / self.decay)
+            self.ewma = self.ewma * weight + latency * (1 - weight)
+        self._ewma_time = now
+
+    def succeeded(self) -> None:
+        self.failures = 0
+        self.ejections = 0
+
+    def failed(self, now: float, max_fails: int, eject_time: float) -> bool:
+        """Counts a failure. Returns whether the backend is ejected for it."""
+        self.failures += 1
+        if self.failures < max_fails or not self.is_available(now):
+            return False
+        self.ejected_until = now + min(eject_time * 2 ** self.ejections, MAX_EJECT_TIME)
+        self.ejections += 1
+        self.failures = 0
+        return True
+
+
+class UpstreamGroup:
+    """
+    Backends given as "host:port" (or "https://host:port") addresses,
+    balanced with method. decay is how many seconds it takes for a response
+    time to lose most of its weight in the ewma average. tls is how to connect
+    to the https backends, or None for the server's default.
+    """
+
+    def __init__(
+        self,
+        backends: Iterable[str],
+        method: str = BalanceMethod.LeastOutstanding,
+        max_fails: int = 3,
+        eject_time: float = 10.0,
+        decay: float = 10.0,
+        tls: Optional[TlsProfile] = None):
+
+        self.method = BalanceMethod(method)
+        self.max_fails = max(max_fails, 1)
+        self.eject_time = eject_time
+        self.tls = tls
+        self.backends: List[Backend] = []
+        for address in backends:
+            host, port, use_tls = parse_backend(address)
+            self.backends.append(Backend(host, port, decay, use_tls))
+        if not self.backends:
+            raise ValueError("an upstream group needs at least one backend")
+
+    def choose(self, exclude: Iterable[Backend] = ()) -> Backend:
+        """
+        Picks a backend for the next request, other than those in exclude
+        (unless there are no others).
+        """
+        now = time.monotonic()
+        candidates = [b for b in self.backends
+            if b.is_available(now) and b not in exclude]
+        if not candidates:
+            candidates = [b for b in self.backends if b not in exclude] or self.backends
+            # Everything is ejected: try whatever comes back first
+            return min(candidates, key=lambda b: b.ejected_until)
+
+        if len(candidates) == 1:
+            return candidates[0]
+        method = self.method
+        lowest = min(b.load(method) for b in candidates)
+        return random.choice([b for b in candidates if b.load(method) == lowest])
+
+    def begin(self, backend: Backend) -> float:
+        """Counts a request as in progress on backend. Returns the time."""
+        backend.outstanding += 1
+        return time.monotonic()
+
+    def end(self, backend: Backend) -> None:
+        backend.outstanding -= 1
+
+    def record(
+        self, backend: Backend, started: float, status: Optional[int] = None) -> bool:
+        """
+        Records the outcome of a request to backend: the response status, or
+        None if there was no response. Returns whether backend got ejected.
+        """
+        now = time.monotonic()
+        if status is not None:
+            backend.observe(now - started, now)
+        if status is not None and status not in FAILURE_STATUS:
+            backend.succeeded()
+            return False
+        if not backend.failed(now, self.max_fails, self.eject_time):
+            return False
+        _LOGGER.warning("ejecting backend %r for %.0fs", backend,
+            backend.ejected_until - now)
+        return True
@@ -0,0 +1,207 @@
+"""
+Multi-process worker mode
+
+A WorkerSupervisor forks a number of worker processes that each build their
+own ProxyServer (and callback) through a factory and bind the same port with
+SO_REUSEPORT, so the kernel spreads incoming connections across them. The
+supervisor restarts workers that die and passes signals on to them:
+SIGTERM and SIGINT stop everything, SIGHUP restarts all workers.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import time
+from types import FrameType
+from typing import Callable, Dict, Optional, Set
+
+from .loops import run
+from .proxyserver import ProxyServer
+
+_LOGGER = logging.getLogger(__name__)
+
+ServerFactory = Callable[[], ProxyServer]
+
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+# Workers that die sooner than this after starting are restarted with backoff
+MIN_UPTIME = 5.0
+MAX_RESTART_DELAY = 30.0
+# How often workers check that the supervisor is still around
+PARENT_CHECK_INTERVAL = 1.0
+# How long a stopping worker gives requests in progress to finish
+DRAIN_TIMEOUT = 10.0
+
+
+def default_worker_count() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+async def _watch_parent(parent_pid: int, stop: asyncio.Event) -> None:
+    while os.getppid() == parent_pid:
+        await asyncio.sleep(PARENT_CHECK_INTERVAL)
+    _LOGGER.warning("supervisor (pid %d) went away, stopping", parent_pid)
+    stop.set()
+
+
+async def serve(server: ProxyServer, parent_pid: Optional[int] = None) -> None:
+    """
+    Runs server until it fails or the process gets SIGTERM, SIGINT or SIGHUP
+    (or, if parent_pid is given, that process exits). Requests in progress
+    then get DRAIN_TIMEOUT seconds to finish.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (*STOP_SIGNALS, signal.SIGHUP):
+        loop.add_signal_handler(signum, stop.set)
+    watcher = (asyncio.create_task(_watch_parent(parent_pid, stop))
+        if parent_pid else None)
+
+    server_task = asyncio.create_task(server.run(), name="server")
+    stop_task = asyncio.create_task(stop.wait(), name="stop")
+    done, _ = await asyncio.wait(
+        (server_task, stop_task), return_when=asyncio.FIRST_COMPLETED)
+    stop_task.cancel()
+    if watcher:
+        watcher.cancel()
+    if server_task in done:
+        # Raises whatever made the server stop
+        server_task.result()
+        return
+
+    await server.close(drain_timeout=DRAIN_TIMEOUT)
+    server_task.cancel()
+    try:
+        await server_task
+    except asyncio.CancelledError:
+        pass
+
+
+class WorkerSupervisor:
+    """
+    Runs `workers` processes (the number of usable CPUs by default), each
+    serving the ProxyServer returned by factory. factory is called in the
+    worker, after the fork.
+    """
+
+    def __init__(
+        self,
+        factory: ServerFactory,
+        workers: int = 0,
+        restart_delay: float = 1.0):
+
+        if not hasattr(os, "fork"):
+            raise RuntimeError("worker mode needs os.fork()")
+
+        self._factory = factory
+        self.worker_count = workers if workers > 0 else default_worker_count()
+        self.restart_delay = restart_delay
+        # Worker slot by pid, and when each slot last started
+        self._workers: Dict[int, int] = { }
+        self._started: Dict[int, float] = { }
+        self._failures: Dict[int, int] = { }
+        # Workers we told to stop so they'd be restarted
+        self._restarting: Set[int] = set()
+        self._stopping = False
+
+    @property
+    def pids(self) -> Dict[int, int]:
+        return dict(self._workers)
+
+    def _spawn(self, slot: int) -> None:
+        parent_pid = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker(slot, parent_pid)
+
+        self._workers[pid] = slot
+        self._started[slot] = time.monotonic()
+        _LOGGER.info("started worker %d (pid %d)", slot, pid)
+
+    def _run_worker(self, slot: int, parent_pid: int) -> None:
+        exit_code = 1
+        try:
+            for signum in (*STOP_SIGNALS, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+
+            server = self._factory()
+            server.set_options(reuse_port=True)
+            run(serve(server, parent_pid), server.options.event_loop)
+            exit_code = 0
+        except BaseException:
+            _LOGGER.exception("worker %d (pid %d) failed", slot, os.getpid())
+        finally:
+            # Never return into the supervisor's code
+            os._exit(exit_code)
+
+    def _on_signal(self, signum: int, frame: Optional[FrameType]) -> None:
+        if signum in STOP_SIGNALS:
+            _LOGGER.info("stopping workers (signal %d)", signum)
+            self._stopping = True
+            forward = signum
+        else:
+            _LOGGER.info("restarting workers (signal %d)", signum)
+            self._restarting.update(self._workers)
+            forward = signal.SIGTERM
+        self.kill(forward)
+
+    def kill(self, signum: int) -> None:
+        for pid in list(self._workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _restart_delay(self, slot: int) -> float:
+        if time.monotonic() - self._started[slot] >= MIN_UPTIME:
+            self._failures[slot] = 0
+            return 0.0
+        failures = self._failures.get(slot, 0)
+        self._failures[slot] = failures + 1
+        return min(self.restart_delay * 2 ** failures, MAX_RESTART_DELAY)
+
+    def run(self) -> int:
+        """
+        Starts the workers and supervises them until told to stop. Call it
+        from a plain (not async) context: the process is forked.
+        """
+        previous = {
+            signum: signal.signal(signum, self._on_signal)
+            for signum in (*STOP_SIGNALS, signal.SIGHUP) }
+        try:
+            for slot in range(self.worker_count):
+                self._spawn(slot)
+
+            while self._workers:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+
+                if pid not in self._workers:
+                    continue
+                slot = self._workers.pop(pid)
+                exit_code = os.waitstatus_to_exitcode(status)
+                if self._stopping:
+                    _LOGGER.info("worker %d (pid %d) exited", slot, pid)
+                    continue
+
+                if pid in self._restarting:
+                    self._restarting.discard(pid)
+                else:
+                    _LOGGER.warning("worker %d (pid %d) exited with %d, restarting",
+                        slot, pid, exit_code)
+                    delay = self._restart_delay(slot)
+                    if delay:
+                        time.sleep(delay)
+                if not self._stopping:
+                    self._spawn(slot)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+            self._stopping = True
+            self.kill(signal.SIGTERM)
+
+        return 0
@@ -0,0 +1,139 @@
+import asyncio
+import socket
+
+import pytest
+import pytest_asyncio.plugin
+
+from pyproxy import HttpRequest, ProxyServer
+from pyproxy.loops import EventLoop, loop_factory, uvloop_available
+
+LOOPBACK = "127.0.0.1"
+
+# Tests marked all_loops run once per event loop implementation, the rest on
+# the asyncio loop only
+LOOP_FACTORIES = {EventLoop.Asyncio.value: asyncio.new_event_loop}
+if uvloop_available():
+    LOOP_FACTORIES[EventLoop.Uvloop.value] = loop_factory(EventLoop.Uvloop)
+
+# The hook only exists in recent pytest-asyncio versions, and pytest refuses
+# unknown hooks
+if hasattr(pytest_asyncio.plugin.PytestAsyncioSpecs, "pytest_asyncio_loop_factories"):
+    def pytest_asyncio_loop_factories(config, item):
+        if item.get_closest_marker("all_loops"):
+            return LOOP_FACTORIES
+        return {EventLoop.Asyncio.value: asyncio.new_event_loop}
+
+
+# The same five byte request body framed each way a client can send one: the
+# header fields that end the head, then the body
+REQUEST_BODIES = {
+    "content-length": b"Content-Length: 5\r\n\r\nhello",
+    "chunked": b"Transfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n0\r\n\r\n",
+}
+
+
+def unused_port():
+    """
+    A port nothing listens on right now, for servers that can't be given
+    port 0 (such as several worker processes sharing one).
+    """
+    with socket.socket() as sock:
+        sock.bind((LOOPBACK, 0))
+        return sock.getsockname()[1]
+
+
+async def parse_request(head):
+    """An HttpRequest read from a raw request head."""
+    reader = asyncio.StreamReader()
+    reader.feed_data(head)
+    reader.feed_eof()
+    request = HttpRequest((LOOPBACK, 0), reader)
+    await request.read_headers()
+    return request
+
+
+class StubServer:
+    """
+    A server for the proxy to talk to, on a free loopback port. Subclasses
+    implement handler(reader, writer), or pass one in.
+    """
+
+    def __init__(self, handler=None, ssl=None):
+        if handler is not None:
+            self.handler = handler
+        self.ssl = ssl
+        self.port = 0
+        self._server = None
+
+    async def handler(self, reader, writer):
+        raise NotImplementedError
+
+    @property
+    def address(self):
+        return f"{LOOPBACK}:{self.port}"
+
+    def url(self, path="/"):
+        return f"http://{self.address}{path}"
+
+    def path(self, target):
+        """The path of a request target, which may be in absolute form."""
+        prefix = self.url("").encode() if isinstance(target, bytes) else self.url("")
+        return target[len(prefix):] if target.startswith(prefix) else target
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handler, LOOPBACK, 0,
+            ssl=self.ssl)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+# The run() task of each started proxy, to wait for when it's closed
+_RUNNING = { }
+
+
+async def start_proxy(server, **options):
+    """Sets options and starts server, returning once it's listening."""
+    server.set_options(**options)
+    task = asyncio.create_task(server.run(), name="server")
+    _RUNNING[server] = task
+    started = asyncio.create_task(server.wait_started())
+    await asyncio.wait((task, started), return_when=asyncio.FIRST_COMPLETED)
+    if not started.done():
+        started.cancel()
+        # run() failed: raise why
+        await task
+    return task
+
+
+async def connect(server):
+    """Opens a connection to a started proxy (or StubServer)."""
+    return await asyncio.open_connection(LOOPBACK, server.port)
+
+
+async def stop_proxy(server):
+    await server.close()
+    task = _RUNNING.pop(server, None)
+    if task is not None:
+        try:
+            await asyncio.wait_for(task, 5)
+        except asyncio.CancelledError:
+            pass
+
+
+@pytest.fixture
+async def proxy_server():
+    """A ProxyServer on a free loopback port, to start with start_proxy()."""
+    server = ProxyServer(LOOPBACK, 0)
+    server.set_options(allow_loopback_target=True)
+    yield server
+    await stop_proxy(server)
+
+
+@pytest.fixture(scope="session")
+def httpserver_listen_address():
+    # pytest-httpserver picks a free port for port 0
+    return (LOOPBACK, 0)
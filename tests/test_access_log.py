@@ -0,0 +1,125 @@
+import asyncio
+import json
+import logging
+import os
+
+import pytest
+
+from conftest import LOOPBACK, StubServer, start_proxy
+from pyproxy.accesslog import AccessLog
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+class Upstream(StubServer):
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                await reader.readuntil(b"\r\n\r\n")
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+
+def read_lines(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+class TestAccessLog:
+    async def test_common_format(self, tmp_path):
+        path = tmp_path / "access.log"
+        log = AccessLog(str(path))
+        log.start()
+        log.record("10.0.0.1", "GET", "http://example.com/", "HTTP/1.1", 200, 1234, 0.0125,
+            "Forward")
+        log.record("10.0.0.2", "HEAD", "http://example.com/", "HTTP/1.1", 304, 0, 0.001)
+        await log.close()
+
+        first, second = read_lines(path)
+        assert first.startswith('10.0.0.1 - - [')
+        assert first.endswith('] "GET http://example.com/ HTTP/1.1" 200 1234 12.500 Forward')
+        assert second.endswith('"HEAD http://example.com/ HTTP/1.1" 304 - 1.000 -')
+
+    async def test_json_format(self, tmp_path):
+        path = tmp_path / "access.log"
+        log = AccessLog(str(path), format="json")
+        log.record("10.0.0.1", "GET", "/", "HTTP/1.1", 404, 10, 0.5)
+        await log.close()
+
+        entry = json.loads(read_lines(path)[0])
+        assert entry["status"] == 404
+        assert entry["bytes"] == 10
+        assert entry["duration_ms"] == 500.0
+        assert entry["action"] == "-"
+
+    async def test_sampling(self, tmp_path):
+        path = tmp_path / "access.log"
+        log = AccessLog(str(path), sample_rate=0.0)
+        for status in (200, 404, 502):
+            log.record("10.0.0.1", "GET", "/", "HTTP/1.1", status, 0, 0.0)
+        await log.close()
+        # Server errors are always logged
+        assert [line.split('" ')[1].split()[0] for line in read_lines(path)] == ["502"]
+
+    async def test_ring_buffer_drops_oldest(self, tmp_path):
+        path = tmp_path / "access.log"
+        log = AccessLog(str(path), buffer_size=4)
+        for n in range(10):
+            log.record("10.0.0.1", "GET", f"/{n}", "HTTP/1.1", 200, 0, 0.0)
+        await log.close()
+        assert log.dropped == 6
+        assert [line.split()[6] for line in read_lines(path)] == ["/6", "/7", "/8", "/9"]
+
+    async def test_rotation(self, tmp_path):
+        path = tmp_path / "access.log"
+        log = AccessLog(str(path), max_bytes=100, backups=2)
+        for n in range(5):
+            log.record("10.0.0.1", "GET", f"/{n}", "HTTP/1.1", 200, 0, 0.0)
+            await log.flush()
+        await log.close()
+
+        assert sorted(os.listdir(tmp_path)) == ["access.log", "access.log.1", "access.log.2"]
+        assert "/4 " in read_lines(path)[-1]
+        assert "/3 " in read_lines(f"{path}.1")[-1]
+
+    async def test_proxy_requests_logged(self, tmp_path, upstream, proxy_server):
+        path = tmp_path / "access.log"
+        await start_proxy(proxy_server, access_log=str(path), access_log_format="json")
+
+        reader, writer = await asyncio.open_connection(LOOPBACK, proxy_server.port)
+        writer.write(f"GET {upstream.url('/hello')} HTTP/1.1\r\n"
+            f"Host: {upstream.address}\r\n\r\n".encode())
+        await asyncio.wait_for(reader.readuntil(b"hello"), 2)
+        writer.close()
+
+        reader, writer = await asyncio.open_connection(LOOPBACK, proxy_server.port)
+        writer.write(f"CONNECT {upstream.address} HTTP/1.1\r\n\r\n".encode())
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+        writer.write(b"GET /hello HTTP/1.1\r\nHost: x\r\n\r\n")
+        await asyncio.wait_for(reader.readuntil(b"hello"), 2)
+        writer.close()
+        await asyncio.sleep(0.1)
+
+        await proxy_server.close()
+        get, connect = [json.loads(line) for line in read_lines(path)]
+        assert get["method"] == "GET"
+        assert get["target"] == upstream.url("/hello")
+        assert get["status"] == 200
+        assert get["bytes"] == len(b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello")
+        assert get["client"] == LOOPBACK
+        assert connect["method"] == "CONNECT"
+        assert connect["bytes"] == get["bytes"]
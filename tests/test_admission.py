@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import socket
+import time
+
+import pytest
+
+from conftest import LOOPBACK, StubServer, connect, start_proxy, stop_proxy
+from pyproxy import ProxyServer
+from pyproxy.admission import AdmissionControl
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+class Upstream(StubServer):
+    """Answers /slow/<seconds> after that many seconds, anything else at once."""
+
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                path = self.path(head.split(b" ")[1])
+                if path.startswith(b"/slow/"):
+                    await asyncio.sleep(float(path[6:]))
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+
+def request(upstream, path="/"):
+    return (f"GET {upstream.url(path)} HTTP/1.1\r\n"
+        f"Host: {upstream.address}\r\n\r\n").encode()
+
+
+async def get(reader, writer, upstream, path="/", timeout=2):
+    writer.write(request(upstream, path))
+    return await asyncio.wait_for(reader.readuntil(b"\r\n\r\nok"), timeout)
+
+
+class TestAdmission:
+    async def test_admission_control(self):
+        admission = AdmissionControl(max_connections=2, max_per_ip=1)
+        assert admission.try_reserve()
+        assert admission.admit("10.0.0.1")
+        assert admission.try_reserve()
+        assert not admission.admit("10.0.0.1")
+        assert admission.try_reserve()
+        assert admission.admit("10.0.0.2")
+        assert admission.is_full()
+        assert not admission.try_reserve()
+
+        waiter = asyncio.create_task(admission.wait_for_room())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        admission.release("10.0.0.1")
+        await asyncio.wait_for(waiter, 1)
+        assert admission.count("10.0.0.1") == 0
+        # Waiting doesn't take the slot
+        assert admission.try_reserve()
+
+    async def test_per_ip_limit(self, upstream, proxy_server):
+        await start_proxy(proxy_server, max_connections_per_ip=2)
+        clients = [await connect(proxy_server) for _ in range(2)]
+        for reader, writer in clients:
+            await get(reader, writer, upstream)
+
+        reader, writer = await connect(proxy_server)
+        response = await asyncio.wait_for(reader.read(), 2)
+        assert response.startswith(b"HTTP/1.1 503 Service Unavailable\r\n")
+        assert proxy_server.metrics.connections_rejected.value == 1
+
+        # A slot frees up when a connection closes
+        clients[0][1].close()
+        await asyncio.sleep(0.1)
+        reader, writer = await connect(proxy_server)
+        await get(reader, writer, upstream)
+        for _, other in clients[1:] + [(reader, writer)]:
+            other.close()
+
+    async def test_accept_paused_at_limit(self, upstream, proxy_server):
+        await start_proxy(proxy_server, max_connections=1)
+        first_reader, first_writer = await connect(proxy_server)
+        await get(first_reader, first_writer, upstream)
+
+        # Connects (into the backlog) but isn't served yet
+        reader, writer = await connect(proxy_server)
+        writer.write(request(upstream))
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(reader.readuntil(b"ok"), 0.3)
+        assert proxy_server.metrics.connections_accepted.value == 1
+
+        first_writer.close()
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\nok"), 2)
+        writer.close()
+
+    async def test_limit_shared_by_listeners(self, upstream):
+        # Listening on every address gives an IPv4 and an IPv6 listener
+        if not socket.has_ipv6:
+            pytest.skip("needs IPv6")
+        server = ProxyServer(None, 0)
+        server.set_options(allow_loopback_target=True)
+        try:
+            await start_proxy(server, max_connections=2)
+            # Neither listener keeps a slot while it waits, so either one can
+            # serve both connections
+            for host in (LOOPBACK, "::1"):
+                try:
+                    clients = [await asyncio.open_connection(host, server.port)
+                        for _ in range(2)]
+                except OSError:
+                    pytest.skip(f"can't connect to {host}")
+                for reader, writer in clients:
+                    await get(reader, writer, upstream)
+                for _, writer in clients:
+                    writer.close()
+                    await writer.wait_closed()
+        finally:
+            await stop_proxy(server)
+
+    async def test_graceful_drain(self, upstream, proxy_server):
+        server_task = await start_proxy(proxy_server)
+        port = proxy_server.port
+        busy_reader, busy_writer = await connect(proxy_server)
+        idle_reader, idle_writer = await connect(proxy_server)
+        await get(idle_reader, idle_writer, upstream)
+        busy_writer.write(request(upstream, "/slow/0.5"))
+        await asyncio.sleep(0.1)
+
+        start_time = time.monotonic()
+        closing = asyncio.create_task(proxy_server.close(drain_timeout=5))
+        # Idle connections are closed right away
+        assert await asyncio.wait_for(idle_reader.read(), 1) == b""
+        with pytest.raises(ConnectionError):
+            await asyncio.open_connection(LOOPBACK, port)
+
+        # The request in progress completes, and then its connection closes
+        response = await asyncio.wait_for(busy_reader.read(), 2)
+        assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert b"Connection: close\r\n" in response
+        await asyncio.wait_for(closing, 1)
+        assert time.monotonic() - start_time < 1.5
+        assert server_task.done()
+        idle_writer.close()
+        busy_writer.close()
+
+    async def test_drain_timeout(self, upstream, proxy_server):
+        await start_proxy(proxy_server)
+        reader, writer = await connect(proxy_server)
+        writer.write(request(upstream, "/slow/5"))
+        await asyncio.sleep(0.1)
+
+        start_time = time.monotonic()
+        await proxy_server.close(drain_timeout=0.3)
+        assert time.monotonic() - start_time < 1
+        assert await asyncio.wait_for(reader.read(), 1) == b""
+        writer.close()
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+
+import pytest
+
+from conftest import StubServer, connect, start_proxy
+from pyproxy import (
+    HttpRequest, HttpResponse, ProxyServerAction, ProxyServerCallback
+)
+from pyproxy.bodystore import BodyStore
+from pyproxy.stream import MemoryStreamReader
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+class EchoUpstream(StubServer):
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+                body = await reader.readexactly(length)
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: " +
+                    str(len(body)).encode() + b"\r\n\r\n" + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = EchoUpstream()
+    await server.start()
+    yield server
+    await server.close()
+
+@pytest.fixture
+async def proxy_server(proxy_server):
+    await start_proxy(proxy_server, body_spill_threshold=4096)
+    return proxy_server
+
+
+class ReadBodyCallback(ProxyServerCallback):
+    def __init__(self):
+        self.bodies = []
+        self.spilled = []
+
+    async def on_new_request_async(self, request: HttpRequest) -> ProxyServerAction:
+        body = await request.read_body_buffer()
+        self.bodies.append(bytes(body))
+        self.spilled.append(request._stored.spilled)
+        return ProxyServerAction.Forward
+
+    async def on_new_response_async(
+        self,
+        action: ProxyServerAction,
+        request: HttpRequest,
+        response: HttpResponse) -> None:
+        pass
+
+
+class TestBodyStore:
+    def test_small_body_stays_in_memory(self):
+        store = BodyStore(spill_threshold=100, memory_budget=1000)
+        body = store.create()
+        body.write(b"hello ")
+        body.write(b"world")
+        assert not body.spilled
+        assert body.getbuffer() == b"hello world"
+        assert store.budget.used == 11
+
+        body.close()
+        assert store.budget.used == 0
+
+    def test_large_body_spills_to_disk(self):
+        store = BodyStore(spill_threshold=100, memory_budget=1000)
+        body = store.create()
+        body.write(b"a" * 60)
+        assert not body.spilled
+        body.write(b"b" * 60)
+        assert body.spilled
+        assert store.budget.used == 0
+
+        view = body.getbuffer()
+        assert len(view) == 120
+        assert view[58:62] == b"aabb"
+        assert body.getvalue() == b"a" * 60 + b"b" * 60
+        del view
+        body.close()
+
+    def test_budget_spills_smaller_bodies(self):
+        store = BodyStore(spill_threshold=100, memory_budget=150)
+        first = store.create(80)
+        first.write(b"x" * 80)
+        second = store.create(80)
+        assert second.spilled
+        second.close()
+
+        first.close()
+        third = store.create(80)
+        assert not third.spilled
+
+    def test_size_hint_over_threshold(self):
+        store = BodyStore(spill_threshold=100)
+        body = store.create(101)
+        assert body.spilled
+        assert store.spilled == 1
+
+    async def test_memory_stream_reader(self):
+        reader = MemoryStreamReader(b"abcde")
+        assert not reader.at_eof()
+        assert await reader.read(4) == b"abcd"
+        assert not reader.at_eof()
+        assert await reader.read(4) == b"e"
+        assert reader.at_eof()
+        assert await reader.read() == b""
+
+    async def test_spilled_request_body_is_forwarded(self, upstream, proxy_server):
+        callback = ReadBodyCallback()
+        proxy_server.register_callback(callback)
+        reader, writer = await connect(proxy_server)
+
+        for size in (100, 100000):
+            body = bytes(range(256)) * (size // 256) + b"end"
+            writer.write(f"POST {upstream.url()} HTTP/1.1\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+            assert f"Content-Length: {len(body)}".encode() in head
+            assert await reader.readexactly(len(body)) == body
+            assert callback.bodies[-1] == body
+
+        assert callback.spilled == [False, True]
+        writer.close()
+        await asyncio.sleep(0.1)
+        assert proxy_server._server._body_store.budget.used == 0
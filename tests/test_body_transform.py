@@ -0,0 +1,205 @@
+import asyncio
+import logging
+
+import pytest
+
+from conftest import StubServer, connect, start_proxy
+from pyproxy import (
+    HttpRequest, HttpResponse, ProxyServerAction, ProxyServerCallback
+)
+from pyproxy.framing import BodyFraming
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+class Upstream(StubServer):
+    """
+    /slow sends the first half of its body, then waits to be told to send the
+    rest. /echo sends back the request body.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.release = asyncio.Event()
+        self.received = []
+
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                path = self.path(head.split(b" ")[1])
+                if path == b"/slow":
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nhello")
+                    await writer.drain()
+                    await self.release.wait()
+                    writer.write(b"world")
+                elif path == b"/echo":
+                    body = b""
+                    if b"chunked" in head.lower():
+                        while True:
+                            size = int((await reader.readline()).strip(), 16)
+                            data = await reader.readexactly(size + 2)
+                            if size == 0:
+                                break
+                            body += data[:-2]
+                    else:
+                        length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+                        body = await reader.readexactly(length)
+                    self.received.append((head, body))
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: " +
+                        str(len(body)).encode() + b"\r\n\r\n" + body)
+                else:
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nhelloworld")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+@pytest.fixture
+async def proxy_server(proxy_server):
+    await start_proxy(proxy_server)
+    return proxy_server
+
+
+async def upper(chunks):
+    async for chunk in chunks:
+        yield chunk.upper()
+
+
+async def first_chunk_only(chunks):
+    async for chunk in chunks:
+        yield chunk
+        return
+
+
+class TransformCallback(ProxyServerCallback):
+    def __init__(self, request_transform=None, response_transform=None):
+        self.request_transform = request_transform
+        self.response_transform = response_transform
+
+    async def on_new_request_async(self, request: HttpRequest) -> ProxyServerAction:
+        if self.request_transform:
+            request.set_body_transform(self.request_transform)
+        return ProxyServerAction.Forward
+
+    async def on_new_response_async(
+        self,
+        action: ProxyServerAction,
+        request: HttpRequest,
+        response: HttpResponse) -> None:
+
+        if self.response_transform:
+            response.set_body_transform(self.response_transform)
+
+
+def request(upstream, path, version="HTTP/1.1", body=b""):
+    head = (f"{'POST' if body else 'GET'} {upstream.url(path)} "
+        f"{version}\r\nHost: {upstream.address}\r\n")
+    if body:
+        head += f"Content-Length: {len(body)}\r\n"
+    return head.encode() + b"\r\n" + body
+
+
+async def read_chunked(reader):
+    body = b""
+    while True:
+        size = int((await reader.readline()).strip(), 16)
+        data = await reader.readexactly(size + 2)
+        if size == 0:
+            return body
+        body += data[:-2]
+
+
+class TestBodyTransform:
+    async def test_response_streamed_through_transform(self, upstream, proxy_server):
+        proxy_server.register_callback(TransformCallback(response_transform=upper))
+        reader, writer = await connect(proxy_server)
+        writer.write(request(upstream, "/slow"))
+
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+        assert b"Transfer-Encoding: chunked" in head
+        assert b"Content-Length" not in head
+        # The first half gets through before the upstream sends the rest
+        assert await asyncio.wait_for(reader.readline(), 2) == b"5\r\n"
+        assert await reader.readline() == b"HELLO\r\n"
+
+        upstream.release.set()
+        assert await asyncio.wait_for(read_chunked(reader), 2) == b"WORLD"
+        writer.close()
+
+    async def test_request_streamed_through_transform(self, upstream, proxy_server):
+        proxy_server.register_callback(TransformCallback(request_transform=upper))
+        reader, writer = await connect(proxy_server)
+        writer.write(request(upstream, "/echo", body=b"some data"))
+
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+        assert head.startswith(b"HTTP/1.1 200 OK")
+        upstream_head, upstream_body = upstream.received[0]
+        assert b"Transfer-Encoding: chunked" in upstream_head
+        assert upstream_body == b"SOME DATA"
+        writer.close()
+
+    async def test_unread_body_is_discarded(self, upstream, proxy_server):
+        proxy_server.register_callback(
+            TransformCallback(request_transform=first_chunk_only))
+        reader, writer = await connect(proxy_server)
+        body = b"x" * 100000
+        for _ in range(2):
+            writer.write(request(upstream, "/echo", body=body))
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+            length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+            assert 0 < length < len(body)
+            await reader.readexactly(length)
+
+        # Both requests went over the same client and upstream connections
+        assert len(upstream.received) == 2
+        writer.close()
+
+    async def test_http10_client_gets_close_delimited_body(self, upstream, proxy_server):
+        proxy_server.register_callback(TransformCallback(response_transform=upper))
+        reader, writer = await connect(proxy_server)
+        writer.write(request(upstream, "/", version="HTTP/1.0"))
+
+        response = await asyncio.wait_for(reader.read(), 2)
+        head, body = response.split(b"\r\n\r\n", 1)
+        assert b"Transfer-Encoding" not in head
+        assert b"Content-Length" not in head
+        assert body == b"HELLOWORLD"
+        writer.close()
+
+    async def test_chained_transforms(self):
+        response = HttpResponse()
+        response.set_head(b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n")
+
+        async def reverse(chunks):
+            async for chunk in chunks:
+                yield chunk[::-1]
+
+        response.set_body_transform(upper)
+        response.set_body_transform(reverse)
+
+        async def source():
+            yield b"hello"
+
+        assert [c async for c in response.body_transform(source())] == [b"OLLEH"]
+        assert response.get_source_framing() == (BodyFraming.ContentLength, 5)
+
+    async def test_untouched_body_passes_through(self, upstream, proxy_server):
+        proxy_server.register_callback(TransformCallback())
+        reader, writer = await connect(proxy_server)
+        writer.write(request(upstream, "/"))
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+        assert b"Content-Length: 10" in head
+        assert await reader.readexactly(10) == b"helloworld"
+        writer.close()
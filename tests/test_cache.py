@@ -0,0 +1,149 @@
+import asyncio
+import logging
+
+import pytest
+
+from conftest import StubServer, connect, parse_request, start_proxy
+from pyproxy.cache import ResponseCache
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+class Upstream(StubServer):
+    """Serves a few resources with different caching policies."""
+
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    def respond(self, path, headers):
+        if path == "/fresh":
+            return b"200 OK", b"Cache-Control: max-age=60\r\n", b"fresh"
+        if path == "/etag":
+            if headers.get("if-none-match") == '"v1"':
+                return b"304 Not Modified", b'ETag: "v1"\r\n', None
+            return b"200 OK", b'Cache-Control: no-cache\r\nETag: "v1"\r\n', b"etag"
+        if path == "/vary":
+            language = headers.get("accept-language", "en").encode()
+            return (b"200 OK", b"Cache-Control: max-age=60\r\nVary: Accept-Language\r\n",
+                language)
+        if path == "/big":
+            return b"200 OK", b"Cache-Control: max-age=60\r\n", b"x" * 4096
+        if path == "/nostore":
+            return b"200 OK", b"Cache-Control: no-store\r\n", b"nostore"
+        return b"404 Not Found", b"", b""
+
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode().split("\r\n")
+                path = self.path(lines[0].split(" ")[1])
+                headers = dict((k.lower(), v) for k, v in
+                    (line.split(": ", 1) for line in lines[1:] if line))
+                self.requests.append((path, headers))
+
+                status, fields, body = self.respond(path.split("?")[0], headers)
+                writer.write(b"HTTP/1.1 " + status + b"\r\n" + fields)
+                if body is not None:
+                    writer.write(b"Content-Length: " + str(len(body)).encode() +
+                        b"\r\n\r\n" + body)
+                else:
+                    writer.write(b"\r\n")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+@pytest.fixture
+async def proxy_server(proxy_server):
+    await start_proxy(proxy_server, cache_max_bytes=8192,
+        cache_max_entry_bytes=8192)
+    return proxy_server
+
+
+async def get(proxy, upstream, path, headers=b""):
+    reader, writer = await connect(proxy)
+    writer.write(f"GET {upstream.url(path)} HTTP/1.1\r\n"
+        f"Host: {upstream.address}\r\n".encode() + headers + b"\r\n")
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+    length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+    body = await asyncio.wait_for(reader.readexactly(length), 2)
+    writer.close()
+    return head, body
+
+
+class TestResponseCache:
+    async def test_key_includes_scheme(self):
+        plain = await parse_request(b"GET http://www.example.com:443/x HTTP/1.1\r\n"
+            b"Host: www.example.com:443\r\n\r\n")
+        secure = await parse_request(b"GET https://www.example.com:443/x HTTP/1.1\r\n"
+            b"Host: www.example.com:443\r\n\r\n")
+        assert (ResponseCache.get_key(plain, "www.example.com", 443)
+            != ResponseCache.get_key(secure, "www.example.com", 443))
+
+    async def test_fresh_response_served_from_cache(self, upstream, proxy_server):
+        for _ in range(3):
+            head, body = await get(proxy_server, upstream, "/fresh")
+            assert head.startswith(b"HTTP/1.1 200 OK")
+            assert body == b"fresh"
+
+        assert len(upstream.requests) == 1
+        assert proxy_server.cache.stats.hits == 2
+        assert proxy_server.cache.stats.misses == 1
+
+    async def test_stale_response_revalidated(self, upstream, proxy_server):
+        await get(proxy_server, upstream, "/etag")
+        head, body = await get(proxy_server, upstream, "/etag")
+        assert head.startswith(b"HTTP/1.1 200 OK")
+        assert body == b"etag"
+
+        assert len(upstream.requests) == 2
+        assert upstream.requests[1][1]["if-none-match"] == '"v1"'
+        assert proxy_server.cache.stats.revalidations == 1
+
+    async def test_client_no_cache_bypasses_fresh_entry(self, upstream, proxy_server):
+        await get(proxy_server, upstream, "/fresh")
+        await get(proxy_server, upstream, "/fresh", b"Cache-Control: no-cache\r\n")
+        assert len(upstream.requests) == 2
+
+    async def test_vary(self, upstream, proxy_server):
+        for language in (b"en", b"fr", b"en", b"fr"):
+            _, body = await get(proxy_server, upstream, "/vary",
+                b"Accept-Language: " + language + b"\r\n")
+            assert body == language
+
+        assert len(upstream.requests) == 2
+
+    async def test_no_store(self, upstream, proxy_server):
+        await get(proxy_server, upstream, "/nostore")
+        await get(proxy_server, upstream, "/nostore")
+        assert len(upstream.requests) == 2
+        assert len(proxy_server.cache) == 0
+
+    async def test_lru_eviction(self, upstream, proxy_server):
+        await get(proxy_server, upstream, "/fresh")
+        await get(proxy_server, upstream, "/big")
+        # Makes /big the least recently used entry
+        await get(proxy_server, upstream, "/fresh")
+        # Two 4 KiB responses don't fit in an 8 KiB cache
+        await get(proxy_server, upstream, "/big?again")
+
+        cache = proxy_server.cache
+        assert cache.stats.evictions == 1
+        assert cache.size <= cache.max_bytes
+        await get(proxy_server, upstream, "/fresh")
+        await get(proxy_server, upstream, "/big")
+        assert [path for path, _ in upstream.requests] == [
+            "/fresh", "/big", "/big?again", "/big"]
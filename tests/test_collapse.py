@@ -0,0 +1,146 @@
+import asyncio
+import logging
+
+import pytest
+
+from conftest import StubServer, connect, parse_request, start_proxy
+from pyproxy.collapse import Collapser
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+BODY = bytes(range(256)) * 4096
+
+
+class SlowUpstream(StubServer):
+    """Takes a while to answer, then sends BODY chunked in pieces."""
+
+    def __init__(self):
+        super().__init__()
+        self.requests = 0
+        self.extra_headers = b""
+
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                await reader.readuntil(b"\r\n\r\n")
+                self.requests += 1
+                await asyncio.sleep(0.3)
+                writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n"
+                    + self.extra_headers + b"\r\n")
+                for start in range(0, len(BODY), 65536):
+                    chunk = BODY[start:start + 65536]
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    await writer.drain()
+                    await asyncio.sleep(0.01)
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = SlowUpstream()
+    await server.start()
+    yield server
+    await server.close()
+
+
+async def fetch(proxy, upstream, headers="", read_delay=0.0):
+    reader, writer = await connect(proxy)
+    writer.write((f"GET {upstream.url('/asset')} HTTP/1.1\r\n"
+        f"Host: {upstream.address}\r\n{headers}\r\n").encode())
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+    assert b"Transfer-Encoding: chunked\r\n" in head
+    body = b""
+    while True:
+        size = int(await asyncio.wait_for(reader.readuntil(b"\r\n"), 5), 16)
+        if size == 0:
+            break
+        body += await reader.readexactly(size)
+        await reader.readexactly(2)
+        if read_delay:
+            await asyncio.sleep(read_delay)
+    writer.close()
+    return head, body
+
+
+class TestCollapsedForwarding:
+    async def test_key_includes_scheme(self):
+        plain = await parse_request(b"GET http://www.example.com:443/x HTTP/1.1\r\n"
+            b"Host: www.example.com:443\r\n\r\n")
+        secure = await parse_request(b"GET https://www.example.com:443/x HTTP/1.1\r\n"
+            b"Host: www.example.com:443\r\n\r\n")
+        collapser = Collapser()
+        assert (collapser.get_key(plain, "www.example.com", 443)
+            != collapser.get_key(secure, "www.example.com", 443))
+
+    async def test_concurrent_requests_collapsed(self, upstream, proxy_server):
+        await start_proxy(proxy_server, collapse_forwarding=True)
+        results = await asyncio.gather(*(fetch(proxy_server, upstream) for _ in range(10)))
+        assert all(body == BODY for _, body in results)
+        assert upstream.requests == 1
+        assert proxy_server.metrics.requests_collapsed.value == 9
+
+        # Once the fetch is over, the next request goes upstream again
+        await fetch(proxy_server, upstream)
+        assert upstream.requests == 2
+
+    async def test_disabled(self, upstream, proxy_server):
+        await start_proxy(proxy_server)
+        await asyncio.gather(*(fetch(proxy_server, upstream) for _ in range(3)))
+        assert upstream.requests == 3
+
+    async def test_key_headers(self, upstream, proxy_server):
+        await start_proxy(proxy_server, collapse_forwarding=True)
+        await asyncio.gather(
+            fetch(proxy_server, upstream, "Accept-Language: en\r\n"),
+            fetch(proxy_server, upstream, "Accept-Language: fr\r\n"),
+            fetch(proxy_server, upstream, "Accept-Language: fr\r\n"))
+        assert upstream.requests == 2
+
+    async def test_excluded_requests(self, upstream, proxy_server):
+        await start_proxy(proxy_server, collapse_forwarding=True)
+        await asyncio.gather(
+            fetch(proxy_server, upstream, "Cookie: session=1\r\n"),
+            fetch(proxy_server, upstream, "Cookie: session=1\r\n"),
+            fetch(proxy_server, upstream, "Authorization: Basic eA==\r\n"),
+            fetch(proxy_server, upstream, "Range: bytes=0-\r\n"))
+        assert upstream.requests == 4
+
+    async def test_private_response_not_shared(self, upstream, proxy_server):
+        upstream.extra_headers = b"Set-Cookie: id=1\r\n"
+        await start_proxy(proxy_server, collapse_forwarding=True)
+        results = await asyncio.gather(*(fetch(proxy_server, upstream) for _ in range(3)))
+        assert all(body == BODY for _, body in results)
+        assert upstream.requests == 3
+
+    async def test_slow_reader_bounded_buffer(self, upstream, proxy_server):
+        await start_proxy(proxy_server, collapse_forwarding=True,
+            collapse_max_buffer=128 * 1024)
+        slow = asyncio.create_task(fetch(proxy_server, upstream, read_delay=0.02))
+        await asyncio.sleep(0.05)
+        fast = await fetch(proxy_server, upstream)
+        assert fast[1] == BODY
+        assert (await slow)[1] == BODY
+        assert upstream.requests == 1
+
+    async def test_collapsed_fetch_fills_cache(self, upstream, proxy_server):
+        upstream.extra_headers = b"Cache-Control: max-age=60\r\n"
+        await start_proxy(proxy_server, collapse_forwarding=True,
+            cache_max_bytes=4 * 1024 * 1024, cache_max_entry_bytes=2 * 1024 * 1024)
+        await asyncio.gather(*(fetch(proxy_server, upstream) for _ in range(5)))
+        assert proxy_server.cache.stats.stores == 1
+
+        reader, writer = await connect(proxy_server)
+        writer.write((f"GET {upstream.url('/asset')} HTTP/1.1\r\n"
+            f"Host: {upstream.address}\r\n\r\n").encode())
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        assert b"Content-Length: %d\r\n" % len(BODY) in head
+        assert await reader.readexactly(len(BODY)) == BODY
+        writer.close()
+        assert upstream.requests == 1
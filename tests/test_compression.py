@@ -0,0 +1,171 @@
+import asyncio
+import gzip
+import json
+import logging
+
+import pytest
+
+from pyproxy.compression import choose_encoding
+
+from conftest import StubServer, connect, start_proxy
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+JSON_BODY = json.dumps([{ "id": n, "name": f"item {n}" } for n in range(500)]).encode()
+LARGE_BODY = b"".join(b"line %d of a large text body\n" % n for n in range(100000))
+
+RESPONSES = {
+    "/json": (b"Content-Type: application/json\r\n", JSON_BODY),
+    "/small": (b"Content-Type: application/json\r\n", b'{"ok": true}'),
+    "/png": (b"Content-Type: image/png\r\n", JSON_BODY),
+    "/encoded": (b"Content-Type: application/json\r\nContent-Encoding: gzip\r\n",
+        gzip.compress(JSON_BODY)),
+    "/no-transform": (b"Content-Type: application/json\r\n"
+        b"Cache-Control: no-transform\r\n", JSON_BODY),
+    "/large": (b"Content-Type: text/plain; charset=utf-8\r\n", LARGE_BODY),
+    "/cached": (b"Content-Type: application/json\r\nCache-Control: max-age=60\r\n"
+        b'ETag: "v1"\r\n', JSON_BODY),
+}
+
+
+class Upstream(StubServer):
+    def __init__(self):
+        super().__init__()
+        self.requests = 0
+
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                self.requests += 1
+                path = self.path(head.split(b" ")[1].decode())
+                if path == "/chunked":
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n"
+                        b"Transfer-Encoding: chunked\r\n\r\n")
+                    for _ in range(20):
+                        writer.write(b"%x\r\n%s\r\n" % (len(JSON_BODY), JSON_BODY))
+                    writer.write(b"0\r\n\r\n")
+                else:
+                    headers, body = RESPONSES[path]
+                    writer.write(b"HTTP/1.1 200 OK\r\n" + headers +
+                        b"Content-Length: %d\r\n\r\n" % len(body) + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+@pytest.fixture
+async def proxy_server(proxy_server):
+    proxy_server.set_options(compression=True)
+    return proxy_server
+
+
+async def get(proxy, upstream, path, accept_encoding="gzip"):
+    """Returns the response headers (lowercased names) and body."""
+    reader, writer = await connect(proxy)
+    extra = f"Accept-Encoding: {accept_encoding}\r\n" if accept_encoding else ""
+    writer.write((f"GET {upstream.url(path)} HTTP/1.1\r\n"
+        f"Host: {upstream.address}\r\n{extra}\r\n").encode())
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+    headers = { }
+    for line in head.decode().split("\r\n")[1:-2]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    body = b""
+    if headers.get("transfer-encoding") == "chunked":
+        while size := int((await reader.readuntil(b"\r\n"))[:-2], 16):
+            body += (await reader.readexactly(size + 2))[:-2]
+        await reader.readuntil(b"\r\n")
+    else:
+        body = await reader.readexactly(int(headers["content-length"]))
+    writer.close()
+    return headers, body
+
+
+class TestCompression:
+    def test_choose_encoding(self):
+        available = ("br", "gzip")
+        assert choose_encoding("gzip, deflate", available) == "gzip"
+        assert choose_encoding("gzip;q=0.5, br", available) == "br"
+        assert choose_encoding("br;q=0, gzip", available) == "gzip"
+        assert choose_encoding("*", available) == "br"
+        assert choose_encoding("*, br;q=0", available) == "gzip"
+        assert choose_encoding("x-gzip", available) == "gzip"
+        assert choose_encoding("identity", available) is None
+        assert choose_encoding("", available) is None
+
+    async def test_gzip(self, upstream, proxy_server):
+        await start_proxy(proxy_server)
+        headers, body = await get(proxy_server, upstream, "/json")
+        assert headers["content-encoding"] == "gzip"
+        assert headers["transfer-encoding"] == "chunked"
+        assert "content-length" not in headers
+        assert headers["vary"] == "Accept-Encoding"
+        assert gzip.decompress(body) == JSON_BODY
+        assert len(body) < len(JSON_BODY) / 2
+        assert proxy_server.metrics.responses_compressed.value == 1
+
+    async def test_large_and_chunked_bodies(self, upstream, proxy_server):
+        await start_proxy(proxy_server)
+        headers, body = await get(proxy_server, upstream, "/large", "br;q=0.1, gzip")
+        assert headers["content-encoding"] == "gzip"
+        assert gzip.decompress(body) == LARGE_BODY
+
+        headers, body = await get(proxy_server, upstream, "/chunked")
+        assert headers["content-encoding"] == "gzip"
+        assert gzip.decompress(body) == JSON_BODY * 20
+
+    async def test_not_accepted(self, upstream, proxy_server):
+        await start_proxy(proxy_server)
+        for accept_encoding in (None, "identity", "gzip;q=0"):
+            headers, body = await get(proxy_server, upstream, "/json", accept_encoding)
+            assert "content-encoding" not in headers
+            assert headers["content-length"] == str(len(JSON_BODY))
+            # Another client could get it compressed
+            assert headers["vary"] == "Accept-Encoding"
+            assert body == JSON_BODY
+
+    @pytest.mark.parametrize("path", ["/small", "/png", "/encoded", "/no-transform"])
+    async def test_left_alone(self, upstream, proxy_server, path):
+        await start_proxy(proxy_server)
+        headers, body = await get(proxy_server, upstream, path)
+        assert body == RESPONSES[path][1]
+        assert headers.get("content-encoding") != "gzip" or path == "/encoded"
+        assert proxy_server.metrics.responses_compressed.value == 0
+
+    async def test_options(self, upstream, proxy_server):
+        await start_proxy(proxy_server, compression_min_size=1,
+            compression_types=("image/png",))
+        assert (await get(proxy_server, upstream, "/small"))[0].get("content-encoding") is None
+        headers, body = await get(proxy_server, upstream, "/png")
+        assert headers["content-encoding"] == "gzip"
+        assert gzip.decompress(body) == JSON_BODY
+
+    async def test_cache_keeps_uncompressed_body(self, upstream, proxy_server):
+        await start_proxy(proxy_server, cache_max_bytes=1024 * 1024)
+        headers, body = await get(proxy_server, upstream, "/cached")
+        assert headers["content-encoding"] == "gzip"
+        assert headers["etag"] == 'W/"v1"'
+        assert gzip.decompress(body) == JSON_BODY
+
+        headers, body = await get(proxy_server, upstream, "/cached", None)
+        assert "content-encoding" not in headers
+        assert headers["etag"] == '"v1"'
+        assert body == JSON_BODY
+
+        headers, body = await get(proxy_server, upstream, "/cached")
+        assert gzip.decompress(body) == JSON_BODY
+        assert upstream.requests == 1
+        assert proxy_server.cache.stats.hits == 2
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+
+import pytest
+
+import aiorequests
+from pyproxy.connectionpool import ConnectionPool
+
+from conftest import LOOPBACK, StubServer, start_proxy
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+class Upstream(StubServer):
+    """Minimal keep-alive HTTP server that counts the connections it gets."""
+
+    def __init__(self):
+        super().__init__()
+        self.connections = 0
+
+    async def handler(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                body = b'{"message": "hello"}'
+                writer.write(b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: application/json\r\n"
+                    b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" +
+                    body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+@pytest.fixture
+def aiorequest(proxy_server):
+    return aiorequests.Requests(LOOPBACK, proxy_server.port)
+
+@pytest.fixture
+async def proxy_server(proxy_server):
+    await start_proxy(proxy_server)
+    return proxy_server
+
+
+class TestConnectionPool:
+    async def test_upstream_connection_reused_across_clients(
+        self, upstream, proxy_server, aiorequest):
+
+        url = upstream.url("/hello")
+        for _ in range(3):
+            # Every request comes in through a brand new client session
+            response = await aiorequest.get(url)
+            assert response.status == 200
+            assert await response.json() == { "message": "hello" }
+
+        assert upstream.connections == 1
+
+    async def test_idle_connection_expires(self, upstream):
+        pool = ConnectionPool(idle_ttl=0)
+        connection = await pool.acquire(LOOPBACK, upstream.port)
+        pool.release(connection, reusable=True)
+
+        connection = await pool.acquire(LOOPBACK, upstream.port)
+        assert not connection.reused
+        assert upstream.connections == 2
+        pool.release(connection, reusable=False)
+        await pool.close()
+
+    async def test_max_idle(self, upstream):
+        pool = ConnectionPool(max_idle=1)
+        connections = [await pool.acquire(LOOPBACK, upstream.port)
+            for _ in range(3)]
+        for connection in connections:
+            pool.release(connection, reusable=True)
+        assert pool.idle_count == 1
+        await pool.close()
+
+    async def test_per_host_cap_waits_for_release(self, upstream):
+        pool = ConnectionPool(max_per_host=1)
+        connection = await pool.acquire(LOOPBACK, upstream.port)
+        waiter = asyncio.create_task(pool.acquire(LOOPBACK, upstream.port))
+        await asyncio.sleep(0.1)
+        assert not waiter.done()
+
+        pool.release(connection, reusable=True)
+        reused = await asyncio.wait_for(waiter, 1)
+        assert reused is connection
+        assert upstream.connections == 1
+        pool.release(reused, reusable=False)
+        await pool.close()
+
+    async def test_stale_connection_discarded(self, upstream):
+        pool = ConnectionPool()
+        connection = await pool.acquire(LOOPBACK, upstream.port)
+        pool.release(connection, reusable=True)
+
+        # Simulate the server going away while the connection sits idle
+        connection.writer.transport.abort()
+        await asyncio.sleep(0.1)
+
+        fresh = await pool.acquire(LOOPBACK, upstream.port)
+        assert fresh is not connection
+        pool.release(fresh, reusable=False)
+        await pool.close()
@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import logging
+
+import pytest
+
+from pyproxy import (
+    FormError, HttpRequest, HttpResponse, ProxyServerAction,
+    ProxyServerCallback, parse_form_data
+)
+from pyproxy.forms import FormParser, parse_header_value
+
+from conftest import StubServer, connect, start_proxy
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+BOUNDARY = "----form-boundary"
+MULTIPART = f"multipart/form-data; boundary={BOUNDARY}"
+
+
+def multipart(*parts):
+    body = b"preamble\r\n"
+    for headers, data in parts:
+        body += f"--{BOUNDARY}\r\n{headers}\r\n\r\n".encode() + data + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\nepilogue".encode()
+
+
+def parse(content_type, body, chunk_size, **kwargs):
+    parser = FormParser(content_type, **kwargs)
+    parts = []
+    for start in range(0, len(body), chunk_size):
+        parts += parser.feed(body[start:start + chunk_size])
+    return parts + parser.close()
+
+
+class EchoUpstream(StubServer):
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+                body = await reader.readexactly(length)
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body)
+                    + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = EchoUpstream()
+    await server.start()
+    yield server
+    await server.close()
+
+@pytest.fixture
+async def proxy_server(proxy_server):
+    proxy_server.set_options(body_spill_threshold=4096)
+    return proxy_server
+
+
+class UploadInspector(ProxyServerCallback):
+    """Hashes uploaded files as they stream past, and blocks "blocked" ones."""
+
+    def __init__(self, stop_after=None):
+        self.stop_after = stop_after
+        self.fields = {}
+        self.hashes = {}
+
+    def file_sink(self, part):
+        digest = self.hashes[part.filename] = hashlib.sha256()
+        return digest.update
+
+    async def on_new_request_async(self, request: HttpRequest) -> ProxyServerAction:
+        async for part in request.iter_form(self.file_sink):
+            if part.is_file:
+                if part.filename == "blocked":
+                    return ProxyServerAction.Suppress
+            else:
+                self.fields[part.name] = part.text()
+                if part.name == self.stop_after:
+                    break
+        return ProxyServerAction.Forward
+
+    async def on_new_response_async(
+        self,
+        action: ProxyServerAction,
+        request: HttpRequest,
+        response: HttpResponse) -> None:
+
+        if action == ProxyServerAction.Suppress:
+            response.http_version = request.version
+            response.response_code = 403
+            response.response_text = "Forbidden"
+            response.set_body(b"blocked")
+
+
+async def post(proxy, upstream, body, content_type, chunked=False):
+    reader, writer = await connect(proxy)
+    framing = ("Transfer-Encoding: chunked\r\n" if chunked
+        else f"Content-Length: {len(body)}\r\n")
+    writer.write((f"POST {upstream.url('/upload')} HTTP/1.1\r\n"
+        f"Host: {upstream.address}\r\nContent-Type: {content_type}\r\n"
+        f"{framing}\r\n").encode())
+    if chunked:
+        for start in range(0, len(body), 10000):
+            chunk = body[start:start + 10000]
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        writer.write(b"0\r\n\r\n")
+    else:
+        writer.write(body)
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+    length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+    response = await reader.readexactly(length)
+    writer.close()
+    return head, response
+
+
+class TestFormParser:
+    def test_parse_form_data(self):
+        assert parse_form_data(b"a=1&b=x%3Dy=z&flag&c=hello+world&&d=") == {
+            b"a": "1", b"b": "x=y=z", b"flag": "", b"c": "hello world", b"d": ""}
+
+    @pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1000])
+    def test_urlencoded_chunks(self, chunk_size):
+        body = b"name=J%C3%BCrgen&empty=&q=a+b%26c&last"
+        parts = parse("application/x-www-form-urlencoded", body, chunk_size)
+        assert [(part.name, part.value) for part in parts] == [
+            ("name", "Jürgen".encode()), ("empty", b""), ("q", b"a b&c"), ("last", b"")]
+
+    @pytest.mark.parametrize("chunk_size", [1, 5, 17, 64, 100000])
+    def test_multipart_chunks(self, chunk_size):
+        data = bytes(range(256)) * 40 + b"\r\n--" + BOUNDARY[:-1].encode()
+        body = multipart(
+            ('Content-Disposition: form-data; name="title"', b"hello\r\nworld"),
+            ('Content-Disposition: form-data; name="file"; filename="a \\"b\\".bin"\r\n'
+                'Content-Type: application/octet-stream', data),
+            ('Content-Disposition: form-data; name="empty"', b""))
+        title, upload, empty = parse(MULTIPART, body, chunk_size)
+        assert (title.name, title.value, title.is_file) == ("title", b"hello\r\nworld", False)
+        assert upload.filename == 'a "b".bin'
+        assert upload.content_type == "application/octet-stream"
+        assert upload.value == data
+        assert (empty.name, empty.value) == ("empty", b"")
+
+    def test_file_sink(self):
+        data = b"x" * 100000
+        received = []
+        body = multipart(
+            ('Content-Disposition: form-data; name="file"; filename="big"', data))
+        upload, = parse(MULTIPART, body, 4096, max_field_size=1000,
+            file_sink=lambda part: received.append)
+        assert upload.value == b""
+        assert upload.size == len(data)
+        assert b"".join(received) == data
+        assert max(map(len, received)) <= 4096
+
+    def test_limits_and_errors(self):
+        with pytest.raises(FormError):
+            parse("application/x-www-form-urlencoded", b"a=" + b"x" * 100, 10,
+                max_field_size=50)
+        with pytest.raises(FormError):
+            parse(MULTIPART, multipart(('Content-Disposition: form-data; name="a"',
+                b"x" * 100)), 10, max_field_size=50)
+        with pytest.raises(FormError):
+            parse(MULTIPART, multipart(('Content-Disposition: form-data; name="a"',
+                b"x"))[:-20], 10)
+        with pytest.raises(FormError):
+            parse(MULTIPART, multipart(("Content-Type: text/plain", b"x")), 10)
+        with pytest.raises(FormError):
+            FormParser("text/plain")
+        with pytest.raises(FormError):
+            FormParser("multipart/form-data")
+
+    def test_parse_header_value(self):
+        assert parse_header_value('form-data; name="a;b"; filename=c.txt') == (
+            "form-data", {"name": "a;b", "filename": "c.txt"})
+        assert parse_header_value("Multipart/Form-Data; Boundary=\"x y\"") == (
+            "multipart/form-data", {"boundary": "x y"})
+
+
+class TestFormCallbacks:
+    async def test_upload_streamed_and_forwarded(self, upstream, proxy_server):
+        inspector = UploadInspector()
+        proxy_server.register_callback(inspector)
+        await start_proxy(proxy_server)
+
+        data = bytes(range(256)) * 2000
+        body = multipart(
+            ('Content-Disposition: form-data; name="title"', b"report"),
+            ('Content-Disposition: form-data; name="file"; filename="report.bin"', data))
+        for chunked in (False, True):
+            head, response = await post(proxy_server, upstream, body, MULTIPART, chunked)
+            assert head.startswith(b"HTTP/1.1 200 OK\r\n")
+            assert response == body
+        assert inspector.fields == {"title": "report"}
+        assert inspector.hashes["report.bin"].digest() == hashlib.sha256(data).digest()
+
+    async def test_stopping_early(self, upstream, proxy_server):
+        inspector = UploadInspector(stop_after="a")
+        proxy_server.register_callback(inspector)
+        await start_proxy(proxy_server)
+
+        body = b"a=1&b=" + b"x" * 100000
+        head, response = await post(proxy_server, upstream, body,
+            "application/x-www-form-urlencoded")
+        assert response == body
+        assert inspector.fields == {"a": "1"}
+
+    async def test_suppress_upload(self, upstream, proxy_server):
+        proxy_server.register_callback(UploadInspector())
+        await start_proxy(proxy_server)
+
+        body = multipart(
+            ('Content-Disposition: form-data; name="file"; filename="blocked"', b"x"))
+        head, response = await post(proxy_server, upstream, body, MULTIPART)
+        assert head.startswith(b"HTTP/1.1 403 Forbidden\r\n")
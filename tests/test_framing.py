@@ -0,0 +1,197 @@
+import asyncio
+import logging
+
+import pytest
+
+from conftest import REQUEST_BODIES, StubServer, connect, start_proxy
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+pytestmark = pytest.mark.all_loops
+
+CHUNKED_RESPONSE = (b"HTTP/1.1 200 OK\r\n"
+    b"Transfer-Encoding: chunked\r\n\r\n"
+    b"5\r\nhello\r\n"
+    b"7;ext=1\r\n, world\r\n"
+    b"0\r\n"
+    b"Checksum: abc\r\n\r\n")
+
+
+async def skip_body(reader, head):
+    """Reads past the body of a request with the given head."""
+    if b"Transfer-Encoding: chunked\r\n" in head:
+        while size := int(await reader.readuntil(b"\r\n"), 16):
+            await reader.readexactly(size + 2)
+        await reader.readuntil(b"\r\n")
+    elif b"Content-Length: " in head:
+        await reader.readexactly(
+            int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0]))
+
+
+class Upstream(StubServer):
+    """HTTP server that frames its responses according to the request path."""
+
+    def __init__(self):
+        super().__init__()
+        self.connections = 0
+
+    async def handler(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                method, path, _ = head.split(b"\r\n")[0].split(b" ")
+                if not path.endswith(b"/echo"):
+                    await skip_body(reader, head)
+                if path.endswith(b"/chunked"):
+                    writer.write(CHUNKED_RESPONSE)
+                elif path.endswith(b"/close"):
+                    writer.write(b"HTTP/1.1 200 OK\r\n\r\nuntil close")
+                    await writer.drain()
+                    break
+                elif path.endswith(b"/nocontent"):
+                    writer.write(b"HTTP/1.1 204 No Content\r\n\r\n")
+                elif path.endswith(b"/noreason"):
+                    writer.write(b"HTTP/1.1 204 \r\n\r\n")
+                elif path.endswith(b"/nophrase"):
+                    writer.write(b"HTTP/1.1 200\r\nContent-Length: 2\r\n\r\nok")
+                elif path.endswith(b"/notmodified"):
+                    writer.write(b"HTTP/1.1 304 Not Modified\r\n"
+                        b"Content-Length: 5\r\n\r\n")
+                elif path.endswith(b"/echo"):
+                    # Echo a chunked request body back
+                    body = b""
+                    while True:
+                        size = int(await reader.readuntil(b"\r\n"), 16)
+                        if size == 0:
+                            await reader.readuntil(b"\r\n")
+                            break
+                        body += await reader.readexactly(size + 2)
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: " +
+                        str(len(body)).encode() + b"\r\n\r\n" + body)
+                else:
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n")
+                    if method != b"HEAD":
+                        writer.write(b"hello")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+@pytest.fixture
+async def proxy_server(proxy_server):
+    await start_proxy(proxy_server)
+    return proxy_server
+
+@pytest.fixture
+async def client(proxy_server):
+    reader, writer = await connect(proxy_server)
+    yield reader, writer
+    writer.close()
+
+
+def request(upstream, method, path, version="HTTP/1.1", extra=b""):
+    return (f"{method} {upstream.url(path)} {version}\r\n"
+        f"Host: {upstream.address}\r\n").encode() + extra + b"\r\n"
+
+
+async def read_response(reader, size):
+    return await asyncio.wait_for(reader.readexactly(size), 2)
+
+
+class TestFraming:
+    async def test_chunked_response_relayed_with_trailers(self, upstream, client):
+        reader, writer = client
+        for _ in range(2):
+            writer.write(request(upstream, "GET", "/chunked"))
+            response = await read_response(reader, len(CHUNKED_RESPONSE))
+            assert response == CHUNKED_RESPONSE
+
+        # Both the client and server connections were kept alive
+        assert upstream.connections == 1
+
+    async def test_chunked_request_body(self, upstream, client):
+        reader, writer = client
+        writer.write(request(upstream, "POST", "/echo",
+            extra=b"Transfer-Encoding: chunked\r\n") +
+            b"3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n")
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+        assert b"Content-Length: 9" in head
+        assert await read_response(reader, 9) == b"abc\r\nde\r\n"
+
+    async def test_close_delimited_response_rechunked(self, upstream, client):
+        reader, writer = client
+        writer.write(request(upstream, "GET", "/close"))
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+        assert b"Transfer-Encoding: chunked" in head
+        body = await asyncio.wait_for(reader.readuntil(b"0\r\n\r\n"), 2)
+        assert body == b"b\r\nuntil close\r\n0\r\n\r\n"
+
+        # The client connection is still usable
+        writer.write(request(upstream, "GET", "/"))
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+        assert await read_response(reader, 5) == b"hello"
+
+    async def test_close_delimited_response_for_http_1_0(self, upstream, client):
+        reader, writer = client
+        writer.write(request(upstream, "GET", "/close", version="HTTP/1.0"))
+        response = await asyncio.wait_for(reader.read(), 2)
+        assert response == b"HTTP/1.1 200 OK\r\n\r\nuntil close"
+
+    @pytest.mark.parametrize("method, path", [
+        ("HEAD", "/"),
+        ("GET", "/nocontent"),
+        ("GET", "/notmodified"),
+    ])
+    async def test_bodiless_responses(self, upstream, client, method, path):
+        reader, writer = client
+        writer.write(request(upstream, method, path))
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+
+        # Nothing else follows, and the connection remains usable
+        writer.write(request(upstream, "GET", "/"))
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+        assert head.startswith(b"HTTP/1.1 200 OK")
+        assert await read_response(reader, 5) == b"hello"
+        assert upstream.connections == 1
+
+    async def test_empty_reason_phrase(self, upstream, client):
+        reader, writer = client
+        for _ in range(2):
+            writer.write(request(upstream, "GET", "/noreason"))
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+            assert head == b"HTTP/1.1 204 \r\n\r\n"
+
+        writer.write(request(upstream, "GET", "/nophrase"))
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+        assert head.startswith(b"HTTP/1.1 200\r\n")
+        assert await read_response(reader, 2) == b"ok"
+        # The pooled connection wasn't given up on for want of a reason phrase
+        assert upstream.connections == 1
+
+    @pytest.mark.parametrize("body", REQUEST_BODIES.values(), ids=REQUEST_BODIES)
+    async def test_keep_alive_after_request_body(self, upstream, client, body):
+        reader, writer = client
+        for path in ("/noreason", "/nophrase"):
+            writer.write(request(upstream, "POST", path)[:-2] + body)
+        writer.write(request(upstream, "GET", "/nophrase"))
+
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+        assert head == b"HTTP/1.1 204 \r\n\r\n"
+        for _ in range(2):
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+            assert head.startswith(b"HTTP/1.1 200\r\n")
+            assert await read_response(reader, 2) == b"ok"
+        # Both connections stayed in step through the bodies
+        assert upstream.connections == 1
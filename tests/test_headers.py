@@ -0,0 +1,83 @@
+from pyproxy.headers import HttpHeaders
+
+HEAD = (b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"set-cookie: a=1\r\n"
+    b"Cache-Control:no-cache\r\n"
+    b"Set-Cookie: b=2\r\n"
+    b"\r\n")
+
+
+class TestHttpHeaders:
+    def test_unmodified_head_is_untouched(self):
+        headers = HttpHeaders.from_head(HEAD)
+        assert headers["content-type"] == "text/plain"
+        assert headers.head is HEAD
+        assert not headers.modified
+
+    def test_case_insensitive_lookup(self):
+        headers = HttpHeaders.from_head(HEAD)
+        assert headers["CONTENT-TYPE"] == "text/plain"
+        assert "cache-control" in headers
+        assert "Content-Length" not in headers
+        assert headers.get("Content-Length") is None
+
+    def test_field_without_space_after_colon(self):
+        headers = HttpHeaders.from_head(HEAD)
+        assert headers["Cache-Control"] == "no-cache"
+
+    def test_repeated_fields(self):
+        headers = HttpHeaders.from_head(HEAD)
+        assert headers["Set-Cookie"] == "a=1"
+        assert headers.get_all("Set-Cookie") == ["a=1", "b=2"]
+        assert len(headers) == 3
+        assert list(headers) == ["Content-Type", "set-cookie", "Cache-Control"]
+
+    def test_set_splices_in_place(self):
+        headers = HttpHeaders.from_head(HEAD)
+        headers["Content-Type"] = "application/json"
+        assert headers.head == HEAD.replace(b"text/plain", b"application/json")
+        assert headers.modified
+
+    def test_set_replaces_repeated_fields(self):
+        headers = HttpHeaders.from_head(HEAD)
+        headers["Set-Cookie"] = "c=3"
+        assert headers.get_all("set-cookie") == ["c=3"]
+        assert headers.head == (b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain\r\n"
+            b"Set-Cookie: c=3\r\n"
+            b"Cache-Control:no-cache\r\n"
+            b"\r\n")
+
+    def test_add_and_delete(self):
+        headers = HttpHeaders.from_head(HEAD)
+        headers.add("Set-Cookie", "c=3")
+        assert headers.get_all("Set-Cookie") == ["a=1", "b=2", "c=3"]
+        del headers["set-cookie"]
+        headers["Content-Length"] = "0"
+        assert headers.head == (b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain\r\n"
+            b"Cache-Control:no-cache\r\n"
+            b"Content-Length: 0\r\n"
+            b"\r\n")
+
+    def test_start_line(self):
+        headers = HttpHeaders.from_head(HEAD)
+        headers.start_line = b"HTTP/1.1 404 Not Found"
+        assert headers["Cache-Control"] == "no-cache"
+        assert headers.head.startswith(b"HTTP/1.1 404 Not Found\r\nContent-Type:")
+
+    def test_new_headers(self):
+        headers = HttpHeaders()
+        headers.start_line = b"HTTP/1.1 200 OK"
+        headers.update({ "Content-Type": "application/json", "Date": "now" })
+        assert headers.head == (b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: application/json\r\n"
+            b"Date: now\r\n"
+            b"\r\n")
+
+    def test_clear(self):
+        headers = HttpHeaders.from_head(HEAD)
+        headers.clear()
+        assert len(headers) == 0
+        assert headers.head == b"HTTP/1.1 200 OK\r\n\r\n"
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+
+import pytest
+
+from pyproxy import ProxyServer, loops
+from pyproxy.__main__ import parse_args
+from pyproxy.loops import EventLoop, loop_factory
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+def loop_module(factory):
+    loop = factory()
+    try:
+        return type(loop).__module__.split(".")[0]
+    finally:
+        loop.close()
+
+
+class TestLoops:
+    def test_asyncio(self):
+        assert loop_module(loop_factory(EventLoop.Asyncio)) == "asyncio"
+
+    def test_auto(self):
+        expected = "uvloop" if loops.uvloop_available() else "asyncio"
+        assert loop_module(loop_factory(EventLoop.Auto)) == expected
+
+    def test_uvloop_fallback(self, monkeypatch):
+        monkeypatch.setattr(loops, "uvloop", None)
+        assert loop_module(loop_factory(EventLoop.Uvloop)) == "asyncio"
+        assert loop_module(loop_factory(EventLoop.Auto)) == "asyncio"
+
+    def test_unknown_loop(self):
+        with pytest.raises(ValueError):
+            loop_factory("twisted")
+
+    @pytest.mark.parametrize("kind", list(EventLoop))
+    def test_run(self, kind):
+        async def main():
+            await asyncio.sleep(0)
+            return type(asyncio.get_running_loop()).__module__.split(".")[0]
+
+        assert loops.run(main(), kind) == loop_module(loop_factory(kind))
+
+    def test_server_option(self):
+        server = ProxyServer("127.0.0.1", 9999)
+        assert server.options.event_loop == EventLoop.Auto
+        server.set_options(event_loop="asyncio")
+        assert server.options.event_loop == EventLoop.Asyncio
+
+    def test_cli_loop_flag(self):
+        assert parse_args([]).loop == "auto"
+        assert parse_args(["--loop", "uvloop"]).loop == "uvloop"
+        with pytest.raises(SystemExit):
+            parse_args(["--loop", "twisted"])
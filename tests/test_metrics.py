@@ -0,0 +1,130 @@
+import asyncio
+import logging
+
+import pytest
+
+import aiorequests
+from pyproxy.metrics import Counter, Histogram, MetricsRegistry
+
+from conftest import LOOPBACK, StubServer, connect, start_proxy, unused_port
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+BODY = b'{"message": "hello"}'
+
+
+class Upstream(StubServer):
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                await reader.readuntil(b"\r\n\r\n")
+                writer.write(b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: application/json\r\n"
+                    b"Content-Length: " + str(len(BODY)).encode() + b"\r\n\r\n" +
+                    BODY)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+@pytest.fixture
+def aiorequest(proxy_server):
+    return aiorequests.Requests(LOOPBACK, proxy_server.port)
+
+@pytest.fixture
+async def proxy_server(proxy_server):
+    await start_proxy(proxy_server, admin_port=unused_port())
+    return proxy_server
+
+
+async def scrape(proxy, path="/metrics"):
+    reader, writer = await asyncio.open_connection(LOOPBACK, proxy.options.admin_port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    response = await asyncio.wait_for(reader.read(), 2)
+    writer.close()
+    return response
+
+
+class TestMetrics:
+    def test_histogram_exposition(self):
+        registry = MetricsRegistry()
+        histogram = registry.register(
+            Histogram("latency_seconds", "Latency", buckets=(0.1, 1.0)))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+
+        assert registry.render() == (
+            "# HELP latency_seconds Latency\n"
+            "# TYPE latency_seconds histogram\n"
+            'latency_seconds_bucket{le="0.1"} 2\n'
+            'latency_seconds_bucket{le="1.0"} 3\n'
+            'latency_seconds_bucket{le="+Inf"} 4\n'
+            "latency_seconds_sum 2.65\n"
+            "latency_seconds_count 4\n")
+        assert registry.snapshot()["latency_seconds"]["count"] == 4
+
+    def test_labelled_metrics_share_help(self):
+        registry = MetricsRegistry()
+        registry.register(Counter("bytes_total", "Bytes", { "direction": "in" })).inc(3)
+        registry.register(Counter("bytes_total", "Bytes", { "direction": "out" })).inc()
+
+        text = registry.render()
+        assert text.count("# TYPE bytes_total counter") == 1
+        assert 'bytes_total{direction="in"} 3\n' in text
+        assert registry.snapshot() == { "bytes_total": { "in": 3, "out": 1 } }
+
+    async def test_request_metrics(self, upstream, proxy_server, aiorequest):
+        url = upstream.url("/hello")
+        for _ in range(2):
+            response = await aiorequest.get(url)
+            assert response.status == 200
+        await asyncio.sleep(0.1)
+
+        metrics = proxy_server.metrics
+        assert metrics.requests.value == 2
+        assert metrics.connections_accepted.value == 2
+        assert metrics.connections_active.value == 0
+        assert metrics.upstream_connect_seconds.count == 1
+        assert metrics.time_to_first_byte_seconds.count == 2
+        assert metrics.first_request_seconds.count == 2
+        assert metrics.bytes_to_client.value > 2 * len(BODY)
+        assert metrics.bytes_to_upstream.value > 0
+
+    async def test_tunnel_metrics(self, upstream, proxy_server):
+        reader, writer = await connect(proxy_server)
+        writer.write(f"CONNECT {upstream.address} HTTP/1.1\r\n\r\n".encode())
+        await reader.readuntil(b"\r\n\r\n")
+        assert proxy_server.metrics.tunnels_active.value == 1
+
+        request = b"GET / HTTP/1.1\r\n\r\n"
+        writer.write(request)
+        await reader.readuntil(BODY)
+        writer.close()
+        await asyncio.sleep(0.2)
+
+        metrics = proxy_server.metrics
+        assert metrics.tunnels.value == 1
+        assert metrics.tunnels_active.value == 0
+        assert metrics.bytes_to_upstream.value == len(request)
+
+    async def test_scrape_endpoint(self, upstream, proxy_server, aiorequest):
+        await aiorequest.get(upstream.url("/hello"))
+
+        response = await scrape(proxy_server)
+        assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert b"Content-Type: text/plain; version=0.0.4" in response
+        assert b"\npyproxy_requests_total 1\n" in response
+        assert b'pyproxy_callback_seconds_count{callback="on_new_request_async"}' in response
+
+        assert (await scrape(proxy_server, "/other")).startswith(b"HTTP/1.1 404")
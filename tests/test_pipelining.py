@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import time
+
+import pytest
+
+from conftest import StubServer, connect, start_proxy
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+pytestmark = pytest.mark.all_loops
+
+DELAY = 0.3
+
+
+class SlowUpstream(StubServer):
+    """Takes DELAY seconds to answer, and logs when requests start and end."""
+
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                method, target = head.decode().split(" ")[:2]
+                path = self.path(target)
+                if b"Content-Length" in head:
+                    await reader.readexactly(
+                        int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0]))
+                self.events.append(("start", path))
+                await asyncio.sleep(DELAY)
+                body = f"{method} {path}".encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: " +
+                    str(len(body)).encode() + b"\r\n\r\n" + body)
+                await writer.drain()
+                self.events.append(("end", path))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = SlowUpstream()
+    await server.start()
+    yield server
+    await server.close()
+
+@pytest.fixture
+async def proxy_server(proxy_server):
+    await start_proxy(proxy_server)
+    return proxy_server
+
+
+def request(upstream, path, method="GET", headers=""):
+    body = b"data" if method == "POST" else b""
+    if body:
+        headers += f"Content-Length: {len(body)}\r\n"
+    return (f"{method} {upstream.url(path)} HTTP/1.1\r\n"
+        f"Host: {upstream.address}\r\n{headers}\r\n").encode() + body
+
+
+async def read_response(reader):
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+    length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+    return (await reader.readexactly(length)).decode()
+
+
+class TestPipelining:
+    async def test_requests_overlap(self, upstream, proxy_server):
+        reader, writer = await connect(proxy_server)
+        start = time.monotonic()
+        writer.write(b"".join(request(upstream, f"/{n}") for n in range(4)))
+
+        for n in range(4):
+            assert await read_response(reader) == f"GET /{n}"
+        # All four went upstream before the first response came back
+        assert time.monotonic() - start < 2 * DELAY
+        assert [e for e, _ in upstream.events[:4]] == ["start"] * 4
+        writer.close()
+
+    async def test_unsafe_requests_are_serialized(self, upstream, proxy_server):
+        reader, writer = await connect(proxy_server)
+        writer.write(request(upstream, "/a") + request(upstream, "/b", "POST")
+            + request(upstream, "/c"))
+
+        assert [await read_response(reader) for _ in range(3)] == [
+            "GET /a", "POST /b", "GET /c"]
+        assert upstream.events == [
+            ("start", "/a"), ("end", "/a"),
+            ("start", "/b"), ("end", "/b"),
+            ("start", "/c"), ("end", "/c")]
+        writer.close()
+
+    async def test_connection_close_stops_reading(self, upstream, proxy_server):
+        reader, writer = await connect(proxy_server)
+        writer.write(request(upstream, "/a")
+            + request(upstream, "/b", headers="Connection: close\r\n")
+            + request(upstream, "/c"))
+
+        assert await read_response(reader) == "GET /a"
+        assert await read_response(reader) == "GET /b"
+        assert await asyncio.wait_for(reader.read(), 2) == b""
+        assert ("start", "/c") not in upstream.events
+        writer.close()
+
+    async def test_pipelining_disabled(self, upstream, proxy_server):
+        proxy_server.set_options(pipeline_depth=1)
+        reader, writer = await connect(proxy_server)
+        writer.write(request(upstream, "/a") + request(upstream, "/b"))
+
+        assert await read_response(reader) == "GET /a"
+        assert await read_response(reader) == "GET /b"
+        assert upstream.events[1] == ("end", "/a")
+        writer.close()
@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import os
+
+import pytest
+
+from pyproxy import ProxyServer
+from pyproxy.recording import INITIAL_SLOTS, Recorder, RecordingStore, recording_key
+
+from conftest import (LOOPBACK, REQUEST_BODIES, StubServer, connect, parse_request,
+    start_proxy, stop_proxy)
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+class Upstream(StubServer):
+    """Numbers its responses, and sends them chunked for /chunked."""
+
+    def __init__(self):
+        super().__init__()
+        self.requests = 0
+
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                if b"Content-Length: " in head:
+                    await reader.readexactly(
+                        int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0]))
+                self.requests += 1
+                target = head.split(b" ")[1]
+                body = b"response %d" % self.requests
+                if target.endswith(b"/chunked"):
+                    writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                        b"%x\r\n%s\r\n0\r\n\r\n" % (len(body), body))
+                else:
+                    writer.write(b"HTTP/1.1 200 OK\r\nX-Upstream: yes\r\n"
+                        b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+
+async def fetch(proxy, upstream, path, headers=""):
+    reader, writer = await connect(proxy)
+    writer.write((f"GET {upstream.url(path)} HTTP/1.1\r\n"
+        f"Host: {upstream.address}\r\n{headers}\r\n").encode())
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+    if b"Transfer-Encoding: chunked\r\n" in head:
+        size = int(await reader.readuntil(b"\r\n"), 16)
+        body = await reader.readexactly(size)
+        await reader.readuntil(b"0\r\n\r\n")
+    else:
+        length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+        body = await reader.readexactly(length)
+    writer.close()
+    return head, body
+
+
+class TestRecordingStore:
+    def test_round_trip(self, tmp_path):
+        path = str(tmp_path / "recording")
+        store = RecordingStore(path, writable=True)
+        store.append([(b"a", b"head a", b"body a"), (b"b", b"head b", b"")])
+        assert store.lookup(b"a") == (b"head a", b"body a")
+        assert store.lookup(b"b") == (b"head b", b"")
+        assert store.lookup(b"c") is None
+        store.close()
+
+        store = RecordingStore(path)
+        assert len(store) == 2
+        assert store.lookup(b"a") == (b"head a", b"body a")
+        store.close()
+
+    def test_later_entries_replace_earlier(self, tmp_path):
+        path = str(tmp_path / "recording")
+        store = RecordingStore(path, writable=True)
+        store.append([(b"a", b"head", b"first")])
+        store.append([(b"a", b"head", b"second")])
+        assert len(store) == 1
+        assert store.lookup(b"a") == (b"head", b"second")
+        store.close()
+
+    def test_index_grows(self, tmp_path):
+        path = str(tmp_path / "recording")
+        store = RecordingStore(path, writable=True)
+        count = INITIAL_SLOTS * 2
+        store.append([(b"key %d" % n, b"head", b"body %d" % n) for n in range(count)])
+        assert len(store) == count
+        assert all(store.lookup(b"key %d" % n) == (b"head", b"body %d" % n)
+            for n in range(count))
+        store.close()
+
+    def test_unindexed_entries_recovered(self, tmp_path):
+        path = str(tmp_path / "recording")
+        store = RecordingStore(path, writable=True)
+        store.append([(b"a", b"head", b"body a")])
+        store.close()
+        index = open(path + ".idx", "rb").read()
+
+        store = RecordingStore(path, writable=True)
+        store.append([(b"b", b"head", b"body b")])
+        store.close()
+        # Put back the index from before b was added, and tear an entry
+        with open(path + ".idx", "wb") as f:
+            f.write(index)
+        with open(path, "ab") as f:
+            f.write(b"\x05\0\0\0\x04\0")
+        size = os.path.getsize(path)
+
+        store = RecordingStore(path)
+        assert store.lookup(b"b") == (b"head", b"body b")
+        store.close()
+        store = RecordingStore(path, writable=True)
+        assert len(store) == 2
+        store.close()
+        assert os.path.getsize(path) == size - 6
+
+    async def test_key_includes_scheme(self):
+        plain = await parse_request(b"GET http://www.example.com:443/x HTTP/1.1\r\n"
+            b"Host: www.example.com:443\r\n\r\n")
+        secure = await parse_request(b"GET https://www.example.com:443/x HTTP/1.1\r\n"
+            b"Host: www.example.com:443\r\n\r\n")
+        assert (recording_key(plain, "www.example.com", 443)
+            != recording_key(secure, "www.example.com", 443))
+
+    def test_not_a_recording(self, tmp_path):
+        path = tmp_path / "recording"
+        path.write_bytes(b"something else")
+        with pytest.raises(ValueError):
+            RecordingStore(str(path))
+
+    async def test_recorder_queue_bounded(self, tmp_path):
+        path = str(tmp_path / "recording")
+        # Not started, so nothing is written until it's closed
+        recorder = Recorder(RecordingStore(path, writable=True), max_pending=100)
+        for n in range(4):
+            recorder.record(b"key %d" % n, b"head", b"x" * 30)
+        assert recorder.dropped == 2
+        await recorder.close()
+
+        store = RecordingStore(path)
+        assert len(store) == 2
+        assert store.lookup(b"key 1") is not None
+        assert store.lookup(b"key 2") is None
+        store.close()
+
+
+class TestRecordReplay:
+    async def test_record_then_replay(self, tmp_path, upstream, proxy_server):
+        path = str(tmp_path / "recording")
+        await start_proxy(proxy_server, record_mode="record", record_file=path)
+        head, body = await fetch(proxy_server, upstream, "/one")
+        assert body == b"response 1"
+        head, body = await fetch(proxy_server, upstream, "/chunked")
+        assert body == b"response 2"
+        await proxy_server.close()
+        await upstream.close()
+
+        server = ProxyServer(LOOPBACK, 0)
+        server.set_options(allow_loopback_target=True)
+        try:
+            await start_proxy(server, record_mode="replay", record_file=path)
+            head, body = await fetch(server, upstream, "/one")
+            assert head.startswith(b"HTTP/1.1 200 OK\r\n")
+            assert b"X-Upstream: yes\r\n" in head
+            assert body == b"response 1"
+            head, body = await fetch(server, upstream, "/chunked")
+            assert b"Transfer-Encoding" not in head
+            assert body == b"response 2"
+
+            head, body = await fetch(server, upstream, "/two")
+            assert head.startswith(b"HTTP/1.1 502 Bad Gateway\r\n")
+            assert server.metrics.responses_replayed.value == 2
+            assert server.metrics.replay_misses.value == 1
+        finally:
+            await stop_proxy(server)
+        await upstream.start()
+
+    async def test_key_headers(self, tmp_path, upstream, proxy_server):
+        path = str(tmp_path / "recording")
+        await start_proxy(proxy_server, record_mode="record", record_file=path,
+            record_key_headers=("Accept-Language",))
+        await fetch(proxy_server, upstream, "/", "Accept-Language: en\r\n")
+        await fetch(proxy_server, upstream, "/", "Accept-Language: fr\r\n")
+        await proxy_server.close()
+
+        store = RecordingStore(path)
+        assert len(store) == 2
+        store.close()
+
+    async def test_replay_forwards_misses(self, tmp_path, upstream, proxy_server):
+        path = str(tmp_path / "recording")
+        RecordingStore(path, writable=True).close()
+        await start_proxy(proxy_server, record_mode="replay", record_file=path,
+            replay_forward_misses=True)
+        head, body = await fetch(proxy_server, upstream, "/one")
+        assert body == b"response 1"
+
+    async def test_replay_miss_keeps_connection(self, tmp_path, upstream, proxy_server):
+        path = str(tmp_path / "recording")
+        RecordingStore(path, writable=True).close()
+        await start_proxy(proxy_server, record_mode="replay", record_file=path)
+
+        reader, writer = await connect(proxy_server)
+        for _ in range(2):
+            writer.write((f"GET {upstream.url('/one')} HTTP/1.1\r\n"
+                f"Host: {upstream.address}\r\n\r\n").encode())
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+            assert head.startswith(b"HTTP/1.1 502 Bad Gateway\r\n")
+        writer.close()
+        assert upstream.requests == 0
+
+    @pytest.mark.parametrize("body", REQUEST_BODIES.values(), ids=REQUEST_BODIES)
+    async def test_replay_skips_body(self, tmp_path, upstream, proxy_server, body):
+        path = str(tmp_path / "recording")
+        await start_proxy(proxy_server, record_mode="record", record_file=path)
+        reader, writer = await connect(proxy_server)
+        writer.write(f"POST {upstream.url('/one')} HTTP/1.1\r\n"
+            f"Host: {upstream.address}\r\n".encode() + REQUEST_BODIES["content-length"])
+        await asyncio.wait_for(reader.readuntil(b"response 1"), 2)
+        writer.close()
+        await proxy_server.close()
+
+        server = ProxyServer(LOOPBACK, 0)
+        server.set_options(allow_loopback_target=True)
+        try:
+            await start_proxy(server, record_mode="replay", record_file=path)
+            # A miss, a hit and a request after them, all on one connection
+            reader, writer = await connect(server)
+            for target in ("/two", "/one"):
+                writer.write(f"POST {upstream.url(target)} HTTP/1.1\r\n"
+                    f"Host: {upstream.address}\r\n".encode() + body)
+            writer.write((f"GET {upstream.url('/three')} HTTP/1.1\r\n"
+                f"Host: {upstream.address}\r\n\r\n").encode())
+            for status in (b"502 Bad Gateway", b"200 OK", b"502 Bad Gateway"):
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+                assert head.startswith(b"HTTP/1.1 " + status + b"\r\n")
+                length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+                await reader.readexactly(length)
+            writer.close()
+            assert server.metrics.responses_replayed.value == 1
+            assert server.metrics.replay_misses.value == 2
+        finally:
+            await stop_proxy(server)
@@ -9,35 +9,23 @@ import pytest
 from pytest_httpserver import HTTPServer
 
 import aiorequests
+from conftest import LOOPBACK, REQUEST_BODIES, connect, start_proxy
 from pyproxy import (
-    HttpRequest, HttpResponse, ProxyServer, ProxyServerAction, ProxyServerCallback
+    HttpRequest, HttpResponse, ProxyServerAction, ProxyServerCallback
 )
 
-LOOPBACK = "127.0.0.1"
-HTTP_SERVER_PORT = 9998
-PROXY_PORT = 9999
-
 _LOGGER = logging.getLogger(__name__)
 
 logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
 
-@pytest.fixture(scope="session")
-def httpserver_listen_address():
-    return (LOOPBACK, HTTP_SERVER_PORT)
-
 @pytest.fixture
-def aiorequest():
-    return aiorequests.Requests(LOOPBACK, PROXY_PORT)
+async def proxy_server(proxy_server):
+    await start_proxy(proxy_server)
+    return proxy_server
 
 @pytest.fixture
-async def proxy_server():
-    server = ProxyServer(LOOPBACK, PROXY_PORT)
-    server.set_options(allow_loopback_target=True)
-    server_task = asyncio.create_task(server.run(), name="server")
-    yield server
-    await server.close()
-    await asyncio.sleep(0.25)
-    server_task.cancel()
+def aiorequest(proxy_server):
+    return aiorequests.Requests(LOOPBACK, proxy_server.port)
 
 
 class Callback(ProxyServerCallback):
@@ -80,6 +68,28 @@ class Callback(ProxyServerCallback):
         response.set_body(callback_payload.encode())
 
 
+class NoContentCallback(ProxyServerCallback):
+    """Answers every request itself with a bodiless 204."""
+
+    def __init__(self):
+        self.methods = []
+
+    async def on_new_request_async(
+        self, request: HttpRequest) -> ProxyServerAction:
+        self.methods.append(request.method)
+        return ProxyServerAction.Suppress
+
+    async def on_new_response_async(
+        self,
+        action: ProxyServerAction,
+        request: HttpRequest,
+        response: HttpResponse) -> None:
+
+        response.http_version = request.version
+        response.response_code = 204
+        response.response_text = "No Content"
+
+
 class TestRequestSuppression:
     async def test_request_suppressed(
         self, httpserver: HTTPServer, proxy_server, aiorequest):
@@ -97,3 +107,29 @@ class TestRequestSuppression:
         responsejson = await response.json()
         assert responsejson != server_payload
         assert responsejson == callback_payload
+
+    async def test_suppressed_with_no_content(self, proxy_server):
+        proxy_server.register_callback(NoContentCallback())
+
+        reader, writer = await connect(proxy_server)
+        # The connection stays usable after a response without a body
+        for _ in range(2):
+            writer.write(b"GET http://example.com/ HTTP/1.1\r\nHost: example.com\r\n\r\n")
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+            assert head.startswith(b"HTTP/1.1 204 No Content\r\n")
+        writer.close()
+
+    @pytest.mark.parametrize("body", REQUEST_BODIES.values(), ids=REQUEST_BODIES)
+    async def test_suppressed_with_request_body(self, proxy_server, body):
+        callback = NoContentCallback()
+        proxy_server.register_callback(callback)
+
+        reader, writer = await connect(proxy_server)
+        # The unread body is skipped, not taken for the next request
+        writer.write(b"POST http://example.com/ HTTP/1.1\r\nHost: example.com\r\n"
+            + body + b"GET http://example.com/ HTTP/1.1\r\nHost: example.com\r\n\r\n")
+        for _ in range(2):
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+            assert head.startswith(b"HTTP/1.1 204 No Content\r\n")
+        writer.close()
+        assert callback.methods == ["POST", "GET"]
@@ -1,39 +1,26 @@
-import asyncio
 import logging
 
 import pytest
 from pytest_httpserver import HTTPServer
 
 import aiorequests
+from conftest import LOOPBACK, start_proxy
 from pyproxy import (
-    HttpRequest, HttpResponse, ProxyServer, ProxyServerAction, ProxyServerCallback
+    HttpRequest, HttpResponse, ProxyServerAction, ProxyServerCallback
 )
 
-LOOPBACK = "127.0.0.1"
-HTTP_SERVER_PORT = 9998
-PROXY_PORT = 9999
-
 _LOGGER = logging.getLogger(__name__)
 
 logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
 
-@pytest.fixture(scope="session")
-def httpserver_listen_address():
-    return (LOOPBACK, HTTP_SERVER_PORT)
-
 @pytest.fixture
-def aiorequest():
-    return aiorequests.Requests(LOOPBACK, PROXY_PORT)
+async def proxy_server(proxy_server):
+    await start_proxy(proxy_server)
+    return proxy_server
 
 @pytest.fixture
-async def proxy_server():
-    server = ProxyServer(LOOPBACK, PROXY_PORT)
-    server.set_options(allow_loopback_target=True)
-    server_task = asyncio.create_task(server.run(), name="server")
-    yield server
-    await server.close()
-    await asyncio.sleep(0.25)
-    server_task.cancel()
+def aiorequest(proxy_server):
+    return aiorequests.Requests(LOOPBACK, proxy_server.port)
 
 
 class Callback(ProxyServerCallback):
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import socket
+import time
+
+import pytest
+
+import aiorequests
+from pyproxy.resolver import (
+    CachingResolver, Resolver, connect_happy_eyeballs, interleave_families
+)
+
+from conftest import LOOPBACK, StubServer, start_proxy, unused_port
+
+# TEST-NET-1 (RFC 5737): never routed, so connecting to it fails or hangs
+UNREACHABLE = "192.0.2.1"
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+def addrinfo(ip, port, family=socket.AF_INET):
+    sockaddr = (ip, port) if family == socket.AF_INET else (ip, port, 0, 0)
+    return (family, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", sockaddr)
+
+
+class StubResolver(Resolver):
+    """Resolves names from a dict and counts the lookups it gets."""
+
+    def __init__(self, hosts, delay=0.0):
+        self.hosts = hosts
+        self.delay = delay
+        self.lookups = 0
+
+    async def resolve(self, host, port):
+        self.lookups += 1
+        await asyncio.sleep(self.delay)
+        if host not in self.hosts:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [addrinfo(ip, port) for ip in self.hosts[host]]
+
+
+class Upstream(StubServer):
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                await reader.readuntil(b"\r\n\r\n")
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+@pytest.fixture
+def aiorequest(proxy_server):
+    return aiorequests.Requests(LOOPBACK, proxy_server.port)
+
+@pytest.fixture
+def stub_resolver():
+    return StubResolver({ "upstream.test": [UNREACHABLE, LOOPBACK] })
+
+@pytest.fixture
+async def proxy_server(proxy_server, stub_resolver):
+    proxy_server.set_resolver(stub_resolver)
+    # Connect anew for every request
+    await start_proxy(proxy_server, happy_eyeballs_delay=0.1, pool_max_idle=0)
+    return proxy_server
+
+
+class TestCachingResolver:
+    async def test_positive_ttl(self):
+        stub = StubResolver({ "a.test": ["10.0.0.1"] })
+        resolver = CachingResolver(stub, positive_ttl=0.2)
+        for _ in range(3):
+            assert await resolver.resolve("a.test", 80) == [addrinfo("10.0.0.1", 80)]
+        assert stub.lookups == 1
+
+        await asyncio.sleep(0.3)
+        await resolver.resolve("a.test", 80)
+        assert stub.lookups == 2
+
+    async def test_negative_ttl(self):
+        stub = StubResolver({ })
+        resolver = CachingResolver(stub, negative_ttl=60)
+        for _ in range(2):
+            with pytest.raises(socket.gaierror):
+                await resolver.resolve("missing.test", 80)
+        assert stub.lookups == 1
+
+    async def test_concurrent_lookups_share_one_query(self):
+        stub = StubResolver({ "a.test": ["10.0.0.1"] }, delay=0.1)
+        resolver = CachingResolver(stub)
+        results = await asyncio.gather(
+            *(resolver.resolve("a.test", 80) for _ in range(10)))
+        assert stub.lookups == 1
+        assert all(result == results[0] for result in results)
+
+    async def test_cancelled_caller_does_not_cancel_others(self):
+        stub = StubResolver({ "a.test": ["10.0.0.1"] }, delay=0.1)
+        resolver = CachingResolver(stub)
+        first = asyncio.create_task(resolver.resolve("a.test", 80))
+        second = asyncio.create_task(resolver.resolve("a.test", 80))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == [addrinfo("10.0.0.1", 80)]
+
+    async def test_numeric_addresses_skip_lookup(self):
+        stub = StubResolver({ })
+        resolver = CachingResolver(stub)
+        assert await resolver.resolve("::1", 80) == [
+            addrinfo("::1", 80, socket.AF_INET6)]
+        assert stub.lookups == 0
+
+
+class TestHappyEyeballs:
+    def test_interleave_families(self):
+        v6 = [addrinfo(f"::{i}", 80, socket.AF_INET6) for i in (1, 2)]
+        v4 = [addrinfo(f"10.0.0.{i}", 80) for i in (1, 2, 3)]
+        ordered = interleave_families(v6 + v4)
+        assert ordered == [v6[0], v4[0], v6[1], v4[1], v4[2]]
+
+    async def test_unreachable_address_does_not_stall(self, upstream):
+        start = time.monotonic()
+        sock = await connect_happy_eyeballs([
+            addrinfo(UNREACHABLE, upstream.port),
+            addrinfo(LOOPBACK, upstream.port)], delay=0.1)
+        with sock:
+            assert sock.getpeername() == (LOOPBACK, upstream.port)
+        assert time.monotonic() - start < 1
+
+    async def test_all_addresses_fail(self):
+        # Nothing listens on these
+        port = unused_port()
+        with pytest.raises(OSError):
+            await connect_happy_eyeballs([
+                addrinfo(LOOPBACK, port),
+                addrinfo("127.0.0.2", port)], delay=0.1)
+
+
+class TestProxyResolution:
+    async def test_request_through_stub_resolver(
+        self, upstream, proxy_server, stub_resolver, aiorequest):
+
+        url = f"http://upstream.test:{upstream.port}/hello"
+        for _ in range(2):
+            response = await asyncio.wait_for(aiorequest.get(url), 2)
+            assert response.status == 200
+
+        assert stub_resolver.lookups == 1
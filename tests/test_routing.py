@@ -0,0 +1,140 @@
+import asyncio
+import logging
+
+import pytest
+
+import aiorequests
+from pyproxy import (
+    HttpRequest, HttpResponse, ProxyServerAction, ProxyServerCallback
+)
+from pyproxy.routing import CallbackRouter
+
+from conftest import LOOPBACK, StubServer, start_proxy
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+class Upstream(StubServer):
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                await reader.readuntil(b"\r\n\r\n")
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 8\r\n\r\nupstream")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+@pytest.fixture
+def aiorequest(proxy_server):
+    return aiorequests.Requests(LOOPBACK, proxy_server.port)
+
+@pytest.fixture
+async def proxy_server(proxy_server):
+    await start_proxy(proxy_server)
+    return proxy_server
+
+
+class NamedCallback(ProxyServerCallback):
+    def __init__(self, name):
+        self.name = name
+        self.requests = []
+        self.responses = []
+
+    async def on_new_request_async(self, request: HttpRequest) -> ProxyServerAction:
+        self.requests.append(request.url.path)
+        return ProxyServerAction.Forward
+
+    async def on_new_response_async(
+        self,
+        action: ProxyServerAction,
+        request: HttpRequest,
+        response: HttpResponse) -> None:
+
+        self.responses.append(request.url.path)
+        response.headers["X-Callback"] = self.name
+
+    def __repr__(self):
+        return self.name
+
+
+class TestRouting:
+    def test_host_patterns(self):
+        router = CallbackRouter()
+        exact, wildcard, anything = (NamedCallback(n) for n in ("exact", "wildcard", "any"))
+        router.add(exact, hosts=["api.example.com"])
+        router.add(wildcard, hosts=["*.example.com"])
+        router.add(anything)
+
+        assert router.match("API.example.com", 80, "GET", "/") is exact
+        assert router.match("www.example.com", 80, "GET", "/") is wildcard
+        assert router.match("a.b.example.com", 80, "GET", "/") is wildcard
+        assert router.match("example.com", 80, "GET", "/") is anything
+        assert router.match("example.org", 80, "GET", "/") is anything
+
+    def test_longest_path_prefix_wins(self):
+        router = CallbackRouter()
+        short, long = NamedCallback("short"), NamedCallback("long")
+        router.add(short, hosts="example.com", paths=["/api"])
+        router.add(long, hosts="example.com", paths=["/api/v2/"])
+
+        assert router.match("example.com", 80, "GET", "/api/v2/items") is long
+        assert router.match("example.com", 80, "GET", "/api/v1/items") is short
+        assert router.match("example.com", 80, "GET", "/") is None
+        assert router.match("other.com", 80, "GET", "/api") is None
+
+    def test_path_prefix_matches_segments(self):
+        router = CallbackRouter()
+        api = NamedCallback("api")
+        router.add(api, paths=["/api"])
+
+        assert router.match("example.com", 80, "GET", "/api") is api
+        assert router.match("example.com", 80, "GET", "/api/items") is api
+        assert router.match("example.com", 80, "GET", "/api?q=1") is api
+        assert router.match("example.com", 80, "GET", "/apiv2") is None
+        assert router.match("example.com", 80, "GET", "/apiv2/items") is None
+
+    def test_methods_and_ports(self):
+        router = CallbackRouter()
+        uploads, tls = NamedCallback("uploads"), NamedCallback("tls")
+        router.add(uploads, methods=["post", "PUT"])
+        router.add(tls, ports=[443])
+
+        assert router.match("example.com", 80, "POST", "/") is uploads
+        assert router.match("example.com", 443, "POST", "/") is uploads
+        assert router.match("example.com", 443, "GET", "/") is tls
+        assert router.match("example.com", 80, "GET", "/") is None
+
+    def test_invalid_pattern(self):
+        with pytest.raises(ValueError):
+            CallbackRouter().add(NamedCallback("bad"), hosts=["www.*.com"])
+
+    async def test_dispatch(self, upstream, proxy_server, aiorequest):
+        api = NamedCallback("api")
+        other = NamedCallback("other")
+        proxy_server.register_callback(api, hosts=[LOOPBACK], paths=["/api/"])
+        proxy_server.register_callback(other, hosts=["*.example.com"])
+
+        base = upstream.url("")
+        response = await aiorequest.get(f"{base}/api/items")
+        assert response.headers["X-Callback"] == "api"
+
+        # Matches nothing, so goes straight through
+        response = await aiorequest.get(f"{base}/index.html")
+        assert response.status == 200
+        assert "X-Callback" not in response.headers
+
+        assert api.requests == api.responses == ["/api/items"]
+        assert other.requests == []
+        assert proxy_server.metrics.request_callback_seconds.count == 1
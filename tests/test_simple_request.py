@@ -1,37 +1,25 @@
-import asyncio
 import logging
 
 import pytest
 from pytest_httpserver import HTTPServer
 
 import aiorequests
-from pyproxy import ProxyServer
-
-LOOPBACK = "127.0.0.1"
-HTTP_SERVER_PORT = 9998
-PROXY_PORT = 9999
+from conftest import LOOPBACK, start_proxy
 
 _LOGGER = logging.getLogger(__name__)
 
 logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
 
-@pytest.fixture(scope="session")
-def httpserver_listen_address():
-    return (LOOPBACK, HTTP_SERVER_PORT)
+pytestmark = pytest.mark.all_loops
 
 @pytest.fixture
-def aiorequest():
-    return aiorequests.Requests(LOOPBACK, PROXY_PORT)
+async def proxy_server(proxy_server):
+    await start_proxy(proxy_server)
+    return proxy_server
 
 @pytest.fixture
-async def proxy_server():
-    server = ProxyServer(LOOPBACK, PROXY_PORT)
-    server.set_options(allow_loopback_target=True)
-    server_task = asyncio.create_task(server.run(), name="server")
-    yield server
-    await server.close()
-    await asyncio.sleep(0.25)
-    server_task.cancel()
+def aiorequest(proxy_server):
+    return aiorequests.Requests(LOOPBACK, proxy_server.port)
 
 
 class TestSimpleRequests:
@@ -51,10 +39,10 @@ class TestSimpleRequests:
         payload = { "message": "hello" }
         httpserver.expect_request("/hello").respond_with_json(payload)
 
-        aiorequest = aiorequests.Requests(LOOPBACK, PROXY_PORT)
+        aiorequest = aiorequests.Requests(LOOPBACK, proxy_server.port)
         aiorequest._proxy_entry = { }
-        headers = { "Host": f"{LOOPBACK}:{HTTP_SERVER_PORT}" }
-        response = await aiorequest.get(f"http://{LOOPBACK}:{PROXY_PORT}/hello",
+        headers = { "Host": f"{LOOPBACK}:{httpserver.port}" }
+        response = await aiorequest.get(f"http://{LOOPBACK}:{proxy_server.port}/hello",
             headers=headers)
         assert response.status == 200
         assert await response.json() == payload
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import threading
+import time
+
+import pytest
+
+from pyproxy import (
+    HttpRequest, HttpResponse, ProxyServerAction, ProxyServerSyncCallback
+)
+from pyproxy.callbackpool import CallbackPool
+
+from conftest import StubServer, connect, start_proxy
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+class Upstream(StubServer):
+    """Answers with the request body, or "ok" if there is none."""
+
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                body = b"ok"
+                if b"Content-Length: " in head:
+                    length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+                    body = await reader.readexactly(length)
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body)
+                    + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+
+class SlowPolicy(ProxyServerSyncCallback):
+    """Blocks in its request hook, like CPU-heavy policy code would."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.threads = set()
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def on_new_request(self, request: HttpRequest) -> ProxyServerAction:
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        self.threads.add(threading.current_thread().name)
+        time.sleep(self.delay)
+        with self._lock:
+            self.active -= 1
+        return ProxyServerAction.Forward
+
+    def on_new_response(
+        self, action: ProxyServerAction, request: HttpRequest, response: HttpResponse
+        ) -> None:
+
+        response.headers["X-Policy"] = "checked"
+
+
+class BodyPolicy(ProxyServerSyncCallback):
+    read_bodies = True
+
+    def __init__(self):
+        self.seen = []
+
+    def on_new_request(self, request: HttpRequest) -> ProxyServerAction:
+        body = request.get_body_buffer()
+        self.seen.append(bytes(body))
+        return (ProxyServerAction.Suppress if bytes(body[:5]) == b"block"
+            else ProxyServerAction.Forward)
+
+    def on_new_response(
+        self, action: ProxyServerAction, request: HttpRequest, response: HttpResponse
+        ) -> None:
+
+        if action == ProxyServerAction.Suppress:
+            response.http_version = request.version
+            response.response_code = 403
+            response.response_text = "Forbidden"
+            response.set_body(b"blocked")
+        else:
+            self.seen.append(bytes(response.get_body_buffer()))
+
+
+async def fetch(proxy, upstream, path="/", body=None):
+    reader, writer = await connect(proxy)
+    method = "POST" if body is not None else "GET"
+    extra = f"Content-Length: {len(body)}\r\n" if body is not None else ""
+    writer.write((f"{method} {upstream.url(path)} HTTP/1.1\r\n"
+        f"Host: {upstream.address}\r\n{extra}\r\n").encode() + (body or b""))
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+    length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+    response = await reader.readexactly(length)
+    writer.close()
+    return head, response
+
+
+class TestSyncCallbacks:
+    async def test_callback_pool_limit(self):
+        pool = CallbackPool(threads=4, concurrency=2)
+        policy = SlowPolicy(0.1)
+        await asyncio.gather(*(pool.run(policy.on_new_request, None) for _ in range(6)))
+        assert policy.max_active == 2
+        pool.close()
+
+    async def test_slow_hook_does_not_block_loop(self, upstream, proxy_server):
+        policy = SlowPolicy(0.5)
+        proxy_server.register_callback(policy, paths=["/slow"])
+        await start_proxy(proxy_server)
+
+        slow = asyncio.create_task(fetch(proxy_server, upstream, "/slow"))
+        await asyncio.sleep(0.05)
+        start_time = time.monotonic()
+        head, body = await fetch(proxy_server, upstream, "/fast")
+        assert body == b"ok"
+        assert time.monotonic() - start_time < 0.3
+
+        head, body = await slow
+        assert b"X-Policy: checked\r\n" in head
+        assert all(name.startswith("callback") for name in policy.threads)
+
+    async def test_concurrency_limit(self, upstream, proxy_server):
+        policy = SlowPolicy(0.2)
+        proxy_server.register_callback(policy)
+        await start_proxy(proxy_server, callback_threads=4, callback_concurrency=1)
+
+        start_time = time.monotonic()
+        await asyncio.gather(*(fetch(proxy_server, upstream) for _ in range(3)))
+        assert policy.max_active == 1
+        assert time.monotonic() - start_time >= 0.6
+
+    async def test_hooks_see_bodies(self, upstream, proxy_server):
+        policy = BodyPolicy()
+        proxy_server.register_callback(policy)
+        await start_proxy(proxy_server, body_spill_threshold=1024)
+
+        large = b"x" * 100000
+        head, body = await fetch(proxy_server, upstream, body=large)
+        assert body == large
+        # The request body and the echoed response body, spooled to disk
+        assert policy.seen == [large, large]
+
+        head, body = await fetch(proxy_server, upstream, body=b"block this")
+        assert head.startswith(b"HTTP/1.1 403 Forbidden\r\n")
+        assert body == b"blocked"
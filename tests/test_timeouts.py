@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+
+import pytest
+
+from pyproxy.timer import TimerWheel, touch
+
+from conftest import StubServer, connect, start_proxy
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+class Upstream(StubServer):
+    """Sends /trickle a byte at a time and never finishes /stall."""
+
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                path = self.path(head.split(b" ")[1])
+                if path == b"/trickle":
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n")
+                    for _ in range(10):
+                        await asyncio.sleep(0.1)
+                        writer.write(b"x")
+                        await writer.drain()
+                elif path == b"/stall":
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nx")
+                    await writer.drain()
+                    await asyncio.sleep(10)
+                else:
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+@pytest.fixture
+async def proxy_server(proxy_server):
+    await start_proxy(proxy_server, header_timeout=0.5, idle_timeout=0.5,
+        read_timeout=0.5, timer_resolution=0.05)
+    return proxy_server
+
+
+async def wait_closed(reader):
+    """Returns how long it took the proxy to close the connection."""
+    start = time.monotonic()
+    data = await asyncio.wait_for(reader.read(), 3)
+    return time.monotonic() - start, data
+
+
+def get(upstream, path):
+    return (f"GET {upstream.url(path)} HTTP/1.1\r\n"
+        f"Host: {upstream.address}\r\n\r\n").encode()
+
+
+class TestTimerWheel:
+    async def test_deadline_expires(self):
+        wheel = TimerWheel(resolution=0.05)
+        start = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            with wheel.deadline(0.2):
+                await asyncio.sleep(5)
+        assert 0.2 <= time.monotonic() - start < 0.5
+        assert len(wheel) == 0
+
+    async def test_touch_keeps_deadline_alive(self):
+        wheel = TimerWheel(resolution=0.05)
+        with wheel.deadline(0.2):
+            for _ in range(10):
+                await asyncio.sleep(0.05)
+                touch()
+
+    async def test_touched_deadline_not_doubled(self):
+        wheel = TimerWheel(resolution=0.05)
+        start = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            with wheel.deadline(0.4):
+                await asyncio.sleep(0.01)
+                touch()
+                await asyncio.sleep(5)
+        # Counted from the touch, not from when the wheel noticed it
+        assert 0.4 <= time.monotonic() - start < 0.65
+
+    async def test_reset_changes_timeout(self):
+        wheel = TimerWheel(resolution=0.05)
+        with pytest.raises(asyncio.TimeoutError):
+            with wheel.deadline(0.1) as deadline:
+                # A timeout of 0 never expires
+                assert deadline.reset(0) == 0.1
+                await asyncio.sleep(0.3)
+                deadline.reset(0.1)
+                await asyncio.sleep(1)
+
+    async def test_one_timer_for_many_deadlines(self):
+        wheel = TimerWheel(resolution=0.05)
+
+        async def wait(timeout):
+            with wheel.deadline(timeout):
+                await asyncio.sleep(timeout * 2)
+
+        tasks = [asyncio.create_task(wait(0.1 + i * 0.01)) for i in range(100)]
+        await asyncio.sleep(0)
+        assert len(wheel) == 100
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert all(isinstance(r, asyncio.TimeoutError) for r in results)
+        assert len(wheel) == 0
+
+
+class TestTimeouts:
+    async def test_header_timeout(self, proxy_server):
+        reader, writer = await connect(proxy_server)
+        writer.write(b"GET http://")
+        elapsed, _ = await wait_closed(reader)
+        assert 0.4 < elapsed < 1.5
+        writer.close()
+
+    async def test_idle_timeout(self, upstream, proxy_server):
+        reader, writer = await connect(proxy_server)
+        writer.write(get(upstream, "/"))
+        await reader.readuntil(b"ok")
+        elapsed, data = await wait_closed(reader)
+        assert data == b""
+        assert 0.4 < elapsed < 1.5
+        writer.close()
+
+    async def test_slow_response_outlives_read_timeout(self, upstream, proxy_server):
+        reader, writer = await connect(proxy_server)
+        writer.write(get(upstream, "/trickle"))
+        await asyncio.wait_for(reader.readuntil(b"xxxxxxxxxx"), 3)
+        writer.close()
+
+    async def test_stalled_response_hits_read_timeout(self, upstream, proxy_server):
+        reader, writer = await connect(proxy_server)
+        writer.write(get(upstream, "/stall"))
+        elapsed, data = await wait_closed(reader)
+        assert data.endswith(b"\r\n\r\nx")
+        assert elapsed < 1.5
+        writer.close()
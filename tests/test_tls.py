@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import shutil
+import ssl
+import subprocess
+
+import pytest
+
+from pyproxy import TlsProfile
+from pyproxy.tls import TlsContexts
+from pyproxy.upstreams import UpstreamGroup, parse_backend
+
+from conftest import StubServer, connect, start_proxy
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    """A self-signed certificate for 127.0.0.1 and localhost, and its key."""
+    if shutil.which("openssl") is None:
+        pytest.skip("needs the openssl command")
+    directory = tmp_path_factory.mktemp("tls")
+    cert, key = str(directory / "cert.pem"), str(directory / "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+        "-keyout", key, "-out", cert, "-days", "1", "-subj", "/CN=localhost",
+        "-addext", "subjectAltName=IP:127.0.0.1,DNS:localhost"],
+        check=True, capture_output=True)
+    return cert, key
+
+
+class Backend(StubServer):
+    """An HTTPS server that counts the connections it gets."""
+
+    def __init__(self, certificate):
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(*certificate)
+        super().__init__(ssl=context)
+        self.connections = 0
+
+    async def handler(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                await reader.readuntil(b"\r\n\r\n")
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\nsecure")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def backend(certificate):
+    server = Backend(certificate)
+    await server.start()
+    yield server
+    await server.close()
+
+
+async def get(proxy, target="/", host="www.example.com"):
+    reader, writer = await connect(proxy)
+    try:
+        writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+        return head, await reader.readexactly(length)
+    finally:
+        writer.close()
+
+
+class TestTlsProfiles:
+    def test_parse_backend(self):
+        assert parse_backend("backend:8080") == ("backend", 8080, False)
+        assert parse_backend("http://backend") == ("backend", 80, False)
+        assert parse_backend("https://backend") == ("backend", 443, True)
+        assert parse_backend("https://[::1]:8443/") == ("::1", 8443, True)
+        with pytest.raises(ValueError):
+            parse_backend("ftp://backend")
+
+    def test_group_backends(self):
+        profile = TlsProfile(server_name="backend.internal")
+        group = UpstreamGroup(["10.0.0.1:80", "https://10.0.0.2"], tls=profile)
+        assert [b.tls for b in group.backends] == [False, True]
+        assert group.tls is profile
+
+    def test_contexts_shared(self, certificate):
+        contexts = TlsContexts()
+        context = contexts.get(TlsProfile(ca_file=certificate[0]))
+        assert contexts.get(TlsProfile(ca_file=certificate[0])) is context
+        # The server name is given per connection, not per context
+        assert contexts.get(
+            TlsProfile(ca_file=certificate[0], server_name="localhost")) is context
+        assert contexts.get(TlsProfile(verify=False)) is not context
+        assert len(contexts) == 2
+
+
+class TestUpstreamTls:
+    async def test_reverse_proxy_reuses_connection(
+        self, certificate, backend, proxy_server):
+
+        proxy_server.register_upstream([f"https://{backend.address}"],
+            tls=TlsProfile(ca_file=certificate[0]))
+        await start_proxy(proxy_server, forward_proxy=False)
+
+        for _ in range(3):
+            head, body = await get(proxy_server)
+            assert head.startswith(b"HTTP/1.1 200 OK\r\n")
+            assert body == b"secure"
+        assert backend.connections == 1
+        assert proxy_server.metrics.upstream_tls_handshakes.value == 1
+
+    async def test_session_resumed(self, certificate, backend, proxy_server):
+        proxy_server.register_upstream([f"https://{backend.address}"],
+            tls=TlsProfile(ca_file=certificate[0], server_name="localhost"))
+        # Every request gets a new connection
+        await start_proxy(proxy_server, forward_proxy=False, pool_max_idle=0)
+
+        for _ in range(3):
+            head, body = await get(proxy_server)
+            assert body == b"secure"
+        assert backend.connections == 3
+        assert proxy_server.metrics.upstream_tls_handshakes.value == 3
+        assert proxy_server.metrics.upstream_tls_resumed.value == 2
+
+    async def test_forward_https_target(self, certificate, backend, proxy_server):
+        await start_proxy(proxy_server, upstream_tls_ca_file=certificate[0])
+
+        head, body = await get(proxy_server, f"https://{backend.address}/",
+            backend.address)
+        assert head.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert body == b"secure"
+
+    async def test_untrusted_certificate(self, backend, proxy_server):
+        proxy_server.register_upstream([f"https://{backend.address}"])
+        await start_proxy(proxy_server, forward_proxy=False)
+
+        head, _ = await get(proxy_server)
+        assert head.startswith(b"HTTP/1.1 502 Bad Gateway\r\n")
+        assert proxy_server.metrics.upstream_tls_handshakes.value == 0
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import socket
+
+import pytest
+
+from pyproxy.relay import BufferPool, RelayEngine, attach_local, open_relay
+from pyproxy.tunnel import TunnelMode, splice_supported
+
+from conftest import LOOPBACK, StubServer, connect, start_proxy
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+# The streams and tunnel paths depend on event loop internals
+pytestmark = pytest.mark.all_loops
+
+MODES = [
+    { "tunnel_mode": TunnelMode.Streams },
+    { "tunnel_mode": TunnelMode.RecvInto },
+    { "tunnel_mode": TunnelMode.Auto },
+    # Small watermarks and buffers to exercise flow control
+    { "relay_engine": RelayEngine.Protocol, "relay_buffer_size": 1024,
+      "relay_high_watermark": 4096, "relay_low_watermark": 1024 },
+]
+if splice_supported():
+    MODES.append({ "tunnel_mode": TunnelMode.Splice })
+
+
+async def echo_handler(reader, writer):
+    try:
+        while data := await reader.read(64 * 1024):
+            writer.write(data)
+            await writer.drain()
+    finally:
+        writer.close()
+
+@pytest.fixture
+async def upstream():
+    server = await StubServer(echo_handler).start()
+    yield server
+    await server.close()
+
+@pytest.fixture(params=MODES, ids=lambda options: "-".join(map(str, options.values())))
+async def proxy_server(proxy_server, request):
+    await start_proxy(proxy_server, **request.param)
+    return proxy_server
+
+
+async def open_tunnel(proxy, upstream, early_data=b""):
+    reader, writer = await connect(proxy)
+    writer.write(f"CONNECT {upstream.address} HTTP/1.1\r\n"
+        f"Host: {upstream.address}\r\n\r\n".encode() + early_data)
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+    assert head.startswith(b"HTTP/1.1 200")
+    return reader, writer
+
+
+class TestTunnel:
+    async def test_tunnel_relays_both_ways(self, upstream, proxy_server):
+        # Data sent along with the CONNECT request must not get lost
+        reader, writer = await open_tunnel(proxy_server, upstream, early_data=b"early")
+        payload = bytes(range(256)) * 4096
+        writer.write(payload)
+        await writer.drain()
+
+        echoed = await asyncio.wait_for(
+            reader.readexactly(len(payload) + len(b"early")), 5)
+        assert echoed == b"early" + payload
+        writer.close()
+
+    async def test_tunnel_half_close(self, upstream, proxy_server):
+        reader, writer = await open_tunnel(proxy_server, upstream)
+        writer.write(b"last words")
+        writer.write_eof()
+
+        # The upstream sees our EOF, echoes what it got and closes
+        assert await asyncio.wait_for(reader.read(), 2) == b"last words"
+        writer.close()
+
+
+class TestRelay:
+    async def test_buffers_returned_after_backpressure(self, upstream):
+        buffers = BufferPool(1024)
+        done = asyncio.Event()
+
+        async def handler(reader, writer):
+            # A small send buffer, so the relay backs up sooner
+            writer.get_extra_info("socket").setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            relay = await open_relay(LOOPBACK, upstream.port, buffers,
+                high_watermark=4096, low_watermark=1024)
+            attach_local(relay, (reader, writer))
+            await relay.wait()
+            done.set()
+
+        local = await StubServer(handler).start()
+        reader, writer = await connect(local)
+        payload = bytes(range(256)) * 4096
+        writer.write(payload)
+        # Not reading yet, until the transports have been holding on to
+        # buffers
+        for _ in range(200):
+            if buffers.allocated > 2:
+                break
+            await asyncio.sleep(0.01)
+        echoed = await asyncio.wait_for(reader.readexactly(len(payload)), 5)
+        assert echoed == payload
+        writer.close()
+        await asyncio.wait_for(done.wait(), 2)
+        await local.close()
+        await asyncio.sleep(0.05)
+
+        assert buffers.allocated > 2
+        assert len(buffers) == buffers.allocated
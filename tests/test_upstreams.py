@@ -0,0 +1,287 @@
+import asyncio
+import logging
+import socket
+
+import pytest
+
+from pyproxy.upstreams import UpstreamGroup, parse_address
+
+from conftest import (LOOPBACK, REQUEST_BODIES, StubServer, connect, start_proxy,
+    unused_port)
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+
+class Backend(StubServer):
+    """Answers with its port and the request head it got."""
+
+    def __init__(self, status=200, delay=0.0):
+        super().__init__()
+        self.status = status
+        self.delay = delay
+        self.connections = 0
+        self.requests = 0
+        self.heads = []
+
+    async def handler(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                self.requests += 1
+                self.heads.append(head)
+                await asyncio.sleep(self.delay)
+                body = b"%d" % self.port
+                writer.write(b"HTTP/1.1 %d Whatever\r\nContent-Length: %d\r\n\r\n%s"
+                    % (self.status, len(body), body))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def backends():
+    servers = [Backend() for _ in range(2)]
+    for server in servers:
+        await server.start()
+    yield servers
+    for server in servers:
+        await server.close()
+
+
+async def get(proxy, path="/", host="www.example.com"):
+    reader, writer = await connect(proxy)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+    length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+    body = await reader.readexactly(length)
+    writer.close()
+    return head, body
+
+
+@pytest.fixture
+def unresponsive():
+    """
+    The port of a listener whose backlog is full, so connecting to it hangs.
+    """
+    listener = socket.socket()
+    listener.bind((LOOPBACK, 0))
+    listener.listen(0)
+    port = listener.getsockname()[1]
+    queued = socket.create_connection((LOOPBACK, port))
+    yield port
+    queued.close()
+    listener.close()
+
+
+async def tunnel(proxy, port):
+    """Asks proxy for a tunnel to a loopback port, returning all it sends."""
+    reader, writer = await connect(proxy)
+    writer.write(f"CONNECT {LOOPBACK}:{port} HTTP/1.1\r\n"
+        f"Host: {LOOPBACK}:{port}\r\n\r\n".encode())
+    try:
+        return await asyncio.wait_for(reader.read(), 2)
+    finally:
+        writer.close()
+
+
+def addresses(*ports):
+    return [f"{LOOPBACK}:{port}" for port in ports]
+
+
+class TestUpstreamGroup:
+    def test_parse_address(self):
+        assert parse_address("backend:8080") == ("backend", 8080)
+        assert parse_address("backend") == ("backend", 80)
+        assert parse_address("[::1]:8080") == ("::1", 8080)
+        assert parse_address("::1") == ("::1", 80)
+
+    def test_least_outstanding(self):
+        group = UpstreamGroup(["a:80", "b:80", "c:80"])
+        a, b, c = group.backends
+        group.begin(a)
+        group.begin(a)
+        group.begin(b)
+        assert group.choose() is c
+        group.begin(c)
+        group.begin(c)
+        assert group.choose() is b
+        assert group.choose(exclude=[b]) in (a, c)
+
+    def test_ewma(self):
+        group = UpstreamGroup(["a:80", "b:80"], method="ewma")
+        a, b = group.backends
+        for backend, latency in ((a, 0.5), (b, 0.1)):
+            group.record(backend, group.begin(backend) - latency, 200)
+            group.end(backend)
+        assert group.choose() is b
+        # Busy enough to be slower than a, for now
+        for _ in range(6):
+            group.begin(b)
+        assert group.choose() is a
+
+    def test_ejection(self):
+        group = UpstreamGroup(["a:80", "b:80"], max_fails=2, eject_time=10)
+        a, b = group.backends
+        assert not group.record(a, group.begin(a))
+        assert group.record(a, group.begin(a), 503)
+        assert all(group.choose() is b for _ in range(10))
+
+        # With everything ejected, the one back first is used
+        group.record(b, group.begin(b))
+        group.record(b, group.begin(b))
+        assert group.choose() is a
+
+    def test_success_resets_failures(self):
+        group = UpstreamGroup(["a:80"], max_fails=2)
+        a, = group.backends
+        group.record(a, group.begin(a))
+        group.record(a, group.begin(a), 200)
+        assert not group.record(a, group.begin(a))
+
+
+class TestReverseProxy:
+    async def test_balanced_across_backends(self, backends, proxy_server):
+        for backend in backends:
+            backend.delay = 0.1
+        ports = [backend.port for backend in backends]
+        proxy_server.register_upstream(addresses(*ports), hosts=["www.example.com"])
+        await start_proxy(proxy_server)
+
+        results = await asyncio.gather(*(get(proxy_server) for _ in range(6)))
+        assert sorted(body for _, body in results) == sorted(
+            b"%d" % port for port in ports * 3)
+        head = backends[0].heads[0]
+        assert head.startswith(b"GET / HTTP/1.1\r\n")
+        assert b"X-Forwarded-For: 127.0.0.1\r\n" in head
+        assert b"X-Forwarded-Host: www.example.com\r\n" in head
+
+    async def test_routes(self, backends, proxy_server):
+        www, api = backends
+        proxy_server.register_upstream(addresses(www.port), hosts=["www.example.com"])
+        proxy_server.register_upstream(addresses(api.port), hosts=["*.example.com"],
+            paths=["/api/"])
+        await start_proxy(proxy_server, forward_proxy=False)
+
+        assert (await get(proxy_server, "/api/x"))[1] == b"%d" % www.port
+        assert (await get(proxy_server, "/api/x", "api.example.com"))[1] == b"%d" % api.port
+        head, _ = await get(proxy_server, "/", "api.example.com")
+        assert head.startswith(b"HTTP/1.1 404 Not Found\r\n")
+
+    async def test_not_found_keeps_connection(self, proxy_server):
+        await start_proxy(proxy_server, forward_proxy=False)
+
+        reader, writer = await connect(proxy_server)
+        for _ in range(2):
+            writer.write(b"GET / HTTP/1.1\r\nHost: www.example.com\r\n\r\n")
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+            assert head.startswith(b"HTTP/1.1 404 Not Found\r\n")
+        writer.close()
+
+    @pytest.mark.parametrize("body", REQUEST_BODIES.values(), ids=REQUEST_BODIES)
+    async def test_not_found_skips_body(self, proxy_server, body):
+        await start_proxy(proxy_server, forward_proxy=False)
+
+        reader, writer = await connect(proxy_server)
+        # The next request is read from after the body, not from inside it
+        writer.write(b"POST / HTTP/1.1\r\nHost: www.example.com\r\n" + body
+            + b"GET /next HTTP/1.1\r\nHost: www.example.com\r\n\r\n")
+        for _ in range(2):
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+            assert head.startswith(b"HTTP/1.1 404 Not Found\r\n")
+        writer.close()
+
+    async def test_connect_refused_without_forward_proxy(self, backends, proxy_server):
+        proxy_server.register_upstream(addresses(backends[0].port),
+            hosts=["www.example.com"])
+        await start_proxy(proxy_server, forward_proxy=False)
+
+        response = await tunnel(proxy_server, backends[1].port)
+        assert response.startswith(b"HTTP/1.1 403 Forbidden\r\n")
+        assert proxy_server.metrics.tunnels.value == 0
+        assert backends[1].connections == 0
+
+    @pytest.mark.parametrize("forward_proxy", [False, True])
+    async def test_connect_refused_with_catch_all_group(
+        self, backends, proxy_server, forward_proxy):
+
+        proxy_server.register_upstream(addresses(backends[0].port))
+        await start_proxy(proxy_server, forward_proxy=forward_proxy)
+        # Every host routes to the group, which tunnels don't go to
+        response = await tunnel(proxy_server, backends[1].port)
+        assert response.startswith(b"HTTP/1.1 403 Forbidden\r\n")
+
+        # Nor do they go to loopback, group or not
+        proxy_server.set_options(allow_loopback_target=False)
+        assert await tunnel(proxy_server, backends[1].port) == b""
+        assert proxy_server.metrics.tunnels.value == 0
+        assert backends[1].connections == 0
+
+    async def test_failing_backend_ejected(self, backends, proxy_server):
+        group = proxy_server.register_upstream(
+            addresses(backends[0].port, unused_port()), max_fails=1)
+        await start_proxy(proxy_server)
+
+        # Requests to the backend that's down are retried on the other one.
+        # Enough are sent that the one that's down is almost surely picked
+        for _ in range(16):
+            head, body = await get(proxy_server)
+            assert body == b"%d" % backends[0].port
+        down = group.backends[1]
+        assert down.ejections == 1 and down.outstanding == 0
+        assert proxy_server.metrics.backend_ejections.value == 1
+
+    async def test_backend_connect_timeout(self, backends, unresponsive, proxy_server):
+        group = proxy_server.register_upstream(
+            addresses(backends[0].port, unresponsive), max_fails=1)
+        await start_proxy(proxy_server, connect_timeout=0.2)
+
+        for _ in range(16):
+            head, body = await get(proxy_server)
+            assert body == b"%d" % backends[0].port
+        down = group.backends[1]
+        assert down.ejections == 1 and down.outstanding == 0
+
+    async def test_all_backends_down(self, unresponsive, proxy_server):
+        proxy_server.register_upstream(addresses(unused_port(), unused_port()),
+            hosts=["refused.example.com"])
+        proxy_server.register_upstream(addresses(unresponsive),
+            hosts=["timeout.example.com"])
+        await start_proxy(proxy_server, forward_proxy=False, connect_timeout=0.2)
+
+        head, _ = await get(proxy_server, host="refused.example.com")
+        assert head.startswith(b"HTTP/1.1 502 Bad Gateway\r\n")
+        head, _ = await get(proxy_server, host="timeout.example.com")
+        assert head.startswith(b"HTTP/1.1 504 Gateway Timeout\r\n")
+
+    @pytest.mark.parametrize("body", REQUEST_BODIES.values(), ids=REQUEST_BODIES)
+    async def test_all_backends_down_with_body(self, proxy_server, body):
+        proxy_server.register_upstream(addresses(unused_port()))
+        await start_proxy(proxy_server, forward_proxy=False)
+
+        # How much of the body was read is unknown, so the connection is
+        # closed rather than read from where the next request might be
+        reader, writer = await connect(proxy_server)
+        writer.write(b"POST / HTTP/1.1\r\nHost: www.example.com\r\n" + body
+            + b"GET /next HTTP/1.1\r\nHost: www.example.com\r\n\r\n")
+        response = await asyncio.wait_for(reader.read(), 2)
+        assert response.startswith(b"HTTP/1.1 502 Bad Gateway\r\n")
+        assert b"Connection: close\r\n" in response
+        assert response.count(b"HTTP/1.1") == 1
+        writer.close()
+
+    async def test_error_responses_count(self, backends, proxy_server):
+        backends[1].status = 503
+        group = proxy_server.register_upstream(
+            addresses(*(backend.port for backend in backends)), max_fails=2)
+        await start_proxy(proxy_server)
+
+        # Backends are picked at random among equals: send enough requests
+        # that the failing one is almost surely picked twice
+        statuses = [(await get(proxy_server))[0].split(b" ")[1] for _ in range(32)]
+        assert statuses.count(b"503") == 2
+        assert group.backends[1].ejections == 1
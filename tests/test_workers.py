@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import sys
+
+import pytest
+
+from pyproxy.__main__ import parse_args
+
+from conftest import LOOPBACK, StubServer, unused_port
+
+_LOGGER = logging.getLogger(__name__)
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+# The workers can't each listen on port 0, as they have to share the port
+SUPERVISOR = """
+from pyproxy import ProxyServer, WorkerSupervisor
+
+def create_server():
+    server = ProxyServer("{address}", {port})
+    server.set_options(allow_loopback_target=True)
+    return server
+
+raise SystemExit(WorkerSupervisor(create_server, workers=2, restart_delay=0.1).run())
+"""
+
+pytestmark = pytest.mark.skipif(
+    not os.path.exists(f"/proc/{os.getpid()}/task/{os.getpid()}/children"),
+    reason="needs fork() and /proc child lists")
+
+
+class Upstream(StubServer):
+    async def handler(self, reader, writer):
+        try:
+            while True:
+                await reader.readuntil(b"\r\n\r\n")
+                body = str(os.getpid()).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: " +
+                    str(len(body)).encode() + b"\r\n\r\n" + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+async def upstream():
+    server = Upstream()
+    await server.start()
+    yield server
+    await server.close()
+
+@pytest.fixture
+async def supervisor():
+    port = unused_port()
+    process = subprocess.Popen([sys.executable, "-c",
+        SUPERVISOR.format(address=LOOPBACK, port=port)])
+    process.port = port
+    yield process
+    if process.poll() is None:
+        process.terminate()
+        process.wait(5)
+
+
+def workers(process):
+    with open(f"/proc/{process.pid}/task/{process.pid}/children") as children:
+        return sorted(int(pid) for pid in children.read().split())
+
+
+async def wait_for_workers(process, count, timeout=5):
+    for _ in range(int(timeout / 0.1)):
+        pids = workers(process)
+        if len(pids) == count:
+            return pids
+        await asyncio.sleep(0.1)
+    raise AssertionError(f"expected {count} workers, got {workers(process)}")
+
+
+async def get(supervisor, upstream):
+    for _ in range(50):
+        try:
+            reader, writer = await asyncio.open_connection(LOOPBACK, supervisor.port)
+            break
+        except ConnectionRefusedError:
+            # Workers are still starting up
+            await asyncio.sleep(0.1)
+    writer.write(f"GET {upstream.url()} HTTP/1.1\r\n"
+        f"Host: {upstream.address}\r\n\r\n".encode())
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2)
+    writer.close()
+    return head
+
+
+class TestWorkers:
+    def test_cli_workers_flag(self):
+        assert parse_args([]).workers is None
+        assert parse_args(["--workers"]).workers == 0
+        assert parse_args(["--workers", "3"]).workers == 3
+
+    async def test_workers_serve_requests(self, upstream, supervisor):
+        await wait_for_workers(supervisor, 2)
+        for _ in range(4):
+            assert (await get(supervisor, upstream)).startswith(b"HTTP/1.1 200 OK")
+
+    async def test_crashed_worker_restarted(self, upstream, supervisor):
+        pids = await wait_for_workers(supervisor, 2)
+        os.kill(pids[0], signal.SIGKILL)
+        await asyncio.sleep(0.5)
+
+        new_pids = await wait_for_workers(supervisor, 2)
+        assert pids[0] not in new_pids
+        assert pids[1] in new_pids
+        assert (await get(supervisor, upstream)).startswith(b"HTTP/1.1 200 OK")
+
+    async def test_sighup_restarts_all_workers(self, supervisor):
+        pids = await wait_for_workers(supervisor, 2)
+        supervisor.send_signal(signal.SIGHUP)
+        await asyncio.sleep(0.5)
+
+        new_pids = await wait_for_workers(supervisor, 2)
+        assert not set(pids) & set(new_pids)
+
+    async def test_sigterm_stops_workers(self, supervisor):
+        await wait_for_workers(supervisor, 2)
+        supervisor.send_signal(signal.SIGTERM)
+        for _ in range(50):
+            if supervisor.poll() is not None:
+                break
+            await asyncio.sleep(0.1)
+        assert supervisor.returncode == 0